@@ -1,7 +1,8 @@
 from django.contrib import admin
 
-from .models import (Assignment, AssignmentGroup, SavedComment, Version,
-                     VersionFile, VersionText)
+from .models import (Assignment, AssignmentGroup, AssignmentJob,
+                     CanvasUploadCheckpoint, SavedComment, Version,
+                     VersionFile, VersioningState, VersionText)
 
 # Register your models here.
 
@@ -14,14 +15,29 @@ class AssignmentAdmin(admin.ModelAdmin):
         'assignment_group_object__name',
     ]
 
+    def get_queryset(self, request):
+        return Assignment.annotate_grading_stats(
+            super().get_queryset(request).select_related('course', 'assignment_group_object'))
+
 class SavedCommentAdmin(admin.ModelAdmin):
     list_display = ['id', '__str__', 'author', 'assignment', 'position', 'version', 'question_number', 'created_at']
     list_filter = ['author', 'assignment__course', 'assignment']
 
+class AssignmentJobAdmin(admin.ModelAdmin):
+    list_display = ['id', 'job_type', 'assignment', 'status', 'progress', 'created_by', 'created_at', 'finished_at']
+    list_filter = ['job_type', 'status', 'assignment__course']
+
+class CanvasUploadCheckpointAdmin(admin.ModelAdmin):
+    list_display = ['id', 'submission', 'key', 'uploaded_at']
+    list_filter = ['submission__assignment']
+
 admin.site.register(Assignment, AssignmentAdmin)
+admin.site.register(AssignmentJob, AssignmentJobAdmin)
+admin.site.register(CanvasUploadCheckpoint, CanvasUploadCheckpointAdmin)
 
 admin.site.register(Version)
 admin.site.register(VersionFile)
 admin.site.register(VersionText)
+admin.site.register(VersioningState)
 admin.site.register(SavedComment, SavedCommentAdmin)
 admin.site.register(AssignmentGroup)
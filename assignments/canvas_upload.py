@@ -0,0 +1,324 @@
+"""Concurrent upload of grades and comments to Canvas submissions.
+
+An upload is a dict with the Canvas ids of the course, the assignment
+and the student of a submission, and the list of operations to run on
+that submission, in order:
+
+    {"course_id": ..., "assignment_id": ..., "user_id": ...,
+     "operations": [
+        {"type": "grade", "posted_grade": 9.5, "text_comment": "..."},
+        {"type": "comment", "text_comment": "..."},
+        {"type": "file", "path": "/path/to/file.pdf", "name": "file.pdf"},
+     ]}
+
+Any other keys of the uploads and operations are passed through
+untouched, so the caller can use them to record what was uploaded.
+
+The uploads run concurrently, at most `max_concurrency` submissions at
+a time, while the operations of a submission run one after the other so
+that the comments keep their order. The requests take their turn from
+the rate limiter of the Canvas transport, see `courses.canvas_transport`,
+and are counted in its metrics. A request that gets a 429, 5xx or 403
+Rate Limit Exceeded response or a connection error is retried with
+exponential backoff. The requests that post a comment are only retried
+when Canvas certainly did not process them (429, 503, 403 Rate Limit
+Exceeded or a refused connection), since retrying them after a timeout
+or another 5xx could post the comment twice.
+The first operation of a submission that still fails stops the
+submission, so a later run can resume from it.
+
+With `bulk=True`, the grades and text comments are sent instead with
+the bulk `update_grades` endpoint, `bulk_chunk_size` students per
+request, and the Progress object Canvas returns for each request is
+polled until the grades are saved. A student can only get one text
+comment per request, so the k-th comments of all students go in the
+k-th round of requests. The files, which have no bulk endpoint, are
+uploaded afterwards for each submission.
+
+This module does not touch the database: the results are yielded in
+the calling thread by `CanvasUploader.iter_upload`, which runs the
+event loop in a background thread.
+"""
+import asyncio
+import os
+import queue
+import random
+import threading
+import time
+
+import aiohttp
+
+from courses.canvas_transport import get_canvas_transport, is_throttled
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# the statuses of the requests that Canvas rejected without processing
+# them, which can be retried even when they post a comment
+REJECTED_STATUSES = {429, 503}
+# the operations that can be sent with the bulk update_grades endpoint
+BULK_OPERATION_TYPES = {"grade", "comment"}
+
+
+class CanvasUploadError(Exception):
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+def encode_form(data, prefix=""):
+    """Flatten nested dicts and lists to the form fields of the Canvas API,
+    e.g. {"comment": {"file_ids": [1]}} -> [("comment[file_ids][]", "1")]
+    """
+    fields = []
+    if isinstance(data, dict):
+        for key, value in data.items():
+            fields += encode_form(value, f"{prefix}[{key}]" if prefix else key)
+    elif isinstance(data, (list, tuple)):
+        for value in data:
+            fields += encode_form(value, f"{prefix}[]")
+    elif data is not None:
+        fields.append((prefix, str(data)))
+    return fields
+
+
+class CanvasUploader:
+    def __init__(
+        self,
+        base_url,
+        token,
+        max_concurrency=8,
+        max_retries=5,
+        backoff=1.0,
+        max_backoff=60.0,
+        timeout=120,
+        bulk_chunk_size=500,
+        poll_interval=1.0,
+        transport=None,
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.token = token
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.bulk_chunk_size = bulk_chunk_size
+        self.poll_interval = poll_interval
+        self.transport = transport if transport is not None else get_canvas_transport()
+
+    def get_retry_delay(self, attempt, response=None):
+        if response is not None and "Retry-After" in response.headers:
+            try:
+                return min(float(response.headers["Retry-After"]), self.max_backoff)
+            except ValueError:
+                pass
+        # full jitter, so that the retries of the concurrent uploads spread out
+        return random.uniform(0, min(self.backoff * 2 ** attempt, self.max_backoff))
+
+    async def request(self, session, method, url, authenticated=True, idempotent=True, **kwargs):
+        """Send a request, retrying on 429, 5xx and connection errors,
+        and return the decoded JSON response.
+
+        If idempotent is False, e.g. for the requests that post a comment,
+        only the requests that were not processed by Canvas are retried.
+        """
+        headers = {"Authorization": f"Bearer {self.token}"} if authenticated else {}
+        for attempt in range(self.max_retries + 1):
+            waited = await self.transport.bucket.acquire_async()
+            start = time.perf_counter()
+            try:
+                async with session.request(method, url, headers=headers, **kwargs) as response:
+                    if response.status < 400:
+                        self.transport.record(
+                            response.status, time.perf_counter() - start, waited, response.headers)
+                        return await response.json(content_type=None)
+                    text = await response.text()
+                    self.transport.record(
+                        response.status, time.perf_counter() - start, waited, response.headers, text)
+                    retry_statuses = RETRY_STATUSES if idempotent else REJECTED_STATUSES
+                    retry = response.status in retry_statuses or is_throttled(response.status, text)
+                    if not retry or attempt == self.max_retries:
+                        raise CanvasUploadError(
+                            f"{method} {url} failed with {response.status}: {text[:200]}",
+                            status=response.status)
+                    delay = self.get_retry_delay(attempt, response)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                self.transport.record(None, time.perf_counter() - start, waited)
+                # the request may have been processed, unless the connection was refused
+                sent = not isinstance(e, aiohttp.ClientConnectorError)
+                if attempt == self.max_retries or (sent and not idempotent):
+                    raise CanvasUploadError(f"{method} {url} failed: {e!r}")
+                delay = self.get_retry_delay(attempt)
+            await asyncio.sleep(delay)
+
+    def get_submissions_url(self, upload):
+        return (
+            f"{self.base_url}/api/v1/courses/{upload['course_id']}"
+            f"/assignments/{upload['assignment_id']}/submissions")
+
+    def get_submission_url(self, upload):
+        return f"{self.get_submissions_url(upload)}/{upload['user_id']}"
+
+    async def edit_submission(self, session, upload, data):
+        return await self.request(
+            session, "PUT", self.get_submission_url(upload), data=encode_form(data),
+            idempotent="comment" not in data)
+
+    async def upload_comment_file(self, session, upload, path, name):
+        """Upload a file in the three steps of the Canvas file upload API
+        and return the id of the uploaded file."""
+        size = os.path.getsize(path)
+        upload_target = await self.request(
+            session, "POST", f"{self.get_submission_url(upload)}/comments/files",
+            data=encode_form({"name": name, "size": size}), idempotent=False)
+        with open(path, "rb") as f:
+            form = aiohttp.FormData()
+            for key, value in upload_target.get("upload_params", {}).items():
+                form.add_field(key, str(value))
+            form.add_field("file", f, filename=name)
+            uploaded = await self.request(
+                session, "POST", upload_target["upload_url"], authenticated=False, data=form)
+        return uploaded["id"]
+
+    async def run_operation(self, session, upload, operation):
+        if operation["type"] == "grade":
+            data = {"submission": {"posted_grade": operation["posted_grade"]}}
+            if operation.get("text_comment"):
+                data["comment"] = {"text_comment": operation["text_comment"]}
+            return await self.edit_submission(session, upload, data)
+        if operation["type"] == "comment":
+            return await self.edit_submission(
+                session, upload, {"comment": {"text_comment": operation["text_comment"]}})
+        if operation["type"] == "file":
+            file_id = await self.upload_comment_file(
+                session, upload, operation["path"], operation["name"])
+            return await self.edit_submission(
+                session, upload, {"comment": {"file_ids": [file_id]}})
+        raise ValueError(f"Unknown operation type: {operation['type']}")
+
+    async def wait_for_progress(self, session, progress):
+        """Poll a Canvas Progress object until its job is over."""
+        while progress["workflow_state"] in ("queued", "running"):
+            await asyncio.sleep(self.poll_interval)
+            progress = await self.request(
+                session, "GET", f"{self.base_url}/api/v1/progress/{progress['id']}")
+        if progress["workflow_state"] != "completed":
+            raise CanvasUploadError(
+                f"Progress {progress['id']} {progress['workflow_state']}: {progress.get('message')}")
+        return progress
+
+    async def update_grades(self, session, semaphore, chunk, emit, failed):
+        """Send the (upload, operation) pairs of a chunk, of different
+        students, in one update_grades request."""
+        grade_data = {}
+        for upload, operation in chunk:
+            data = {}
+            if operation["type"] == "grade":
+                data["posted_grade"] = operation["posted_grade"]
+            if operation.get("text_comment"):
+                data["text_comment"] = operation["text_comment"]
+            grade_data[upload["user_id"]] = data
+        async with semaphore:
+            try:
+                progress = await self.request(
+                    session, "POST", f"{self.get_submissions_url(chunk[0][0])}/update_grades",
+                    data=encode_form({"grade_data": grade_data}),
+                    idempotent=not any("text_comment" in data for data in grade_data.values()))
+                progress = await self.wait_for_progress(session, progress)
+            except CanvasUploadError as e:
+                for upload, operation in chunk:
+                    failed.add(id(upload))
+                    emit((upload, operation, None, e))
+                return
+        for upload, operation in chunk:
+            emit((upload, operation, progress, None))
+
+    async def update_grades_in_bulk(self, session, semaphore, uploads, emit, stop):
+        bulk_operations = [
+            [operation for operation in upload["operations"]
+             if operation["type"] in BULK_OPERATION_TYPES]
+            for upload in uploads
+        ]
+        failed = set()
+        n_rounds = max(map(len, bulk_operations), default=0)
+        for k in range(n_rounds):
+            if stop.is_set():
+                return
+            pending = [
+                (upload, operations[k])
+                for upload, operations in zip(uploads, bulk_operations)
+                if len(operations) > k and id(upload) not in failed
+            ]
+            await asyncio.gather(*(
+                self.update_grades(
+                    session, semaphore, pending[i:i + self.bulk_chunk_size], emit, failed)
+                for i in range(0, len(pending), self.bulk_chunk_size)
+            ))
+        # the files of the submissions whose grades and comments were uploaded
+        await asyncio.gather(*(
+            self.upload_submission(session, semaphore, {
+                **upload,
+                "operations": [
+                    operation for operation in upload["operations"]
+                    if operation["type"] not in BULK_OPERATION_TYPES],
+            }, emit, stop)
+            for upload in uploads if id(upload) not in failed
+        ))
+
+    async def upload_submission(self, session, semaphore, upload, emit, stop):
+        async with semaphore:
+            for operation in upload["operations"]:
+                if stop.is_set():
+                    return
+                try:
+                    response = await self.run_operation(session, upload, operation)
+                except (CanvasUploadError, OSError) as e:
+                    emit((upload, operation, None, e))
+                    return
+                emit((upload, operation, response, None))
+
+    async def upload_all(self, uploads, emit, stop, bulk=False):
+        semaphore = asyncio.BoundedSemaphore(self.max_concurrency)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        connector = aiohttp.TCPConnector(limit=self.max_concurrency)
+        async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+            if bulk:
+                await self.update_grades_in_bulk(session, semaphore, uploads, emit, stop)
+                return
+            await asyncio.gather(*(
+                self.upload_submission(session, semaphore, upload, emit, stop)
+                for upload in uploads
+            ))
+
+    def iter_upload(self, uploads, bulk=False):
+        """
+        Run the uploads and yield (upload, operation, response, error) for each
+        operation as soon as it finishes. error is None when the operation was
+        confirmed by Canvas, and response is the JSON of the last response,
+        or the completed Progress object for the operations sent in bulk.
+        Closing the generator stops the uploads before their next operation.
+        """
+        results = queue.Queue()
+        stop = threading.Event()
+        done = object()
+
+        def run():
+            try:
+                asyncio.run(self.upload_all(uploads, results.put, stop, bulk=bulk))
+            except BaseException as e:
+                results.put(e)
+            finally:
+                results.put(done)
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        try:
+            while True:
+                result = results.get()
+                if result is done:
+                    break
+                if isinstance(result, BaseException):
+                    raise result
+                yield result
+        finally:
+            stop.set()
+            thread.join()
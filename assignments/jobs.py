@@ -0,0 +1,90 @@
+"""Runners of the assignment jobs executed by `run_assignment_jobs`.
+
+Each runner receives the AssignmentJob, does the work of the
+corresponding API endpoint and returns the JSON-serializable
+payload that the endpoint used to return directly.
+"""
+from django.core.files.storage import default_storage
+
+from submissions.models import PaperSubmission, PaperSubmissionImage
+
+
+def run_split_pdfs_job(job):
+    """Split the PDFs stored by the upload endpoint into submissions,
+    and delete them once they are split."""
+    pdf_names = job.params.get("pdf_names") or []
+    job.set_progress(0, "Splitting the PDFs into submissions")
+    pdf_files = [default_storage.open(pdf_name) for pdf_name in pdf_names]
+    try:
+        submission_pks = PaperSubmission.add_papersubmissions_to_db(
+            assignment_target=job.assignment,
+            num_pages_per_submission=job.params["num_pages_per_submission"],
+            uploaded_files=pdf_files,
+            progress_callback=job.get_progress_callback("Splitting the PDFs into submissions"),
+        )
+    finally:
+        for pdf_file in pdf_files:
+            pdf_file.close()
+        for pdf_name in pdf_names:
+            default_storage.delete(pdf_name)
+    return {
+        "submission_ids": submission_pks,
+    }
+
+
+def run_identify_job(job):
+    pages_selected = job.params.get("pages_selected") or []
+    max_page_num = PaperSubmissionImage.get_max_page_number(job.assignment) or 0
+    print(f"pages_selected: {pages_selected}")
+    pages_to_skip = tuple(
+        i for i in range(max_page_num) if i + 1 not in pages_selected
+    )
+    print(f"pages_to_skip: {pages_to_skip}")
+    job.set_progress(0, "Identifying submissions")
+    classified_submission_pks, not_classified_submission_pks, reassigned = (
+        PaperSubmission.classify(
+            job.assignment,
+            skip_pages=pages_to_skip,
+            progress_callback=job.get_progress_callback("Identifying submissions"),
+        )
+    )
+    return {
+        "classified_submission_pks": classified_submission_pks,
+        "not_classified_submission_pks": not_classified_submission_pks,
+        "reassigned": reassigned,
+    }
+
+
+def run_version_job(job):
+    job.set_progress(0, "Versioning submissions")
+    submissions_serialized, outliers = PaperSubmission.perform_versioning(
+        job.assignment,
+        selected_pages=(3,),
+        incremental=job.params.get("incremental", True),
+        method=job.params.get("method") or "text",
+        progress_callback=job.get_progress_callback("Versioning submissions"),
+    )
+    return {
+        "submissions": submissions_serialized,
+        "outliers": int(outliers),
+    }
+
+
+def run_extract_info_job(job):
+    job.set_progress(0, "Extracting info from submissions")
+    submissions_serialized = PaperSubmission.extract_info(
+        job.assignment,
+        info_fields=job.params.get("info_fields"),
+        progress_callback=job.get_progress_callback("Extracting info from submissions"),
+    )
+    return {
+        "submissions": submissions_serialized,
+    }
+
+
+JOB_RUNNERS = {
+    "split_pdfs": run_split_pdfs_job,
+    "identify": run_identify_job,
+    "version": run_version_job,
+    "extract_info": run_extract_info_job,
+}
@@ -0,0 +1,81 @@
+import time
+from multiprocessing import get_all_start_methods, get_context
+from threading import Thread
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from assignments.models import AssignmentJob
+
+
+def work(poll_interval, once):
+    """Run queued jobs one after the other until interrupted.
+
+    If `once` is True, return as soon as the queue is empty.
+    """
+    while True:
+        job = AssignmentJob.claim_next()
+        if job is None:
+            if once:
+                return
+            time.sleep(poll_interval)
+            continue
+        job.run()
+
+
+class Command(BaseCommand):
+    help = "Run the queued assignment jobs (split PDFs, identify, version, extract info)"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=1,
+            help="Number of jobs to run concurrently",
+        )
+        parser.add_argument(
+            "--poll-interval",
+            type=float,
+            default=2.0,
+            help="Seconds to wait before checking an empty queue again",
+        )
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Exit when the queue is empty",
+        )
+
+    def handle(self, *args, **options):
+        workers = options["workers"]
+        poll_interval = options["poll_interval"]
+        once = options["once"]
+        n_stale = AssignmentJob.fail_stale()
+        if n_stale:
+            self.stdout.write(f"Marked {n_stale} abandoned running job(s) as failed")
+        self.stdout.write(f"Starting {workers} job worker(s)...")
+        if workers <= 1:
+            work(poll_interval, once)
+            return
+
+        # each worker needs its own database connection
+        connections.close_all()
+        if "fork" in get_all_start_methods():
+            context = get_context("fork")
+            runners = [
+                context.Process(target=work, args=(poll_interval, once))
+                for _ in range(workers)
+            ]
+        else:
+            runners = [
+                Thread(target=work, args=(poll_interval, once), daemon=True)
+                for _ in range(workers)
+            ]
+        for runner in runners:
+            runner.start()
+        try:
+            for runner in runners:
+                runner.join()
+        except KeyboardInterrupt:
+            for runner in runners:
+                if hasattr(runner, "terminate"):
+                    runner.terminate()
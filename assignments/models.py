@@ -1,17 +1,24 @@
+import hashlib
 import os
-import shutil
-import tempfile
+import time
 import uuid
+from collections import defaultdict
+from datetime import timedelta
 
+from django.apps import apps
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.db import models
-from django.db.models import F, Max, Q
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Avg, Count, F, Max, Min, OuterRef, Prefetch, Q, Subquery
 from django.urls import reverse
+from django.utils import timezone
 
+from assignments.canvas_upload import CanvasUploader
 from assignments.utils import versionfile_upload_to
 from courses.models import Course
-from courses.utils import API_URL, get_canvas_course, get_canvas_object
+from courses.utils import (API_URL, CANVAS_API_KEY, get_canvas_course,
+                           get_canvas_object)
 from courses.views import course_detail_view
 from submissions.utils import CommaSeparatedFloatField
 
@@ -108,13 +115,56 @@ class Assignment(models.Model):
 
     def get_all_submissions(self):
         return self.submissions_papersubmission_related.all()
-    
+
+    @classmethod
+    def annotate_grading_stats(cls, queryset):
+        """Annotates the assignments with the numbers of submissions and
+        of graded submissions, the average grade and the maximum page number,
+        so that the statistics of all the assignments of a course are
+        computed in the same query as the assignments.
+        """
+        PaperSubmissionImage = apps.get_model("submissions", "PaperSubmissionImage")
+        graded = Q(submissions_papersubmissions__graded_by__isnull=False)
+        max_page_number = (
+            PaperSubmissionImage.objects
+            .filter(submission__assignment=OuterRef("pk"))
+            .order_by()
+            .values("submission__assignment")
+            .annotate(max_page=Max("page"))
+            .values("max_page"))
+        return queryset.annotate(
+            n_submissions=Count("submissions_papersubmissions"),
+            n_graded_submissions=Count("submissions_papersubmissions", filter=graded),
+            average_grade=Avg("submissions_papersubmissions__grade", filter=graded),
+            max_page_number=Subquery(max_page_number),
+        )
+
+    def get_grading_stats(self):
+        """Returns a dict with the numbers of submissions and of graded
+        submissions and the average grade of the graded submissions, read
+        from the annotations of `annotate_grading_stats` when present.
+        """
+        if hasattr(self, "n_graded_submissions"):
+            return {
+                "n_submissions": self.n_submissions,
+                "n_graded_submissions": self.n_graded_submissions,
+                "average_grade": self.average_grade,
+            }
+        graded = Q(graded_by__isnull=False)
+        return self.get_all_submissions().aggregate(
+            n_submissions=Count("pk"),
+            n_graded_submissions=Count("pk", filter=graded),
+            average_grade=Avg("grade", filter=graded),
+        )
+
+    def count_submissions(self):
+        return self.get_grading_stats()["n_submissions"]
+
     def get_max_page_number(self):
-        subs = self.get_all_submissions()
-        page_nums = [s.get_num_pages() for s in subs]
-        if len(page_nums) == 0:
-            return 0
-        return max(page_nums)
+        if hasattr(self, "max_page_number"):
+            return self.max_page_number or 0
+        PaperSubmissionImage = apps.get_model("submissions", "PaperSubmissionImage")
+        return PaperSubmissionImage.get_max_page_number(self) or 0
 
     def count_submissions_no_students(self):
         return self.get_all_submissions().filter(student__isnull=True).count()
@@ -130,27 +180,25 @@ class Assignment(models.Model):
 
     def get_grading_progress(self):
         """Returns the grading progress of the assignment as a percentage."""
-        submissions = self.get_all_submissions()
-        graded_submissions_count = submissions.filter(
-            graded_by__isnull=False).count()
-        if submissions.count() == 0:
+        stats = self.get_grading_stats()
+        if stats["n_submissions"] == 0:
             return 0
-        return round(100 * graded_submissions_count / submissions.count(), 2)
+        return round(100 * stats["n_graded_submissions"] / stats["n_submissions"], 2)
 
     def get_average_grade(self, section=None):
         """Returns the average grade of the assignment based only 
         on the grades of the submissions that have been graded.
         """
-        submissions = self.get_all_submissions()
-        if section is not None:
-            section_students = section.students.all()
-            submissions = submissions.filter(student__in=section_students)
-
-        graded_submissions = submissions.filter(graded_by__isnull=False)
-        if graded_submissions.count() == 0:
+        if section is None:
+            average_grade = self.get_grading_stats()["average_grade"]
+        else:
+            average_grade = self.get_all_submissions().filter(
+                graded_by__isnull=False,
+                student__sections=section,
+            ).aggregate(average_grade=Avg("grade"))["average_grade"]
+        if average_grade is None:
             return 0
-        grades = [s.grade for s in graded_submissions]
-        return round(sum(grades) / len(grades), 2)
+        return round(average_grade, 2)
 
     def get_all_average_grades(self):
         """Returns the average grade of the assignment based only 
@@ -158,26 +206,68 @@ class Assignment(models.Model):
 
         Returns a list of average grades, one for each section.
         """
+        average_grades = dict(
+            self.get_all_submissions()
+            .filter(graded_by__isnull=False, student__sections__course=self.course)
+            .values_list("student__sections")
+            .annotate(average_grade=Avg("grade"))
+            .order_by())
         return {
-            s: self.get_average_grade(section=s) 
+            s: round(average_grades.get(s.pk) or 0, 2)
         for s in self.course.sections.all()}
 
     def get_all_grades(self):
         """Returns the grades of all submissions of the assignment."""
         return [s.grade for s in self.get_all_submissions().filter(graded_by__isnull=False)]
     
+    def has_question_grades(self):
+        """Returns True if any submission of the assignment has question grades."""
+        QuestionGrade = apps.get_model("submissions", "QuestionGrade")
+        return QuestionGrade.objects.filter(submission__assignment=self).exists()
+
     def get_all_question_grades(self):
-        """Returns the question grades of all submissions of the assignment."""
-        grades = []
-        for s in self.get_all_submissions():
-            if s.get_question_grades():
-                grades.append(s.get_question_grades())
+        """Returns the question grades of all submissions of the assignment
+        as an (N_submissions, number_of_questions) array, with NaN for the
+        questions not graded. Submissions without question grades are left out.
+        """
+        QuestionGrade = apps.get_model("submissions", "QuestionGrade")
+        _, grades = QuestionGrade.get_array(
+            self.get_all_submissions(), n_questions=self.number_of_questions)
         return grades
 
+    def get_question_stats(self, by_version=False):
+        """Returns the number of graded submissions and the average, minimum
+        and maximum grade of each question, computed in a single query.
+
+        If by_version is True, the statistics are computed for each version,
+        and the rows have the name of the version.
+        """
+        QuestionGrade = apps.get_model("submissions", "QuestionGrade")
+        group_by = ["question"]
+        if by_version:
+            group_by = ["submission__version__name", "question"]
+        return list(
+            QuestionGrade.objects
+            .filter(submission__assignment=self, score__isnull=False)
+            .values(*group_by)
+            .annotate(
+                count=Count("pk"),
+                average=Avg("score"),
+                min=Min("score"),
+                max=Max("score"))
+            .order_by(*group_by))
+
     def sync_labeled_submissions_from_canvas(self):
         """Adds the canvas_id of the corresponding canvas 
         submission to the submission object, based on the 
         student's canvas_id and the assignment's canvas_id.
+
+        The submissions are loaded once and matched to the canvas
+        submissions in memory, then saved with a single bulk_update.
+        Returns the number of updated submissions and what could not be
+        matched: the pks of the submissions that are not on canvas, and
+        the names of the canvas students without a submission or with
+        several submissions in the database.
         """
         canvas_course = get_canvas_course(canvas_id=self.course.canvas_id)
         canvas_assignment = canvas_course.get_assignment(
@@ -185,8 +275,16 @@ class Assignment(models.Model):
         canvas_submissions = canvas_assignment.get_submissions(
                 include=["submission_comments", "user"]
                 )
-        all_submissions = self.get_all_submissions()
+        all_submissions = list(self.get_all_submissions().select_related("student"))
+        submissions_by_student_canvas_id = defaultdict(list)
+        for submission in all_submissions:
+            if submission.student is not None and submission.student.canvas_id:
+                submissions_by_student_canvas_id[submission.student.canvas_id].append(submission)
 
+        now = timezone.now()
+        submissions_to_update = []
+        not_in_database = []
+        multiple_in_database = []
         for canvas_submission in canvas_submissions:
             try:
                 if canvas_submission.user["sis_user_id"] is None:
@@ -194,22 +292,36 @@ class Assignment(models.Model):
             except KeyError:
                 print(f"Could not find sis_user_id for {canvas_submission.user['name']}. This usually means that the course is not of the ongoing semester.")
                 continue
-            try:
-                submission = self.submissions_papersubmission_related.get(
-                    student__canvas_id=canvas_submission.user["id"])
-                all_submissions = all_submissions.exclude(
-                    student__canvas_id=canvas_submission.user["id"])
-                print(f"Found submission in database for student with canvas_id: {canvas_submission.user['name']}")
-            except self.submissions_papersubmission_related.model.DoesNotExist:
+            matching_submissions = submissions_by_student_canvas_id.get(
+                str(canvas_submission.user["id"]), [])
+            if len(matching_submissions) == 0:
                 print(f"No submission found in database for student with canvas_id: {canvas_submission.user['name']}")
+                not_in_database.append(canvas_submission.user["name"])
                 continue
-            except self.submissions_papersubmission_related.model.MultipleObjectsReturned:
+            if len(matching_submissions) > 1:
                 print(f"*********Multiple submissions found in database for student with canvas_id: {canvas_submission.user['name']}********")
+                multiple_in_database.append(canvas_submission.user["name"])
                 continue
+            print(f"Found submission in database for student with canvas_id: {canvas_submission.user['name']}")
+            submission = matching_submissions[0]
             submission.canvas_id = canvas_submission.id
             submission.canvas_url = canvas_submission.preview_url
-            submission.save()
-        print(f"{all_submissions.count()} submissions in database that were not found on canvas. This indicates that there are submissions of students not actively enrolled in the course on Canvas.")
+            submission.updated = now
+            submissions_to_update.append(submission)
+
+        self.submissions_papersubmission_related.model.objects.bulk_update(
+            submissions_to_update, ["canvas_id", "canvas_url", "updated"], batch_size=500)
+
+        matched = {submission.pk for submission in submissions_to_update}
+        not_on_canvas = [
+            submission.pk for submission in all_submissions if submission.pk not in matched]
+        print(f"{len(not_on_canvas)} submissions in database that were not found on canvas. This indicates that there are submissions of students not actively enrolled in the course on Canvas.")
+        return {
+            "updated": len(submissions_to_update),
+            "not_on_canvas": not_on_canvas,
+            "not_in_database": not_in_database,
+            "multiple_in_database": multiple_in_database,
+        }
 
 
     def upload_graded_submissions_to_canvas(self, 
@@ -219,9 +331,28 @@ class Assignment(models.Model):
             submission_pdf_sync_option,
             request_user,
             specific_submissions=None,
+            resume=True,
+            grade_sync_mode="submission",
     ):
         """Uploads the grades and comments of the submissions to canvas.
 
+        The submissions are uploaded concurrently, see
+        `assignments.canvas_upload`. What Canvas confirmed is recorded in
+        CanvasUploadCheckpoint, and if resume is True, the grades and
+        comments that did not change since they were uploaded are skipped,
+        so running the upload again after a failure uploads only the rest.
+        Returns the numbers of uploaded and skipped items and the failures.
+
+        With grade_sync_mode "bulk", the grades and text comments of all the
+        submissions are sent with the bulk update_grades endpoint of Canvas,
+        a few requests for the whole assignment instead of one per
+        submission, and the files are uploaded afterwards. Canvas does not
+        return the ids of the comments it creates in bulk, so their
+        canvas_id stays empty; the checkpoints still record them, and
+        comment_sync_option "comment_not_on_canvas" skips the comments
+        with a checkpoint as well as those with a canvas_id, even when
+        resume is False.
+
         Options to in the SyncToForm:
         A select form field to choose the set of submissions to sync:
         - upload all locally graded submissions or, 
@@ -237,7 +368,7 @@ class Assignment(models.Model):
         - upload only comments that are not on canvas. This requires
           a check for each comment if it is already on canvas which
           means that we need to get the canvas_id of the comment when
-          we upload it to canvas. This is not implemented yet.
+          we upload it to canvas.
 
         for these two form fields, we use as parameters here:
         - submission_sync_option
@@ -279,37 +410,74 @@ class Assignment(models.Model):
         )
         """
         # raise ValueError("This error is raised as a final safety measure to prevent accidental uploads of grades to canvas. Comment out this line from assignments.models.upload_graded_submissions_to_canvas to enable the upload.")
+        SubmissionComment = apps.get_model("submissions", "SubmissionComment")
         canvas_course = get_canvas_course(canvas_id=self.course.canvas_id)
         canvas_assignment = canvas_course.get_assignment(
             self.canvas_id)
         canvas_submissions = canvas_assignment.get_submissions(
                 include=["submission_comments", "user"]
                 )
+
+        # load the submissions with everything that is uploaded at once,
+        # instead of querying them for each canvas submission
+        submissions_by_canvas_id = defaultdict(list)
+        submissions = self.get_all_submissions().exclude(canvas_id__isnull=True).exclude(
+            canvas_id="").select_related("student", "version").prefetch_related(
+                Prefetch(
+                    "submissions_submissioncomment_related",
+                    queryset=SubmissionComment.objects.select_related("author")),
+                Prefetch(
+                    "version__versiontext_set",
+                    queryset=VersionText.objects.filter(author=request_user)),
+                Prefetch(
+                    "version__versionfile_set",
+                    queryset=VersionFile.objects.filter(author=request_user)),
+            )
+        for submission in submissions:
+            submissions_by_canvas_id[submission.canvas_id].append(submission)
+        if specific_submissions is not None:
+            specific_submission_pks = {s.pk for s in specific_submissions}
+
+        # what was already uploaded, from the previous runs
+        checkpoints = {
+            (checkpoint.submission_id, checkpoint.key): checkpoint.content_hash
+            for checkpoint in CanvasUploadCheckpoint.objects.filter(submission__assignment=self)
+        }
+
+        uploads = []
+        n_skipped = 0
         for canvas_submission in canvas_submissions:
             if canvas_submission.user["sis_user_id"] is None:
                 continue
-            try:
-                submission = self.submissions_papersubmission_related.get(
-                    canvas_id=canvas_submission.id)
-                print(f"Found submission in database for {canvas_submission.user['name']}")
-            except self.submissions_papersubmission_related.model.DoesNotExist:
+            matching_submissions = submissions_by_canvas_id.get(str(canvas_submission.id), [])
+            if len(matching_submissions) == 0:
                 print(f"No submission found in database for {canvas_submission.user['name']}")
                 continue
-            except self.submissions_papersubmission_related.model.MultipleObjectsReturned:
+            if len(matching_submissions) > 1:
                 print(f"*******Multiple submissions found in database for {canvas_submission.user['name']}******")
                 continue
+            submission = matching_submissions[0]
+            print(f"Found submission in database for {canvas_submission.user['name']}")
             if (submission.grade is None) and (submission_sync_option != "all_identified"):
                 print(f"Will not upload submission without grade for {canvas_submission.user['name']}")
                 continue
             if submission_sync_option == "grade_not_on_canvas" and canvas_submission.score is not None:
                 print(f"Will not upload grade for {canvas_submission.user['name']} because it is already on canvas.")
                 continue
-            if submission_sync_option == "specific" and submission not in specific_submissions:
+            if submission_sync_option == "specific" and submission.pk not in specific_submission_pks:
                 print(f"Will not upload grade for {canvas_submission.user['name']} because it is not in the specific selection.")
                 continue
-            
-            for comment in submission.submissions_submissioncomment_related.all():
-                print(f'Comment: {comment.text}')
+
+            operations = []
+            def add_operation(key, content, **operation):
+                # an operation whose content was uploaded by a previous run is skipped
+                content_hash = hashlib.sha256(content.encode()).hexdigest()
+                if resume and checkpoints.get((submission.pk, key)) == content_hash:
+                    return False
+                operations.append({"key": key, "content_hash": content_hash, **operation})
+                return True
+
+            comments = submission.submissions_submissioncomment_related.all()
 
             # upload the grade and a comment with the question grades to canvas
             score = submission.grade
@@ -321,48 +489,42 @@ class Assignment(models.Model):
                 print(f'Question grades comment: {new_question_grades_comment}')
 
                 # get or create the grade comment for this submission
-                grade_comment = submission.submissions_submissioncomment_related.filter(
-                    is_grade_summary=True,
-                    author=request_user,
-                    ).first()
+                grade_comment = next(
+                    (c for c in comments if c.is_grade_summary and c.author_id == request_user.pk),
+                    None)
                 if grade_comment is None:
                     grade_comment = submission.submissions_submissioncomment_related.create(
                         is_grade_summary=True,
                         author=request_user,
                         text=new_question_grades_comment,
                         )
-                else:
+                elif grade_comment.text != new_question_grades_comment:
                     grade_comment.text = new_question_grades_comment
                     grade_comment.save()
-
-                uploaded_canvas_submission = canvas_submission.edit(submission={
-                    'posted_grade': score},
-                    comment= 
-                        {"text_comment":new_question_grades_comment,
-                        },
-                    )
-
-                # find the canvas_comment_id from the newly edited submission
-                canvas_comment_id = uploaded_canvas_submission.submission_comments[-1]['id']
-                grade_comment.canvas_id = canvas_comment_id
-                grade_comment.save()
-
-                print(f"Uploaded grade and grade comment for {canvas_submission.user['name']}")
+                n_skipped += not add_operation(
+                    "grade", f"{score}\n{new_question_grades_comment}",
+                    type="grade",
+                    posted_grade=score,
+                    text_comment=new_question_grades_comment,
+                    comment=grade_comment)
+            elif score is None:
+                print(f"Will not upload grade for {canvas_submission.user['name']} because it is None.")
             else:
-                if score is None:
-                    print(f"Will not upload grade for {canvas_submission.user['name']} because it is None.")
-                else:
-                    uploaded_canvas_submission = canvas_submission.edit(submission={
-                        'posted_grade': score},
-                        )
-                    print(f"Uploaded grade for {canvas_submission.user['name']}. Grade summary comment was not uploaded.")
+                n_skipped += not add_operation(
+                    "grade", f"{score}", type="grade", posted_grade=score)
 
-            for comment in submission.submissions_submissioncomment_related.all():
+            for comment in comments:
                 if comment.is_grade_summary:
                     continue
                 if comment_sync_option == "none":
                     print(f"Will not upload comment for {canvas_submission.user['name']} because comment_sync_option is 'none'.")
                     continue
+                # the comments uploaded in bulk have no canvas_id, only a checkpoint
+                if comment_sync_option == "comment_not_on_canvas" and (
+                        comment.canvas_id
+                        or (submission.pk, f"comment:{comment.pk}") in checkpoints
+                        or (submission.pk, f"comment_file:{comment.pk}") in checkpoints):
+                    continue
                 # if the comment contains a file, we upload the file to canvas
                 # if the comment does not contain a file, we upload the comment text to canvas
 
@@ -375,81 +537,123 @@ class Assignment(models.Model):
                     continue
 
                 if not comment.comment_file:
-                    print(f'Comment: {comment.text}')
-                    canvas_submission.edit(comment={
-                            "text_comment": comment.text,
-                        },
-                    )
+                    n_skipped += not add_operation(
+                        f"comment:{comment.pk}", comment.text or "",
+                        type="comment",
+                        text_comment=comment.text,
+                        comment=comment)
                 else:
-                    print(f'Comment file: {comment.comment_file}')
-                    new_file_name = comment.get_filename()
-                    tmp_folder_path = os.path.join(settings.BASE_DIR, "tmp")
-                    if not os.path.exists(tmp_folder_path):
-                        os.makedirs(tmp_folder_path)
-                    with tempfile.TemporaryDirectory(dir=tmp_folder_path) as tmp_dir:
-                        tmp_file_path = os.path.join(tmp_dir, new_file_name)
-                        shutil.copyfile(comment.comment_file.path, tmp_file_path)
-
-                        uploaded = canvas_submission.upload_comment(
-                            file=tmp_file_path,
-                        )
-                        if uploaded:
-                            print(f"Uploaded file comment to canvas for {canvas_submission.user['name']}")
+                    n_skipped += not add_operation(
+                        f"comment_file:{comment.pk}", comment.comment_file.name,
+                        type="file",
+                        path=comment.comment_file.path,
+                        name=comment.get_filename(),
+                        comment=comment)
 
-            print(f'Submission comment file url: {submission.pdf}')
             if submission.pdf and submission_pdf_sync_option:
-                new_file_name = f"submission_{submission.student.first_name}_{submission.student.last_name}.pdf"
-                tmp_folder_path = os.path.join(settings.BASE_DIR, "tmp")
-                if not os.path.exists(tmp_folder_path):
-                    os.makedirs(tmp_folder_path)
-                with tempfile.TemporaryDirectory(dir=tmp_folder_path) as tmp_dir:
-                    tmp_file_path = os.path.join(tmp_dir, new_file_name)
-                    shutil.copyfile(submission.pdf.path, tmp_file_path)
-
-                    uploaded = canvas_submission.upload_comment(
-                        file=tmp_file_path,
-                    )
-                    if uploaded:
-                        print(f"Uploaded file comment to canvas for {canvas_submission.user['name']}")
-
-            # get the version comments for this submission
-            # if something goes wrong, we continue to the next submission
-                
+                n_skipped += not add_operation(
+                    "pdf", submission.pdf.name,
+                    type="file",
+                    path=submission.pdf.path,
+                    name=f"submission_{submission.student.first_name}_{submission.student.last_name}.pdf")
+
+            # the version comments of the current user
             submission_version = submission.version
             if not submission_version:
                 print(f"Skipping version comments for {canvas_submission.user['name']} because submission has no version.")
+            else:
+                for comment in submission_version.versiontext_set.all():
+                    n_skipped += not add_operation(
+                        f"version_text:{comment.pk}", comment.text,
+                        type="comment",
+                        text_comment=comment.text)
+                for comment in submission_version.versionfile_set.all():
+                    n_skipped += not add_operation(
+                        f"version_file:{comment.pk}", comment.version_file.name,
+                        type="file",
+                        path=comment.version_file.path,
+                        name=comment.get_filename())
+
+            if operations:
+                uploads.append({
+                    "course_id": canvas_course.id,
+                    "assignment_id": canvas_assignment.id,
+                    "user_id": canvas_submission.user_id,
+                    "name": canvas_submission.user["name"],
+                    "submission": submission,
+                    "operations": operations,
+                })
+
+        # the submissions are uploaded concurrently, and each operation is
+        # recorded as soon as Canvas confirms it, so that running the upload
+        # again after a failure only uploads what is missing
+        uploader = CanvasUploader(
+            API_URL,
+            CANVAS_API_KEY,
+            max_concurrency=settings.CANVAS_UPLOAD_MAX_CONCURRENCY,
+            max_retries=settings.CANVAS_UPLOAD_MAX_RETRIES,
+            bulk_chunk_size=settings.CANVAS_BULK_GRADE_CHUNK_SIZE,
+        )
+        n_uploaded = 0
+        failed = []
+        for upload, operation, response, error in uploader.iter_upload(
+                uploads, bulk=grade_sync_mode == "bulk"):
+            if error is not None:
+                print(f"Could not upload {operation['key']} for {upload['name']}: {error}")
+                failed.append({
+                    "submission_pk": str(upload["submission"].pk),
+                    "operation": operation["key"],
+                    "error": str(error),
+                })
                 continue
-    
-                
-            version_text_comments = submission_version.versiontext_set.filter(
-                author=request_user,
-            )
-            version_file_comments = submission_version.versionfile_set.filter(
-                author=request_user,
-            )
-            for comment in version_text_comments:
-                print(f'Comment: {comment.text}')
-                canvas_submission.edit(comment={
-                        "text_comment": comment.text,
-                    },
-                )
-            for comment in version_file_comments:
-                print(f'Comment file: {comment.version_file}')
-                new_file_name = comment.get_filename()
-                tmp_folder_path = os.path.join(settings.BASE_DIR, "tmp")
-                if not os.path.exists(tmp_folder_path):
-                    os.makedirs(tmp_folder_path)
-                with tempfile.TemporaryDirectory(dir=tmp_folder_path) as tmp_dir:
-                    tmp_file_path = os.path.join(tmp_dir, new_file_name)
-                    shutil.copyfile(comment.version_file.path, tmp_file_path)
-
-                    uploaded = canvas_submission.upload_comment(
-                        file=tmp_file_path,
-                    )
-                    if uploaded:
-                        print(f"Uploaded file comment to canvas for {canvas_submission.user['name']}")
-            
-            
+            comment = operation.get("comment")
+            canvas_comments = (response or {}).get("submission_comments") or []
+            if comment is not None and canvas_comments:
+                # the new comment is the last one of the edited submission
+                comment.canvas_id = canvas_comments[-1]["id"]
+                comment.save()
+            CanvasUploadCheckpoint.objects.update_or_create(
+                submission=upload["submission"],
+                key=operation["key"],
+                defaults={"content_hash": operation["content_hash"]})
+            n_uploaded += 1
+            print(f"Uploaded {operation['key']} for {upload['name']}")
+        print(f"Uploaded {n_uploaded} items, skipped {n_skipped} items uploaded before, {len(failed)} failed.")
+        return {
+            "uploaded": n_uploaded,
+            "skipped": n_skipped,
+            "failed": failed,
+        }
+
+
+class CanvasUploadCheckpoint(models.Model):
+    """
+    Something uploaded to the Canvas submission of a paper submission,
+    e.g. the grade or a comment, and the hash of what was uploaded, so
+    that uploading the grades again skips what Canvas already has.
+    """
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    submission = models.ForeignKey(
+        "submissions.PaperSubmission",
+        on_delete=models.CASCADE,
+        related_name="canvas_upload_checkpoints")
+    # "grade", "pdf", "comment:<pk>", "comment_file:<pk>",
+    # "version_text:<pk>" or "version_file:<pk>"
+    key = models.CharField(max_length=100)
+    content_hash = models.CharField(max_length=64)
+    uploaded_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["submission", "key"],
+                name="unique_canvas_upload_checkpoint",
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.key} of {self.submission_id}"
+
 
 class Version(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
@@ -496,6 +700,37 @@ class VersionText(models.Model):
     created_at = models.DateTimeField(auto_now_add=True, null=True, blank=True)
     updated_at = models.DateTimeField(auto_now=True, null=True, blank=True)
 
+class VersioningState(models.Model):
+    """
+    What the last full versioning of an assignment learned, used to
+    assign new submissions to the existing versions without clustering
+    the whole assignment again.
+    """
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    assignment = models.OneToOneField(
+        Assignment,
+        on_delete=models.CASCADE,
+        related_name="versioning_state")
+    METHODS = [
+        ("text", "Text"),
+        ("fingerprint", "Fingerprint"),
+    ]
+    method = models.CharField(max_length=20, choices=METHODS, default="text")
+    selected_pages = models.JSONField(default=list)
+    # parameters of the fitted text vectorizer, e.g. vocabulary and idf
+    vectorizer = models.JSONField(default=dict)
+    # version pk -> normalized centroid of the submissions of the version
+    centroids = models.JSONField(default=dict)
+    # submissions clustered in the last full versioning and 
+    # submissions that could not be assigned to a version since then
+    n_submissions = models.PositiveIntegerField(default=0)
+    n_outliers = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Versioning state of {self.assignment.name}"
+
 class SavedComment(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     assignment = models.ForeignKey(Assignment, on_delete=models.CASCADE)
@@ -635,4 +870,168 @@ class AssignmentGroup(models.Model):
         return f"{self.name}"
 
     class Meta:
-        ordering = ['course', 'position']
\ No newline at end of file
+        ordering = ['course', 'position']
+
+
+class AssignmentJob(models.Model):
+    """A long-running pipeline (split the uploaded PDFs, identify,
+    version or extract info) on the submissions of an assignment.
+
+    Jobs are queued in the database by the API views and executed
+    by the `run_assignment_jobs` management command. A running job
+    updates heartbeat_at each time it reports its progress, so that
+    the jobs of the workers that died can be told apart.
+    """
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    STATUSES = [
+        (QUEUED, "Queued"),
+        (RUNNING, "Running"),
+        (DONE, "Done"),
+        (FAILED, "Failed"),
+    ]
+    JOB_TYPES = [
+        ("split_pdfs", "Split PDFs into submissions"),
+        ("identify", "Identify submissions"),
+        ("version", "Version submissions"),
+        ("extract_info", "Extract info from submissions"),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    assignment = models.ForeignKey(
+        Assignment,
+        on_delete=models.CASCADE,
+        related_name="jobs")
+    job_type = models.CharField(max_length=20, choices=JOB_TYPES)
+    params = models.JSONField(default=dict, blank=True)
+    status = models.CharField(
+        max_length=10,
+        choices=STATUSES,
+        default=QUEUED)
+    progress = models.FloatField(default=0)
+    message = models.CharField(max_length=255, blank=True)
+    result = models.JSONField(
+        encoder=DjangoJSONEncoder,
+        null=True,
+        blank=True)
+    error = models.TextField(null=True, blank=True)
+    created_by = models.ForeignKey(
+        User,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['created_at']
+
+    def __str__(self):
+        return f"{self.get_job_type_display()} - {self.assignment.name} ({self.status})"
+
+    def is_finished(self):
+        return self.status in (self.DONE, self.FAILED)
+
+    @classmethod
+    def enqueue(cls, assignment, job_type, params=None, created_by=None):
+        return cls.objects.create(
+            assignment=assignment,
+            job_type=job_type,
+            params=params or {},
+            created_by=created_by)
+
+    @classmethod
+    def claim_next(cls):
+        """Mark the oldest queued job as running and return it.
+
+        The status is switched with a conditional update, so that
+        when several workers poll the queue only one of them gets
+        each job. Returns None if the queue is empty.
+        """
+        candidate_pks = cls.objects.filter(
+            status=cls.QUEUED).values_list('pk', flat=True)[:10]
+        for pk in candidate_pks:
+            now = timezone.now()
+            claimed = cls.objects.filter(pk=pk, status=cls.QUEUED).update(
+                status=cls.RUNNING,
+                started_at=now,
+                heartbeat_at=now)
+            if claimed:
+                return cls.objects.get(pk=pk)
+        return None
+
+    @classmethod
+    def fail_stale(cls, timeout=None):
+        """Mark as failed the running jobs without a heartbeat for more
+        than timeout seconds, by default settings.ASSIGNMENT_JOB_STALE_TIMEOUT.
+
+        Their worker died without finishing them, and they would stay
+        running forever otherwise. They are not queued again, since the
+        job itself may have killed the worker. Returns the number of
+        jobs marked as failed.
+        """
+        if timeout is None:
+            timeout = settings.ASSIGNMENT_JOB_STALE_TIMEOUT
+        now = timezone.now()
+        stale_before = now - timedelta(seconds=timeout)
+        return cls.objects.filter(status=cls.RUNNING).filter(
+            Q(heartbeat_at__lt=stale_before)
+            | Q(heartbeat_at__isnull=True, started_at__lt=stale_before)
+        ).update(
+            status=cls.FAILED,
+            error=f"The worker running the job stopped responding for more than {timeout} seconds.",
+            finished_at=now)
+
+    def set_progress(self, progress, message=""):
+        """Store the progress (between 0 and 1) of a running job."""
+        self.progress = progress
+        self.message = message
+        self.heartbeat_at = timezone.now()
+        AssignmentJob.objects.filter(pk=self.pk).update(
+            progress=progress,
+            message=message,
+            heartbeat_at=self.heartbeat_at)
+
+    def get_progress_callback(self, message=""):
+        """Return a progress_callback(n_done, n_total) for the pipelines
+        of the job.
+
+        The progress is only saved when it went up by at least 1%, or
+        every settings.ASSIGNMENT_JOB_HEARTBEAT_INTERVAL seconds, so
+        that the pipelines can report it after every page.
+        """
+        saved = {"progress": self.progress, "time": time.monotonic()}
+
+        def progress_callback(n_done, n_total):
+            progress = n_done / max(n_total, 1)
+            elapsed = time.monotonic() - saved["time"]
+            if (progress - saved["progress"] < 0.01 and progress < 1
+                    and elapsed < settings.ASSIGNMENT_JOB_HEARTBEAT_INTERVAL):
+                return
+            self.set_progress(progress, message)
+            saved["progress"] = progress
+            saved["time"] = time.monotonic()
+        return progress_callback
+
+    def run(self):
+        """Execute the job and store its result or the traceback."""
+        from assignments.jobs import JOB_RUNNERS
+        print(f"Running job {self.pk}: {self}")
+        try:
+            result = JOB_RUNNERS[self.job_type](self)
+        except Exception:
+            import traceback
+            print(traceback.format_exc())
+            self.status = self.FAILED
+            self.error = traceback.format_exc()
+        else:
+            self.status = self.DONE
+            self.result = result
+            self.progress = 1
+        self.finished_at = timezone.now()
+        self.save()
+        print(f"Finished job {self.pk}: {self}")
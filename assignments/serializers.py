@@ -1,5 +1,5 @@
 from rest_framework import serializers
-from .models import Assignment, SavedComment
+from .models import Assignment, AssignmentJob, SavedComment
 
 
 class SavedCommentSerializer(serializers.ModelSerializer):
@@ -14,9 +14,23 @@ class SavedCommentSerializer(serializers.ModelSerializer):
         )
 
 class AssignmentSerializer(serializers.ModelSerializer):
-    submission_count = serializers.IntegerField(source='submissions_papersubmission_related.count', read_only=True)
+    submission_count = serializers.IntegerField(source='count_submissions', read_only=True)
     max_page_number = serializers.IntegerField(source='get_max_page_number', read_only=True)
     saved_comments = SavedCommentSerializer(source='savedcomment_set', many=True, read_only=True)
+
+    @staticmethod
+    def setup_eager_loading(queryset):
+        """
+        Compute the grading statistics in the same query as the assignments and
+        prefetch the nested objects, so that listing the assignments of a course
+        takes the same number of queries however many assignments and
+        submissions there are.
+        """
+        queryset = queryset.select_related(
+            'course', 'assignment_group_object'
+        ).prefetch_related('course__instructors', 'savedcomment_set')
+        return Assignment.annotate_grading_stats(queryset)
+
     class Meta:
         model = Assignment
         fields = (
@@ -36,4 +50,21 @@ class AssignmentSerializer(serializers.ModelSerializer):
             'saved_comments',
             'canvas_id',
         )
-        depth = 1
\ No newline at end of file
+        depth = 1
+
+class AssignmentJobSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = AssignmentJob
+        fields = (
+            'id',
+            'assignment',
+            'job_type',
+            'status',
+            'progress',
+            'message',
+            'result',
+            'error',
+            'created_at',
+            'started_at',
+            'finished_at',
+        )
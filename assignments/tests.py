@@ -1,3 +1,438 @@
-from django.test import TestCase
+import asyncio
+import shutil
+import tempfile
+import threading
+from collections import Counter
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from aiohttp import web
+from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from assignments.canvas_upload import CanvasUploader
+from assignments.models import Assignment, AssignmentJob, CanvasUploadCheckpoint
+from courses.canvas_transport import CanvasTransport
+from courses.models import Course
+from students.models import Student
+from submissions.models import PaperSubmission, SubmissionComment
+
+COURSE_ID = 11
+ASSIGNMENT_ID = 22
+
+
+class FakeCanvas:
+    """A local server with the Canvas endpoints used to upload grades.
+
+    It records the requests it gets, the maximum number of submissions
+    edited at the same time, and answers `failures[user_id]` with the
+    statuses listed there before accepting the requests of that user.
+    The bulk update_grades requests are recorded in `bulk_requests`,
+    and their Progress is running until it was polled twice.
+    """
+
+    def __init__(self, canvas_submissions=()):
+        self.canvas_submissions = list(canvas_submissions)
+        self.requests = []
+        self.failures = {}
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.n_comments = 0
+        self.bulk_requests = []
+        self.progress_polls = {}
+
+    def get_app(self):
+        app = web.Application()
+        prefix = f"/api/v1/courses/{COURSE_ID}"
+        app.router.add_get(prefix, self.get_course)
+        app.router.add_get(f"{prefix}/assignments/{ASSIGNMENT_ID}", self.get_assignment)
+        app.router.add_get(
+            f"{prefix}/assignments/{ASSIGNMENT_ID}/submissions", self.get_submissions)
+        app.router.add_put(
+            f"{prefix}/assignments/{ASSIGNMENT_ID}/submissions/{{user_id}}",
+            self.edit_submission)
+        app.router.add_post(
+            f"{prefix}/assignments/{ASSIGNMENT_ID}/submissions/{{user_id}}/comments/files",
+            self.start_file_upload)
+        app.router.add_post(
+            f"{prefix}/assignments/{ASSIGNMENT_ID}/submissions/update_grades",
+            self.update_grades)
+        app.router.add_get("/api/v1/progress/{progress_id}", self.get_progress)
+        app.router.add_post("/files_upload", self.upload_file)
+        return app
+
+    def start(self):
+        self.loop = asyncio.new_event_loop()
+        started = threading.Event()
+
+        def run():
+            asyncio.set_event_loop(self.loop)
+            self.runner = web.AppRunner(self.get_app())
+            self.loop.run_until_complete(self.runner.setup())
+            site = web.TCPSite(self.runner, "127.0.0.1", 0)
+            self.loop.run_until_complete(site.start())
+            self.port = site._server.sockets[0].getsockname()[1]
+            started.set()
+            self.loop.run_forever()
+            self.loop.run_until_complete(self.runner.cleanup())
+            self.loop.close()
+
+        self.thread = threading.Thread(target=run, daemon=True)
+        self.thread.start()
+        started.wait()
+        self.url = f"http://127.0.0.1:{self.port}/"
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+    async def get_course(self, request):
+        return web.json_response({"id": COURSE_ID, "name": "Course"})
+
+    async def get_assignment(self, request):
+        return web.json_response(
+            {"id": ASSIGNMENT_ID, "course_id": COURSE_ID, "name": "Quiz 1"})
+
+    async def get_submissions(self, request):
+        return web.json_response(self.canvas_submissions)
+
+    def fail(self, user_id):
+        statuses = self.failures.get(user_id)
+        if statuses:
+            status = statuses.pop(0) if len(statuses) > 1 else statuses[0]
+            return web.json_response(
+                {"errors": "failure"}, status=status, headers={"Retry-After": "0"})
+        return None
+
+    async def edit_submission(self, request):
+        user_id = int(request.match_info["user_id"])
+        data = await request.post()
+        self.requests.append((user_id, list(data.items())))
+        failure = self.fail(user_id)
+        if failure is not None:
+            return failure
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(0.01)
+        finally:
+            self.in_flight -= 1
+        self.n_comments += 1
+        return web.json_response({
+            "id": user_id,
+            "user_id": user_id,
+            "submission_comments": [{"id": self.n_comments}],
+        })
+
+    async def update_grades(self, request):
+        data = await request.post()
+        self.bulk_requests.append(list(data.items()))
+        progress_id = len(self.bulk_requests)
+        self.progress_polls[progress_id] = 0
+        return web.json_response({"id": progress_id, "workflow_state": "queued"})
+
+    async def get_progress(self, request):
+        progress_id = int(request.match_info["progress_id"])
+        self.progress_polls[progress_id] += 1
+        workflow_state = "completed" if self.progress_polls[progress_id] >= 2 else "running"
+        return web.json_response({"id": progress_id, "workflow_state": workflow_state})
+
+    async def start_file_upload(self, request):
+        data = await request.post()
+        return web.json_response({
+            "upload_url": f"http://127.0.0.1:{self.port}/files_upload",
+            "upload_params": {"filename": data["name"]},
+        })
+
+    async def upload_file(self, request):
+        data = await request.post()
+        self.requests.append(("file", data["filename"]))
+        return web.json_response({"id": 1000 + len(self.requests)})
+
+
+class CanvasUploaderTest(TestCase):
+
+    def setUp(self):
+        self.canvas = FakeCanvas()
+        self.canvas.start()
+        self.addCleanup(self.canvas.stop)
+        self.transport = CanvasTransport(rate=1000, burst=1000)
+        self.uploader = CanvasUploader(
+            self.canvas.url, "token", max_concurrency=3, max_retries=3, backoff=0.01,
+            transport=self.transport)
+
+    def get_uploads(self, n_uploads):
+        return [{
+            "course_id": COURSE_ID,
+            "assignment_id": ASSIGNMENT_ID,
+            "user_id": user_id,
+            "operations": [
+                {"type": "grade", "posted_grade": user_id, "text_comment": "Question 1"},
+                {"type": "comment", "text_comment": "Good"},
+            ],
+        } for user_id in range(1, n_uploads + 1)]
+
+    def test_concurrency_is_bounded(self):
+        results = list(self.uploader.iter_upload(self.get_uploads(10)))
+        self.assertEqual(len(results), 20)
+        self.assertTrue(all(error is None for *_, error in results))
+        self.assertLessEqual(self.canvas.max_in_flight, 3)
+        self.assertGreater(self.canvas.max_in_flight, 1)
+        self.assertIn(
+            ("submission[posted_grade]", "1"),
+            next(data for user_id, data in self.canvas.requests if user_id == 1))
+
+    def test_rate_limited_requests_are_retried(self):
+        self.canvas.failures[2] = [429, 503, 200]
+        results = list(self.uploader.iter_upload(self.get_uploads(2)))
+        self.assertTrue(all(error is None for *_, error in results))
+        n_requests = Counter(user_id for user_id, _ in self.canvas.requests)
+        self.assertEqual(n_requests[1], 2)
+        self.assertEqual(n_requests[2], 4)
+        summary = self.transport.get_summary()
+        self.assertEqual(summary["n_requests"], 6)
+        self.assertEqual(summary["n_throttled"], 1)
+
+    def test_comments_are_not_retried_after_server_errors(self):
+        self.canvas.failures[1] = [500, 200]
+        self.canvas.failures[2] = [500, 200]
+        uploads = self.get_uploads(2)
+        # the grade of the first student is sent without a comment
+        del uploads[0]["operations"][0]["text_comment"]
+        results = list(self.uploader.iter_upload(uploads))
+        errors = [(upload["user_id"], error.status) for upload, _, _, error in results if error]
+        # the comment may have been posted before the error, it is not posted again
+        self.assertEqual(errors, [(2, 500)])
+        n_requests = Counter(user_id for user_id, _ in self.canvas.requests)
+        self.assertEqual(n_requests[1], 3)
+        self.assertEqual(n_requests[2], 1)
+
+    def test_bulk_update_grades_is_chunked(self):
+        self.uploader.bulk_chunk_size = 2
+        self.uploader.poll_interval = 0
+        results = list(self.uploader.iter_upload(self.get_uploads(5), bulk=True))
+        self.assertEqual(len(results), 10)
+        self.assertTrue(all(error is None for *_, error in results))
+        # no submission is edited one at a time
+        self.assertEqual(self.canvas.requests, [])
+        # the grades in 3 chunks, then the comments in 3 chunks
+        self.assertEqual(len(self.canvas.bulk_requests), 6)
+        grade_requests = sorted(self.canvas.bulk_requests[:3], key=len, reverse=True)
+        self.assertEqual(
+            [dict(data) for data in grade_requests][2],
+            {
+                "grade_data[5][posted_grade]": "5",
+                "grade_data[5][text_comment]": "Question 1",
+            })
+        for data in grade_requests:
+            self.assertLessEqual(
+                len({key.split("]")[0] for key, _ in data}), 2)
+        self.assertEqual(
+            sorted(key for data in self.canvas.bulk_requests[3:] for key, _ in data),
+            [f"grade_data[{user_id}][text_comment]" for user_id in range(1, 6)])
+        # every progress was polled until it completed
+        self.assertEqual(set(self.canvas.progress_polls.values()), {2})
+
+    def test_failure_stops_the_submission(self):
+        self.canvas.failures[2] = [404]
+        results = list(self.uploader.iter_upload(self.get_uploads(2)))
+        errors = [(upload["user_id"], error.status) for upload, _, _, error in results if error]
+        self.assertEqual(errors, [(2, 404)])
+        # the comment of the failed submission is not uploaded
+        self.assertEqual(len(results), 3)
+        n_requests = Counter(user_id for user_id, _ in self.canvas.requests)
+        self.assertEqual(n_requests[2], 1)
+
+
+class UploadGradedSubmissionsToCanvasTest(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.media_root = tempfile.mkdtemp()
+        cls.media_override = override_settings(MEDIA_ROOT=cls.media_root)
+        cls.media_override.enable()
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls.media_override.disable()
+        shutil.rmtree(cls.media_root, ignore_errors=True)
+
+    def setUp(self):
+        self.grader = User.objects.create(username="grader")
+        course = Course.objects.create(name="Course", canvas_id=str(COURSE_ID))
+        self.assignment = Assignment.objects.create(
+            name="Quiz 1", course=course, max_question_scores="5,5",
+            canvas_id=str(ASSIGNMENT_ID))
+        canvas_submissions = []
+        for user_id in (1, 2, 3):
+            student = Student.objects.create(
+                first_name="First", last_name=f"Last {user_id}", uni_id=f"{user_id:08d}")
+            submission = PaperSubmission.objects.create(
+                assignment=self.assignment,
+                student=student,
+                canvas_id=str(100 + user_id),
+                question_grades="4,5",
+                grade=9,
+                pdf=ContentFile(b"%PDF", name=f"{user_id}.pdf"))
+            SubmissionComment.objects.create(
+                paper_submission=submission, author=self.grader, text="Good")
+            canvas_submissions.append({
+                "id": 100 + user_id,
+                "user_id": user_id,
+                "assignment_id": ASSIGNMENT_ID,
+                "score": None,
+                "user": {"name": f"Student {user_id}", "sis_user_id": f"{user_id:08d}"},
+            })
+        self.canvas = FakeCanvas(canvas_submissions)
+        self.canvas.start()
+        self.addCleanup(self.canvas.stop)
+        for module in ("courses.utils", "assignments.models"):
+            patcher = mock.patch(f"{module}.API_URL", self.canvas.url)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch(
+            "courses.canvas_transport._transport", CanvasTransport(rate=1000, burst=1000))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def upload(self, **kwargs):
+        options = {
+            "submission_sync_option": "all",
+            "comment_sync_option": "all",
+            "grade_summary_sync_option": True,
+            "submission_pdf_sync_option": True,
+            **kwargs,
+        }
+        with override_settings(CANVAS_UPLOAD_MAX_RETRIES=1):
+            return self.assignment.upload_graded_submissions_to_canvas(
+                request_user=self.grader, **options)
+
+    def test_rerun_uploads_only_what_failed(self):
+        self.canvas.failures[2] = [400]
+        result = self.upload()
+        # grade, comment and pdf of the two other submissions
+        self.assertEqual(result["uploaded"], 6)
+        self.assertEqual(
+            [failure["operation"] for failure in result["failed"]], ["grade"])
+        self.assertEqual(CanvasUploadCheckpoint.objects.count(), 6)
+        comment = SubmissionComment.objects.get(
+            paper_submission__canvas_id="101", is_grade_summary=False)
+        self.assertTrue(comment.canvas_id)
+
+        del self.canvas.failures[2]
+        self.canvas.requests.clear()
+        result = self.upload()
+        self.assertEqual(result["uploaded"], 3)
+        self.assertEqual(result["skipped"], 6)
+        self.assertEqual(result["failed"], [])
+        self.assertEqual(
+            {user_id for user_id, _ in self.canvas.requests if user_id != "file"}, {2})
+
+        # nothing is left to upload, unless the grade changes
+        self.canvas.requests.clear()
+        self.assertEqual(self.upload()["uploaded"], 0)
+        submission = PaperSubmission.objects.get(canvas_id="103")
+        submission.question_grades = "5,5"
+        submission.grade = 10
+        submission.save()
+        result = self.upload()
+        self.assertEqual(result["uploaded"], 1)
+        self.assertIn(
+            ("submission[posted_grade]", "10.0"), self.canvas.requests[-1][1])
+
+    def test_bulk_upload(self):
+        self.upload(grade_sync_mode="bulk")
+        # the grades, then the comments of the 3 submissions
+        self.assertEqual(len(self.canvas.bulk_requests), 2)
+        # only the pdfs are uploaded one submission at a time
+        self.assertEqual(
+            Counter(user_id for user_id, _ in self.canvas.requests),
+            {"file": 3, 1: 1, 2: 1, 3: 1})
+        self.assertEqual(CanvasUploadCheckpoint.objects.count(), 9)
+        self.canvas.bulk_requests.clear()
+        self.assertEqual(self.upload(grade_sync_mode="bulk")["uploaded"], 0)
+        self.assertEqual(self.canvas.bulk_requests, [])
+        # the comments uploaded in bulk have no canvas_id, but are not posted again
+        self.assertFalse(any(comment.canvas_id for comment in SubmissionComment.objects.all()))
+        result = self.upload(
+            grade_sync_mode="bulk", comment_sync_option="comment_not_on_canvas", resume=False)
+        self.assertEqual(
+            sorted(key for data in self.canvas.bulk_requests for key, _ in data),
+            [f"grade_data[{user_id}][{field}]"
+             for user_id in (1, 2, 3) for field in ("posted_grade", "text_comment")])
+
+    def test_upload_without_resume(self):
+        self.upload()
+        self.canvas.requests.clear()
+        self.assertEqual(self.upload(resume=False)["uploaded"], 9)
+
+
+class AssignmentJobTest(TestCase):
+
+    def setUp(self):
+        course = Course.objects.create(name="Course")
+        self.assignment = Assignment.objects.create(
+            name="Quiz 1", course=course, max_question_scores="5,5")
+
+    def test_stale_running_jobs_fail(self):
+        stale = AssignmentJob.enqueue(self.assignment, "identify")
+        alive = AssignmentJob.enqueue(self.assignment, "version")
+        queued = AssignmentJob.enqueue(self.assignment, "extract_info")
+        self.assertEqual(AssignmentJob.claim_next(), stale)
+        self.assertEqual(AssignmentJob.claim_next(), alive)
+        AssignmentJob.objects.filter(pk=stale.pk).update(
+            heartbeat_at=timezone.now() - timedelta(hours=1))
+
+        self.assertEqual(AssignmentJob.fail_stale(timeout=60), 1)
+        stale.refresh_from_db()
+        alive.refresh_from_db()
+        queued.refresh_from_db()
+        self.assertEqual(stale.status, AssignmentJob.FAILED)
+        self.assertIsNotNone(stale.finished_at)
+        self.assertEqual(alive.status, AssignmentJob.RUNNING)
+        self.assertEqual(queued.status, AssignmentJob.QUEUED)
+
+    def test_progress_is_saved_by_steps(self):
+        job = AssignmentJob.enqueue(self.assignment, "identify")
+        progress_callback = job.get_progress_callback("Identifying submissions")
+        with mock.patch.object(job, "set_progress", wraps=job.set_progress) as set_progress:
+            for n_done in range(1, 1001):
+                progress_callback(n_done, 1000)
+        self.assertAlmostEqual(set_progress.call_count, 100, delta=2)
+        job.refresh_from_db()
+        self.assertEqual(job.progress, 1)
+        self.assertEqual(job.message, "Identifying submissions")
+        self.assertIsNotNone(job.heartbeat_at)
+
+
+class AssignmentDetailViewTest(TestCase):
+
+    def setUp(self):
+        self.course = Course.objects.create(name="Course")
+        self.assignment = Assignment.objects.create(
+            name="Quiz 1", course=self.course, max_question_scores="5,5")
+        self.submission = PaperSubmission.objects.create(assignment=self.assignment)
+        self.client.force_login(User.objects.create(username="grader"))
+
+    def get(self):
+        return self.client.get(reverse(
+            "assignments:detail",
+            kwargs={"course_pk": self.course.pk, "assignment_pk": self.assignment.pk}))
+
+    def test_detail_without_question_grades(self):
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertNotContains(response, "There are already graded questions")
+
+    def test_detail_with_question_grades(self):
+        self.submission.question_grades = "4,5"
+        self.submission.grade = 9
+        self.submission.save()
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, "There are already graded questions")
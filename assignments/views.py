@@ -5,32 +5,36 @@ import numpy as np
 from django.conf import settings
 from django.contrib.auth.decorators import login_required
 from django.core import serializers
+from django.core.serializers.json import DjangoJSONEncoder
 from django.core.files.base import ContentFile
 from django.db.models import Max, Q
 from django.forms.models import model_to_dict
-from django.http import JsonResponse, HttpResponse
+from django.http import JsonResponse, HttpResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404, redirect, render
 from django.utils import timezone
 
 from courses.models import Course
 from courses.utils import get_canvas_course
-from submissions.cluster import (images_to_text,
+from submissions.cluster import (group_texts_by_submission,
                                  perform_dbscan_clustering,
                                  plot_clusters_dbscan, vectorize_texts)
 from submissions.forms import (StudentClassifyForm, SubmissionFilesUploadForm,
                                SubmissionSearchForm, SyncFromForm, SyncToForm)
-from submissions.models import (PaperSubmission, PaperSubmissionImage,
+from submissions.models import (OCRCacheEntry, PaperSubmission,
+                                PaperSubmissionImage, QuestionGrade,
                                 SubmissionComment)
 from submissions.views import _random1000
 
-from .models import Assignment, SavedComment, Version, VersionFile, VersionText
+from .models import (Assignment, AssignmentJob, SavedComment, Version,
+                     VersionFile, VersionText)
 from .utils import delete_versions
 
 from rest_framework import viewsets
 from rest_framework import permissions
 from rest_framework.views import APIView
+from rest_framework.renderers import BaseRenderer, JSONRenderer
 from rest_framework.response import Response
-from assignments.serializers import AssignmentSerializer
+from assignments.serializers import AssignmentJobSerializer, AssignmentSerializer
 from io import BytesIO
 import zipfile
 
@@ -44,6 +48,10 @@ class AssignmentViewSet(viewsets.ModelViewSet):
     queryset = Assignment.objects.all()
     serializer_class = AssignmentSerializer
     permission_classes = [permissions.IsAuthenticatedOrReadOnly,]
+
+    def get_queryset(self):
+        return AssignmentSerializer.setup_eager_loading(Assignment.objects.all())
+
 class AssignmentInCourseViewSet(viewsets.ModelViewSet):
     """
     This ViewSet automatically provides `list`, `create`, `retrieve`,
@@ -55,7 +63,8 @@ class AssignmentInCourseViewSet(viewsets.ModelViewSet):
 
     def get_queryset(self):
         course_id = self.kwargs['course_pk']
-        return Assignment.objects.filter(course_id=course_id)
+        return AssignmentSerializer.setup_eager_loading(
+            Assignment.objects.filter(course_id=course_id))
 
 class ListAssignmentScoresViewSet(APIView):
     permission_classes = [permissions.IsAuthenticatedOrReadOnly,]
@@ -73,26 +82,30 @@ class AssignmentIdentifySubmissions(APIView):
     def patch(self, request, assignment_id):
         assignment = get_object_or_404(Assignment, pk=assignment_id)
         pages_selected = request.data.get("pages_selected")
-        max_page_num = PaperSubmissionImage.get_max_page_number(assignment)
         print(f"pages_selected: {pages_selected}")
-        pages_to_skip = tuple(
-            i for i in range(max_page_num) if i + 1 not in pages_selected
-        )
-        print(f"pages_to_skip: {pages_to_skip}")
-        classified_submission_pks, not_classified_submission_pks = (
-            PaperSubmission.classify(
-                assignment,
-                skip_pages=pages_to_skip,
-            )
+        job = AssignmentJob.enqueue(
+            assignment,
+            "identify",
+            params={"pages_selected": pages_selected},
+            created_by=request.user,
         )
         return Response(
             {
-                "classified_submission_pks": classified_submission_pks,
-                "not_classified_submission_pks": not_classified_submission_pks,
-            }
+                "job_id": job.pk,
+                "status": job.status,
+            },
+            status=202,
         )
     
 class AssignmentVersionSubmissions(APIView):
+    """Queue a "version" job that groups the submissions in versions.
+
+    By default, the versioning is incremental: once the assignment was
+    versioned with the same pages and method, the existing versions are
+    kept and only the submissions without a version are assigned to
+    them. Send `incremental: false` to cluster all the submissions
+    again, e.g. after a bad clustering.
+    """
     permission_classes = [
         permissions.IsAuthenticated,
     ]
@@ -101,15 +114,29 @@ class AssignmentVersionSubmissions(APIView):
         assignment = get_object_or_404(Assignment, pk=assignment_id)
         pages_selected = request.data.get("pages_selected")
         print(f"pages_selected: {pages_selected}")
-
-        submissions_serialized, outliers = PaperSubmission.perform_versioning(
-            assignment, selected_pages=(3,)
+        method = request.data.get("method", "text")
+        if method not in ("text", "fingerprint"):
+            return Response(
+                {"message": f"Unknown versioning method {method}"},
+                status=400,
+            )
+        job = AssignmentJob.enqueue(
+            assignment,
+            "version",
+            params={
+                "pages_selected": pages_selected,
+                "incremental": request.data.get("incremental", True),
+                # "text" (OCR) or "fingerprint" (perceptual hashes)
+                "method": method,
+            },
+            created_by=request.user,
         )
         return Response(
             {
-                "submissions": submissions_serialized,
-                "outliers": outliers,
-            }
+                "job_id": job.pk,
+                "status": job.status,
+            },
+            status=202,
         )
 
 class AssignmentExtractInfoSubmissions(APIView):
@@ -121,15 +148,78 @@ class AssignmentExtractInfoSubmissions(APIView):
         assignment = get_object_or_404(Assignment, pk=assignment_id)
         info_fields = request.data.get("info_fields")
         print(f"info_fields: {info_fields}")
-
-        submissions_serialized = PaperSubmission.extract_info(
-            assignment, info_fields=info_fields
+        job = AssignmentJob.enqueue(
+            assignment,
+            "extract_info",
+            params={"info_fields": info_fields},
+            created_by=request.user,
         )
         return Response(
             {
-                "submissions": submissions_serialized,
-            }
+                "job_id": job.pk,
+                "status": job.status,
+            },
+            status=202,
         )
+
+class AssignmentJobView(APIView):
+    """Poll the status, progress and result of an assignment job."""
+    permission_classes = [
+        permissions.IsAuthenticated,
+    ]
+
+    def get(self, request, job_id):
+        job = get_object_or_404(AssignmentJob, pk=job_id)
+        return Response(AssignmentJobSerializer(job).data)
+
+class EventStreamRenderer(BaseRenderer):
+    media_type = "text/event-stream"
+    format = "txt"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return data
+
+class AssignmentJobEventsView(APIView):
+    """Stream the progress of an assignment job as server-sent events.
+
+    An event is sent whenever the job changes, and the stream is
+    closed once the job is done or has failed.
+
+    Each stream holds a worker of the server, so it is also closed
+    after max_duration seconds. The browser's EventSource then
+    reconnects after the retry_ms milliseconds sent at the start of
+    the stream, and gets the current state of the job again; clients
+    should close it on the "done" and "failed" events.
+    """
+    permission_classes = [
+        permissions.IsAuthenticated,
+    ]
+    renderer_classes = [EventStreamRenderer, JSONRenderer]
+    poll_interval = 1.0
+    max_duration = 30.0
+    retry_ms = 1000
+
+    def get(self, request, job_id):
+        job = get_object_or_404(AssignmentJob, pk=job_id)
+
+        def events():
+            import time
+            yield f"retry: {self.retry_ms}\n\n"
+            last_data = None
+            deadline = time.monotonic() + self.max_duration
+            while True:
+                job.refresh_from_db()
+                data = AssignmentJobSerializer(job).data
+                if data != last_data:
+                    last_data = data
+                    yield f"event: {job.status}\ndata: {json.dumps(data, cls=DjangoJSONEncoder)}\n\n"
+                if job.is_finished() or time.monotonic() >= deadline:
+                    return
+                time.sleep(self.poll_interval)
+
+        response = StreamingHttpResponse(events(), content_type="text/event-stream")
+        response["Cache-Control"] = "no-cache"
+        return response
     
 class ExportSubmissionsPDFsView(APIView):
     permission_classes = [permissions.IsAuthenticated]
@@ -167,15 +257,11 @@ class ExportGradesCSVView(APIView):
         import pandas as pd
         # Retrieve the assignment
         assignment = get_object_or_404(Assignment, pk=assignment_id)
-        submissions = PaperSubmission.objects.filter(assignment=assignment)
-        
+        submissions = PaperSubmission.objects.filter(assignment=assignment).select_related('student', 'version')
+
         # create a pandas dataframe
         data = []
         for submission in submissions:
-            question_grades = submission.get_question_grades()
-            question_grades_dict = dict()
-            for i, qg in enumerate(question_grades):
-                question_grades_dict[f'question_{i+1}_grade'] = qg
             row = {
                 'submission_id': submission.pk,
                 'submission_canvas_id': submission.canvas_id,
@@ -185,10 +271,12 @@ class ExportGradesCSVView(APIView):
                 'student_uni_id': submission.student.uni_id if submission.student else '',
                 'version': submission.version.name if submission.version else '',
                 'grade': submission.grade,
-                **question_grades_dict,
             }
             data.append(row)
         df = pd.DataFrame(data)
+        if not df.empty:
+            # the grades of the questions of all the submissions are loaded at once
+            df = df.join(QuestionGrade.get_dataframe(submissions), on='submission_id')
         # create the response
         from django.http import HttpResponse
         response = HttpResponse(content_type='text/csv')
@@ -303,7 +391,7 @@ def assignment_detail_view(request,  course_pk, assignment_pk):
                 return JsonResponse({'error': 'form is not valid'})
             
             print("form is valid")
-            sync_from_form.save()
+            report = sync_from_form.save()
             message = 'Sync from canvas successful'
             message_type = 'success'
             # return submissions that were synced as json
@@ -312,7 +400,7 @@ def assignment_detail_view(request,  course_pk, assignment_pk):
                            .values('pk', 'canvas_id', 'canvas_url'))
             submissions = list(submissions)
             
-            return JsonResponse({'submissions': submissions})
+            return JsonResponse({'submissions': submissions, 'report': report})
         
         elif "submit-sync-to" in request.POST:
             print("request was POST:sync-to")
@@ -323,9 +411,18 @@ def assignment_detail_view(request,  course_pk, assignment_pk):
             if sync_to_form.is_valid():
                 print("form is valid")
                 try:
-                    sync_to_form.save()
-                    message = 'Upload to canvas completed gracefully. Details in the terminal.'
-                    message_type = 'info'
+                    result = sync_to_form.save()
+                    message = (
+                        f"Upload to canvas: {result['uploaded']} uploaded, "
+                        f"{result['skipped']} skipped, {len(result['failed'])} failed.")
+                    if not result['failed']:
+                        message_type = 'success'
+                    elif result['uploaded']:
+                        message += ' Run the sync again to retry the failed ones, details in the terminal.'
+                        message_type = 'warning'
+                    else:
+                        message += ' Details in the terminal.'
+                        message_type = 'danger'
                 except Exception as e:
                     print(f"An error occured while syncing submissions to canvas: {e}")
                     import traceback
@@ -397,7 +494,7 @@ def version_view(request, course_pk, assignment_pk):
             images.append(image.image.path)
             sub_pks.append(submission.pk)
         
-    texts = images_to_text(images, sub_pks)
+    texts = group_texts_by_submission(OCRCacheEntry.ocr_images(images), sub_pks)
     print(len(texts))
 
     # vectorize the text
@@ -0,0 +1,161 @@
+"""Cache of the GET responses of the Canvas API.
+
+The clients returned by `courses.utils.get_canvas_object` send their
+requests through a `CachedCanvasSession`, so the pages that fetch the
+same course, sections, users or assignment groups from Canvas again and
+again are served from a process-wide cache:
+
+- the responses are kept for the number of seconds given by
+  settings.CANVAS_CACHE_TTLS for their type of resource, e.g. "sections"
+  for /api/v1/courses/1/sections. The resources that are not listed
+  there, like the submissions, are never cached;
+- once a response is expired, it is requested again with the ETag that
+  Canvas sent with it, and a 304 Not Modified response renews it
+  without downloading it again;
+- at most settings.CANVAS_CACHE_MAX_ENTRIES responses are kept, the
+  least recently used are dropped first;
+- the responses are keyed by the access token and the URL with its
+  query string, so users with different tokens never share responses.
+
+Any other request sent through the session, e.g. a PUT to a submission,
+drops the cached responses of its course. The views that save Canvas
+data in the database call `invalidate_canvas_cache` for the same reason.
+
+The requests that are not served from the cache are sent with the shared
+transport of `courses.canvas_transport`.
+
+The cache is kept in the memory of each process, it is not shared
+through Django's cache framework: the responses are requests.Response
+objects, and the runserver of entrypoint.sh is a single process. With
+several server processes, each one has its own cache and the
+invalidations of one process do not reach the others, whose responses
+are then out of date for at most their TTL.
+"""
+import hashlib
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+from django.conf import settings
+
+from courses.canvas_transport import get_canvas_transport
+
+COURSE_PATH_REGEX = re.compile(r"/api/v1/courses/(\d+)")
+
+
+def get_resource_type(url):
+    """Return the type of resource of a Canvas API url, i.e. its last
+    segment that is not an id, e.g. "users" for /api/v1/users/self."""
+    path = requests.utils.urlparse(url).path
+    segments = [
+        segment for segment in path.split("/")
+        if segment and not segment.isdigit() and segment != "self"
+    ]
+    return segments[-1] if segments else ""
+
+
+class CanvasResponseCache:
+    def __init__(self, max_entries=None):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_max_entries(self):
+        if self.max_entries is not None:
+            return self.max_entries
+        return getattr(settings, "CANVAS_CACHE_MAX_ENTRIES", 256)
+
+    def get(self, key):
+        """Return the (response, etag, expires_at) entry of key, or None."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def set(self, key, response, etag, ttl):
+        with self.lock:
+            self.entries[key] = (response, etag, time.monotonic() + ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.get_max_entries():
+                self.entries.popitem(last=False)
+
+    def invalidate(self, course_canvas_id=None):
+        """Drop the cached responses of a course and the list of courses,
+        or all the responses if course_canvas_id is None."""
+        with self.lock:
+            for key in list(self.entries):
+                _, url = key
+                if course_canvas_id is not None:
+                    path = requests.utils.urlparse(url).path.rstrip("/")
+                    match = COURSE_PATH_REGEX.search(path)
+                    if match is None:
+                        if not path.endswith("/api/v1/courses"):
+                            continue
+                    elif match.group(1) != str(course_canvas_id):
+                        continue
+                del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+canvas_response_cache = CanvasResponseCache()
+
+
+def get_token_key(token):
+    # the tokens are not kept in the cache keys
+    return hashlib.sha256(str(token).encode()).hexdigest()
+
+
+def invalidate_canvas_cache(course_canvas_id=None):
+    canvas_response_cache.invalidate(course_canvas_id)
+
+
+class CachedCanvasSession(requests.Session):
+    def __init__(self, token, cache=None):
+        super().__init__()
+        self.token_key = get_token_key(token)
+        self.cache = cache if cache is not None else canvas_response_cache
+
+    def send_request(self, method, url, **kwargs):
+        return get_canvas_transport().request(method, url, **kwargs)
+
+    def get_ttl(self, url):
+        ttls = getattr(settings, "CANVAS_CACHE_TTLS", {})
+        return ttls.get(get_resource_type(url), 0)
+
+    def request(self, method, url, params=None, headers=None, **kwargs):
+        if method.upper() != "GET":
+            response = self.send_request(method, url, params=params, headers=headers, **kwargs)
+            match = COURSE_PATH_REGEX.search(requests.utils.urlparse(url).path)
+            self.cache.invalidate(match.group(1) if match else None)
+            return response
+
+        full_url = requests.Request("GET", url, params=params).prepare().url
+        ttl = self.get_ttl(full_url)
+        if not ttl:
+            return self.send_request(method, url, params=params, headers=headers, **kwargs)
+
+        key = (self.token_key, full_url)
+        entry = self.cache.get(key)
+        if entry is not None:
+            cached_response, etag, expires_at = entry
+            if time.monotonic() < expires_at:
+                return cached_response
+            if etag:
+                headers = {**(headers or {}), "If-None-Match": etag}
+
+        response = self.send_request(method, url, params=params, headers=headers, **kwargs)
+        if response.status_code == 304 and entry is not None:
+            self.cache.set(key, cached_response, etag, ttl)
+            return cached_response
+        if response.status_code == 200:
+            self.cache.set(key, response, response.headers.get("ETag"), ttl)
+        return response
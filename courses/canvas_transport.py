@@ -0,0 +1,198 @@
+"""Process-wide HTTP transport of the requests sent to Canvas.
+
+All the Canvas clients of `courses.utils.get_canvas_object` share the
+`CanvasTransport` returned by `get_canvas_transport`: a requests session
+whose pool keeps the connections to Canvas alive between the requests,
+instead of opening a new connection, and doing a new TLS handshake, for
+each Canvas client.
+
+Before each request, the transport takes a token from a `TokenBucket`
+that allows settings.CANVAS_RATE_LIMIT_PER_SECOND requests per second,
+with bursts of settings.CANVAS_RATE_LIMIT_BURST. Canvas tells in the
+X-Rate-Limit-Remaining header of its responses how much of its own
+quota is left; when it goes under settings.CANVAS_RATE_LIMIT_LOW_WATER,
+the bucket refills proportionally slower, so that we slow down before
+Canvas starts refusing the requests with 403 Rate Limit Exceeded.
+
+The asynchronous uploads of `assignments.canvas_upload` use the same
+bucket and metrics with `acquire_async` and `record`. The requests that
+are not calls to the Canvas API, like the downloads of the avatars of
+the students, can use the pool without the bucket and the metrics with
+`rate_limited=False`.
+
+The latencies, the number of requests, of errors and of throttled
+requests, and the time spent waiting for the bucket are collected in
+`CanvasTransport.metrics`, see `CanvasTransportMetrics.get_summary`.
+"""
+import asyncio
+import threading
+import time
+from collections import Counter, deque
+
+import numpy as np
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+RATE_LIMIT_HEADER = "X-Rate-Limit-Remaining"
+
+
+def is_throttled(status, text=""):
+    """Canvas answers 403 Rate Limit Exceeded, proxies may answer 429."""
+    return status == 429 or (status == 403 and "Rate Limit Exceeded" in text)
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity, low_water=0):
+        self.rate = rate
+        self.capacity = capacity
+        self.low_water = low_water
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        # what Canvas said was left of its quota in the last response
+        self.remaining = None
+        self.lock = threading.Lock()
+
+    def get_rate(self):
+        if self.remaining is None or not self.low_water or self.remaining >= self.low_water:
+            return self.rate
+        # at least a tenth of the rate, so that the quota can recover
+        return self.rate * max(self.remaining / self.low_water, 0.1)
+
+    def reserve(self):
+        """Take a token and return the number of seconds to wait before
+        using it."""
+        with self.lock:
+            now = time.monotonic()
+            rate = self.get_rate()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * rate)
+            self.updated_at = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / rate
+
+    def acquire(self):
+        delay = self.reserve()
+        if delay:
+            time.sleep(delay)
+        return delay
+
+    async def acquire_async(self):
+        delay = self.reserve()
+        if delay:
+            await asyncio.sleep(delay)
+        return delay
+
+    def update(self, headers):
+        remaining = headers.get(RATE_LIMIT_HEADER)
+        if remaining is None:
+            return
+        try:
+            remaining = float(remaining)
+        except ValueError:
+            return
+        with self.lock:
+            self.remaining = remaining
+
+
+class CanvasTransportMetrics:
+    def __init__(self, max_latencies=1000):
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=max_latencies)
+        self.n_requests = 0
+        self.n_errors = 0
+        self.n_throttled = 0
+        self.statuses = Counter()
+        self.waited = 0.0
+
+    def record(self, status, latency, waited=0.0, throttled=False):
+        with self.lock:
+            self.n_requests += 1
+            self.latencies.append(latency)
+            self.statuses[status] += 1
+            self.waited += waited
+            if status is None or status >= 400:
+                self.n_errors += 1
+            if throttled:
+                self.n_throttled += 1
+
+    def get_summary(self):
+        with self.lock:
+            latencies = np.array(self.latencies)
+            summary = {
+                "n_requests": self.n_requests,
+                "n_errors": self.n_errors,
+                "n_throttled": self.n_throttled,
+                "statuses": {str(status): n for status, n in self.statuses.items()},
+                "seconds_waited_for_rate_limit": round(self.waited, 3),
+            }
+        if len(latencies):
+            summary["latency_seconds"] = {
+                "mean": round(float(latencies.mean()), 4),
+                "p50": round(float(np.percentile(latencies, 50)), 4),
+                "p95": round(float(np.percentile(latencies, 95)), 4),
+                "max": round(float(latencies.max()), 4),
+            }
+        return summary
+
+    def reset(self):
+        self.__init__(self.latencies.maxlen)
+
+
+class CanvasTransport(requests.Session):
+    def __init__(self, rate, burst, low_water=0, pool_size=10):
+        super().__init__()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+        self.pool_size = pool_size
+        self.bucket = TokenBucket(rate, burst, low_water)
+        self.metrics = CanvasTransportMetrics()
+
+    def record(self, status, latency, waited=0.0, headers=None, text=""):
+        if headers is not None:
+            self.bucket.update(headers)
+        self.metrics.record(status, latency, waited, is_throttled(status, text))
+
+    def request(self, method, url, *args, rate_limited=True, **kwargs):
+        if not rate_limited:
+            return super().request(method, url, *args, **kwargs)
+        waited = self.bucket.acquire()
+        start = time.perf_counter()
+        try:
+            response = super().request(method, url, *args, **kwargs)
+        except requests.RequestException:
+            self.record(None, time.perf_counter() - start, waited)
+            raise
+        text = response.text if response.status_code == 403 else ""
+        self.record(
+            response.status_code, time.perf_counter() - start, waited, response.headers, text)
+        return response
+
+    def get_summary(self):
+        return {
+            **self.metrics.get_summary(),
+            "pool_size": self.pool_size,
+            "rate_limit_remaining": self.bucket.remaining,
+            "rate_per_second": round(self.bucket.get_rate(), 3),
+        }
+
+
+_transport = None
+_transport_lock = threading.Lock()
+
+
+def get_canvas_transport():
+    """Return the transport shared by all the Canvas calls of the process."""
+    global _transport
+    if _transport is None:
+        with _transport_lock:
+            if _transport is None:
+                _transport = CanvasTransport(
+                    rate=settings.CANVAS_RATE_LIMIT_PER_SECOND,
+                    burst=settings.CANVAS_RATE_LIMIT_BURST,
+                    low_water=settings.CANVAS_RATE_LIMIT_LOW_WATER,
+                    pool_size=settings.CANVAS_TRANSPORT_POOL_SIZE,
+                )
+    return _transport
@@ -1,3 +1,4 @@
+from django.apps import apps
 from django.contrib.auth.models import User
 from django.db import models
 from django.urls import reverse
@@ -55,16 +56,14 @@ class Course(models.Model):
         return reverse("courses:detail", kwargs={"pk": self.pk})
 
     def get_students(self, section_pk=None):
-        students = []
+        """Return the students enrolled in the course, or in one
+        of its sections, with a single query."""
+        Student = apps.get_model("students", "Student")
         if section_pk:
-            section = self.sections.filter(pk=section_pk)
-            for student in section.students.all():
-                students.append(student)
+            students = Student.objects.filter(sections__course=self, sections__pk=section_pk)
         else:
-            for section in self.sections.all():
-                for student in section.students.all():
-                    students.append(student)
-        return students
+            students = Student.objects.filter(sections__course=self)
+        return list(students.distinct())
 
     def get_all_assignment_groups(self):
         assignment_groups = self.assignment_groups.all()
@@ -1,3 +1,259 @@
-from django.test import TestCase
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+from rest_framework.test import APIClient
+
+from courses import utils
+from courses.canvas_cache import (CachedCanvasSession, CanvasResponseCache,
+                                  canvas_response_cache, invalidate_canvas_cache)
+from courses.canvas_transport import CanvasTransport, TokenBucket
+from courses.models import Course
+
+
+class StubCanvasHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append((self.path, self.client_address[1]))
+        path = self.path.split("?")[0]
+        status, body = server.responses.get(path, (404, {}))
+        etag = server.etags.get(path)
+        if etag is not None and self.headers.get("If-None-Match") == etag:
+            status, body = 304, None
+        content = json.dumps(body).encode() if body is not None else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.send_header("X-Rate-Limit-Remaining", str(server.rate_limit_remaining))
+        if etag is not None:
+            self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_PUT(self):
+        server = self.server
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        server.requests.append((f"PUT {self.path}", self.client_address[1]))
+        content = b"{}"
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubCanvas(ThreadingHTTPServer):
+    """A local server answering the GET requests with canned responses,
+    and with 304 Not Modified to the requests with the ETag of etags."""
+
+    def __init__(self, responses, etags=None):
+        super().__init__(("127.0.0.1", 0), StubCanvasHandler)
+        self.responses = responses
+        self.etags = etags or {}
+        self.requests = []
+        self.rate_limit_remaining = 700.0
+        self.url = f"http://127.0.0.1:{self.server_address[1]}/"
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+
+class TokenBucketTest(SimpleTestCase):
+
+    def test_burst_then_rate(self):
+        bucket = TokenBucket(rate=10, capacity=2)
+        self.assertEqual(bucket.reserve(), 0)
+        self.assertEqual(bucket.reserve(), 0)
+        self.assertAlmostEqual(bucket.reserve(), 0.1, places=2)
+        self.assertAlmostEqual(bucket.reserve(), 0.2, places=2)
+
+    def test_slows_down_when_canvas_quota_is_low(self):
+        bucket = TokenBucket(rate=10, capacity=1, low_water=200)
+        bucket.update({"X-Rate-Limit-Remaining": "700.0"})
+        self.assertEqual(bucket.get_rate(), 10)
+        bucket.update({"X-Rate-Limit-Remaining": "50.5"})
+        self.assertAlmostEqual(bucket.get_rate(), 10 * 50.5 / 200)
+        bucket.update({"X-Rate-Limit-Remaining": "-3"})
+        self.assertAlmostEqual(bucket.get_rate(), 1)
+
+
+@override_settings(CANVAS_CACHE_TTLS={"courses": 600})
+class CanvasTransportTest(SimpleTestCase):
+
+    def setUp(self):
+        self.transport = CanvasTransport(rate=1000, burst=1000, low_water=200, pool_size=4)
+        patcher = mock.patch("courses.canvas_transport._transport", self.transport)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        canvas_response_cache.clear()
+        self.addCleanup(canvas_response_cache.clear)
+
+    def test_canvas_calls_share_the_connection(self):
+        responses = {
+            "/api/v1/courses/1": (200, {"id": 1, "name": "Course"}),
+            "/api/v1/courses/1/assignments/2": (200, {"id": 2, "course_id": 1, "name": "Quiz"}),
+        }
+        with StubCanvas(responses) as canvas, \
+                mock.patch.object(utils, "API_URL", canvas.url):
+            for _ in range(3):
+                course = utils.get_canvas_object().get_course(1)
+                course.get_assignment(2)
+            canvas.rate_limit_remaining = 100.0
+            utils.get_canvas_object().get_course(1).get_assignment(2)
+        # the course is cached, the assignments are not
+        paths = [path for path, _ in canvas.requests]
+        self.assertEqual(paths.count("/api/v1/courses/1"), 1)
+        self.assertEqual(paths.count("/api/v1/courses/1/assignments/2"), 4)
+        # one connection, kept alive between the Canvas clients
+        self.assertEqual(len({port for _, port in canvas.requests}), 1)
+
+        summary = self.transport.get_summary()
+        self.assertEqual(summary["n_requests"], 5)
+        self.assertEqual(summary["n_errors"], 0)
+        self.assertEqual(summary["statuses"], {"200": 5})
+        self.assertEqual(summary["rate_limit_remaining"], 100.0)
+        self.assertAlmostEqual(summary["rate_per_second"], 500)
+        self.assertIn("p95", summary["latency_seconds"])
+
+    def test_requests_without_rate_limit(self):
+        responses = {"/avatar.png": (200, {})}
+        with StubCanvas(responses) as canvas:
+            for _ in range(3):
+                response = self.transport.get(f"{canvas.url}avatar.png", rate_limited=False)
+                self.assertEqual(response.status_code, 200)
+        self.assertEqual(len({port for _, port in canvas.requests}), 1)
+        self.assertEqual(self.transport.get_summary()["n_requests"], 0)
+        self.assertEqual(self.transport.bucket.tokens, 1000)
+
+    def test_throttled_requests_are_counted(self):
+        responses = {"/api/v1/courses/1": (403, {"errors": "403 Forbidden (Rate Limit Exceeded)"})}
+        with StubCanvas(responses) as canvas:
+            response = self.transport.get(f"{canvas.url}api/v1/courses/1")
+        self.assertEqual(response.status_code, 403)
+        summary = self.transport.get_summary()
+        self.assertEqual(summary["n_throttled"], 1)
+        self.assertEqual(summary["n_errors"], 1)
+
+
+@override_settings(CANVAS_CACHE_TTLS={"courses": 600, "sections": 600})
+class CanvasResponseCacheTest(TestCase):
+    responses = {
+        "/api/v1/courses": (200, [{"id": 1}, {"id": 2}]),
+        "/api/v1/courses/1": (200, {"id": 1, "name": "Course 1"}),
+        "/api/v1/courses/2": (200, {"id": 2, "name": "Course 2"}),
+        "/api/v1/courses/1/sections": (200, [{"id": 10}]),
+        "/api/v1/courses/2/sections": (200, [{"id": 20}]),
+    }
+
+    def setUp(self):
+        patcher = mock.patch(
+            "courses.canvas_transport._transport", CanvasTransport(rate=1000, burst=1000))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.canvas = StubCanvas(self.responses, etags={"/api/v1/courses/1": '"v1"'})
+        self.canvas.__enter__()
+        self.addCleanup(self.canvas.__exit__)
+        self.cache = CanvasResponseCache()
+        self.session = CachedCanvasSession("token", cache=self.cache)
+
+    def get(self, path, session=None):
+        response = (session or self.session).get(f"{self.canvas.url}{path.lstrip('/')}")
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def count_requests(self, path):
+        return [request_path for request_path, _ in self.canvas.requests].count(path)
+
+    def test_expired_responses_are_revalidated_with_their_etag(self):
+        with override_settings(CANVAS_CACHE_TTLS={"courses": 0.05}):
+            self.get("/api/v1/courses/1")
+            self.get("/api/v1/courses/1")
+            self.assertEqual(self.count_requests("/api/v1/courses/1"), 1)
+            time.sleep(0.1)
+            # Canvas answers 304, the cached response is used again
+            self.assertEqual(self.get("/api/v1/courses/1")["name"], "Course 1")
+            self.assertEqual(self.count_requests("/api/v1/courses/1"), 2)
+            self.get("/api/v1/courses/1")
+            self.assertEqual(self.count_requests("/api/v1/courses/1"), 2)
+            # without an etag, the expired response is downloaded again
+            self.get("/api/v1/courses/2")
+            time.sleep(0.1)
+            self.get("/api/v1/courses/2")
+            self.assertEqual(self.count_requests("/api/v1/courses/2"), 2)
+
+    def test_least_recently_used_responses_are_dropped(self):
+        self.cache.max_entries = 2
+        self.get("/api/v1/courses/1")
+        self.get("/api/v1/courses/2")
+        self.get("/api/v1/courses/1")
+        self.get("/api/v1/courses/1/sections")
+        self.assertEqual(len(self.cache), 2)
+        self.get("/api/v1/courses/1")
+        self.get("/api/v1/courses/2")
+        self.assertEqual(self.count_requests("/api/v1/courses/1"), 1)
+        self.assertEqual(self.count_requests("/api/v1/courses/2"), 2)
+
+    def test_tokens_do_not_share_responses(self):
+        other_session = CachedCanvasSession("other token", cache=self.cache)
+        self.get("/api/v1/courses/2")
+        self.get("/api/v1/courses/2", session=other_session)
+        self.get("/api/v1/courses/2", session=CachedCanvasSession("token", cache=self.cache))
+        self.assertEqual(self.count_requests("/api/v1/courses/2"), 2)
+
+    def test_other_requests_invalidate_their_course(self):
+        for path in self.responses:
+            self.get(path)
+        self.session.put(f"{self.canvas.url}api/v1/courses/1/sections/10", data={"name": "A"})
+        for path in self.responses:
+            self.get(path)
+        # the list of courses and the responses of course 1 are dropped
+        self.assertEqual(self.count_requests("/api/v1/courses"), 2)
+        self.assertEqual(self.count_requests("/api/v1/courses/1/sections"), 2)
+        self.assertEqual(self.count_requests("/api/v1/courses/2"), 1)
+        self.assertEqual(self.count_requests("/api/v1/courses/2/sections"), 1)
+
+    def test_invalidate_course(self):
+        session = CachedCanvasSession("token")
+        self.addCleanup(canvas_response_cache.clear)
+        for path in self.responses:
+            self.get(path, session=session)
+        invalidate_canvas_cache(2)
+        for path in self.responses:
+            self.get(path, session=session)
+        self.assertEqual(self.count_requests("/api/v1/courses"), 2)
+        self.assertEqual(self.count_requests("/api/v1/courses/1"), 1)
+        self.assertEqual(self.count_requests("/api/v1/courses/1/sections"), 1)
+        self.assertEqual(self.count_requests("/api/v1/courses/2/sections"), 2)
+
+    def test_post_canvas_views_invalidate_their_course(self):
+        session = CachedCanvasSession("token")
+        self.addCleanup(canvas_response_cache.clear)
+        course = Course.objects.create(name="Course 1", canvas_id="1")
+        self.get("/api/v1/courses/1/sections", session=session)
+        self.get("/api/v1/courses/2/sections", session=session)
+        client = APIClient()
+        client.force_authenticate(User.objects.create(username="teacher"))
+        response = client.post(
+            reverse("api-create-assignment-group", kwargs={"course_id": course.pk}),
+            {"canvas_id": "5", "name": "Quizzes", "position": 1},
+            format="json")
+        self.assertLess(response.status_code, 400)
+        self.get("/api/v1/courses/1/sections", session=session)
+        self.get("/api/v1/courses/2/sections", session=session)
+        self.assertEqual(self.count_requests("/api/v1/courses/1/sections"), 2)
+        self.assertEqual(self.count_requests("/api/v1/courses/2/sections"), 1)
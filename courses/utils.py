@@ -5,6 +5,8 @@ from pathlib import Path
 from canvasapi import Canvas
 from dotenv import load_dotenv
 
+from courses.canvas_cache import CachedCanvasSession
+
 
 def get_API_key():
     PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -44,9 +46,17 @@ CANVAS_API_KEY = get_API_key()
 
 def get_canvas_object():
     """
-    Return a Canvas object.
+    Return a Canvas object. Its GET requests are cached, see
+    courses.canvas_cache, and its requests are sent with the transport
+    shared by all the Canvas calls, see courses.canvas_transport.
     """
-    return Canvas(API_URL, CANVAS_API_KEY)
+    canvas = Canvas(API_URL, CANVAS_API_KEY)
+    # canvasapi has no option to pass a session: the private Requester of
+    # the Canvas object sends all its requests with its _session attribute,
+    # through the get/post/put/patch/delete methods of requests.Session.
+    # Checked with canvasapi 2.2.0 (environment.yml) and 3.6.0.
+    canvas._Canvas__requester._session = CachedCanvasSession(CANVAS_API_KEY)
+    return canvas
 
 def get_canvas_course(course_code=None, term_name=None, canvas_id=None):
     """
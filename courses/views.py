@@ -8,6 +8,8 @@ from django.contrib.auth.decorators import login_required
 from django.http import JsonResponse
 from django.shortcuts import get_object_or_404, render
 
+from courses.canvas_cache import canvas_response_cache, invalidate_canvas_cache
+from courses.canvas_transport import get_canvas_transport
 from courses.utils import get_canvas_object
 
 from .models import Course, Announcement
@@ -182,6 +184,19 @@ class ListCanvasCourseAnnouncements(APIView):
             canvas_announcements_serialized.append(announcement_dict)
         return Response(canvas_announcements_serialized, status=200)
     
+class GetCanvasTransportMetrics(APIView):
+    """
+    Latency, throttling and rate limit of the requests sent to Canvas
+    by this process, and size of the Canvas response cache.
+    """
+    permission_classes = [permissions.IsAdminUser]
+
+    def get(self, request):
+        return Response({
+            **get_canvas_transport().get_summary(),
+            "cached_responses": len(canvas_response_cache),
+        }, status=200)
+
 class PostCanvasCourse(APIView):
     permission_classes = [permissions.IsAuthenticated]
     def post(self, request):
@@ -212,6 +227,8 @@ class PostCanvasCourse(APIView):
             print("Handling exception: ", e)
             pass
 
+        invalidate_canvas_cache(course_canvas_id)
+
         if created:
             message = 'Course created successfully!'
         else:
@@ -241,6 +258,7 @@ class PostCanvasSection(APIView):
                 'teaching_assistant': request.user,
             }
         )
+        invalidate_canvas_cache(course.canvas_id)
 
         if created:
             message = 'Section created successfully!'
@@ -336,6 +354,7 @@ class PostCanvasCourseEnrollments(APIView):
         print("Updating avatars from canvas ...")
         Student.update_profiles_from_canvas(profiles)
         print("Done updating avatars from canvas ...")
+        invalidate_canvas_cache(course.canvas_id)
 
         response = {
             "message": "All students enrolled successfully!",
@@ -357,6 +376,7 @@ class PostCanvasAssignmentGroup(APIView):
                 'course': course,
             }
         )
+        invalidate_canvas_cache(course.canvas_id)
 
         if created:
             message = 'Assignment Group created successfully!'
@@ -414,6 +434,8 @@ class PostCanvasAssignment(APIView):
                 'success': False,
             }, status=500)
 
+        invalidate_canvas_cache(course.canvas_id)
+
         if created:
             message = 'Assignment created successfully!'
         else:
@@ -442,6 +464,7 @@ class PostCanvasAnnouncement(APIView):
                 'course': course,
             }
         )
+        invalidate_canvas_cache(course.canvas_id)
 
         if created:
             message = 'Announcement created successfully!'
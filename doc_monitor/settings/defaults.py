@@ -165,6 +165,60 @@ STATICFILES_DIRS = [
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+# Maximum size in bytes of the texts kept in the OCR cache used for versioning
+OCR_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# Vision language model used to extract information from the submissions,
+# and number of page images it processes at once
+VLM_MODEL_URI = "Qwen/Qwen2-VL-2B-Instruct"
+# VLM_MODEL_URI = "HuggingFaceTB/SmolVLM-256M-Instruct"
+VLM_BATCH_SIZE = 4
+# Maximum size in bytes of the resized page images cached for the model
+VLM_IMAGE_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+# Seconds after which a running assignment job that did not report any
+# progress is considered abandoned by a worker that died, and marked as
+# failed when `run_assignment_jobs` starts. The jobs report their progress
+# at least every ASSIGNMENT_JOB_HEARTBEAT_INTERVAL seconds while they run.
+ASSIGNMENT_JOB_STALE_TIMEOUT = 30 * 60
+ASSIGNMENT_JOB_HEARTBEAT_INTERVAL = 60
+
+# Number of submissions uploaded to Canvas at the same time, and number of
+# times a request is retried when Canvas is rate limiting or unavailable
+CANVAS_UPLOAD_MAX_CONCURRENCY = 8
+CANVAS_UPLOAD_MAX_RETRIES = 5
+
+# Number of students whose grades are sent in one request when the grades
+# are uploaded with the bulk update_grades endpoint of Canvas
+CANVAS_BULK_GRADE_CHUNK_SIZE = 500
+
+# Number of seconds the responses of the Canvas API are cached, by type of
+# resource, i.e. the last part of the url that is not an id. The resources
+# that are not listed, e.g. the submissions, are not cached. Each server
+# process has its own cache, see courses.canvas_cache
+CANVAS_CACHE_TTLS = {
+    "courses": 600,
+    "sections": 600,
+    "users": 300,
+    "assignment_groups": 300,
+    "assignments": 300,
+    "discussion_topics": 60,
+}
+# Maximum number of Canvas responses kept in the cache
+CANVAS_CACHE_MAX_ENTRIES = 256
+
+# Number of connections to Canvas kept alive, and number of requests sent
+# to Canvas per second, in bursts of at most CANVAS_RATE_LIMIT_BURST. The
+# rate is lowered when the X-Rate-Limit-Remaining header of Canvas goes
+# under CANVAS_RATE_LIMIT_LOW_WATER
+CANVAS_TRANSPORT_POOL_SIZE = 32
+CANVAS_RATE_LIMIT_PER_SECOND = 10
+CANVAS_RATE_LIMIT_BURST = 20
+CANVAS_RATE_LIMIT_LOW_WATER = 200
+
+# Seconds to wait for Canvas when downloading the avatar of a student
+CANVAS_AVATAR_DOWNLOAD_TIMEOUT = 30
+
 # Default URL to redirect if login is required
 LOGIN_URL = '/accounts/login/'
 # Redirect to home URL after login (Default redirects to /accounts/profile/)
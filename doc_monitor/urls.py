@@ -39,6 +39,7 @@ from courses.views import (
     ListCanvasCourseAssignmentGroups,
     ListCanvasCourseAssignments,
     ListCanvasCourseAnnouncements,
+    GetCanvasTransportMetrics,
 )
 from sections.views import (
     SectionViewSet,
@@ -54,6 +55,8 @@ from assignments.views import (
     AssignmentIdentifySubmissions,
     AssignmentVersionSubmissions,
     AssignmentExtractInfoSubmissions,
+    AssignmentJobView,
+    AssignmentJobEventsView,
     ExportSubmissionsPDFsView,
     ExportGradesCSVView,
 )
@@ -145,6 +148,16 @@ urlpatterns = [
         AssignmentExtractInfoSubmissions.as_view(),
         name="assignment-extract-submissions",
     ),
+    path(
+        "api/jobs/<uuid:job_id>/",
+        AssignmentJobView.as_view(),
+        name="assignment-job",
+    ),
+    path(
+        "api/jobs/<uuid:job_id>/events/",
+        AssignmentJobEventsView.as_view(),
+        name="assignment-job-events",
+    ),
     path(
         "api/assignments/<int:assignment_id>/export_pdfs/",
         ExportSubmissionsPDFsView.as_view(),
@@ -167,6 +180,11 @@ urlpatterns = [
     ),
     # canvas api
     path("api/canvas/courses/", ListCanvasCourses.as_view(), name="canvas-courses"),
+    path(
+        "api/canvas/metrics/",
+        GetCanvasTransportMetrics.as_view(),
+        name="canvas-transport-metrics",
+    ),
     path(
         "api/canvas/courses/<int:canvas_id>/",
         GetCanvasCourse.as_view(),
@@ -27,7 +27,11 @@ export ENV_TYPE="dev"
 
 # exec the final command:
 python manage.py makemigrations
+# the duplicates would make the unique constraint of the extracted info fields fail
+python manage.py delete_duplicate_extracted_info_fields
 python manage.py migrate
+# the question grades saved before the QuestionGrade table existed
+python manage.py sync_question_grades --missing
 
 # Create superuser with default values
 DJANGO_SUPERUSER_USERNAME=${DJANGO_SUPERUSER_USERNAME:-admin}
@@ -39,4 +43,7 @@ python manage.py createsuperuser --noinput \
     --email="$DJANGO_SUPERUSER_EMAIL" \
     && echo "Superuser created"
 
+# run the identify/version/extract-info jobs in the background
+python manage.py run_assignment_jobs &
+
 python manage.py runserver 0.0.0.0:8000
\ No newline at end of file
@@ -13,6 +13,7 @@ import {
 import { Toggle } from "@/components/ui/toggle"
 import { Skeleton } from "@/components/ui/skeleton"
 import { Button } from "@/components/ui/button"
+import { Checkbox } from "@/components/ui/checkbox"
 import {
   Dialog,
   DialogContent,
@@ -28,6 +29,7 @@ import {
   FormDescription,
   FormField,
   FormItem,
+  FormLabel,
 } from "@/components/ui/form"
 
 import { useForm } from "react-hook-form"
@@ -123,12 +125,14 @@ function VersioningForm({
   )
   const formSchema = z.object({
     pages: z.array(z.number()),
+    regroupAll: z.boolean(),
   })
   const { toast } = useToast()
   const form = useForm<z.infer<typeof formSchema>>({
     resolver: zodResolver(formSchema),
     defaultValues: {
       pages: [...Array(maxPages)].map((_, i) => i + 1).filter((v) => v == 1),
+      regroupAll: false,
     },
   })
   async function onSubmit(values: z.infer<typeof formSchema>) {
@@ -137,9 +141,14 @@ function VersioningForm({
       description:
         "Grouping submissions based on page(s): " + values.pages.join(),
     })
-    const data = await versionMutation.mutateAsync(values.pages, {
-      onSuccess: () => {},
-    })
+    // by default only the ungrouped submissions are assigned to the
+    // existing versions, regroupAll clusters all the submissions again
+    const data = await versionMutation.mutateAsync(
+      { pages_selected: values.pages, incremental: !values.regroupAll },
+      {
+        onSuccess: () => {},
+      }
+    )
     console.log("data", data)
     router.invalidate()
     setStep(2)
@@ -258,6 +267,25 @@ function VersioningForm({
                     </Button>
                   </div>
                 </div>
+                <FormField
+                  control={form.control}
+                  name="regroupAll"
+                  render={({ field }) => (
+                    <FormItem className="flex flex-row items-center space-x-3 space-y-0">
+                      <FormControl>
+                        <Checkbox
+                          checked={field.value}
+                          onCheckedChange={(checked) =>
+                            field.onChange(checked === true)
+                          }
+                        />
+                      </FormControl>
+                      <FormLabel>
+                        Regroup all submissions, discarding the current versions
+                      </FormLabel>
+                    </FormItem>
+                  )}
+                />
                 <div className="flex flex-row justify-center gap-4">
                   <Button type="submit">Group</Button>
                 </div>
@@ -11,6 +11,7 @@ import {
   Assignment,
   InfoField,
   Submission,
+  SubmissionPage,
   User,
   Announcement,
 } from "./types"
@@ -152,6 +153,68 @@ export async function fetchSubmissionsOfAssignment(assignmentId: number) {
   )
 }
 
+/**
+ * Fetch the submissions of an assignment page by page, following the
+ * cursor of each page. Only the given fields are returned, and the
+ * relations are returned as ids unless they are listed in `expand`.
+ */
+export async function* fetchSubmissionPagesOfAssignment(
+  assignmentId: number,
+  {
+    fields,
+    expand = [],
+    pageSize = 100,
+  }: { fields: (keyof Submission)[]; expand?: string[]; pageSize?: number }
+) {
+  const params = new URLSearchParams({
+    fields: fields.join(","),
+    expand: expand.join(","),
+    page_size: String(pageSize),
+  })
+  let url: string | null = `${urlMapper.submissions(assignmentId)}?${params}`
+  while (url) {
+    const page: SubmissionPage = await fetchData<SubmissionPage>(
+      url,
+      `Assignment ${assignmentId} not found`
+    )
+    yield page.results
+    url = page.next
+  }
+}
+
+/**
+ * The fields of the submissions used by the pages of an assignment: the
+ * submissions table, the identify, versioning and info extraction dialogs
+ * and the navigation between the submissions.
+ */
+const assignmentListSubmissionFields: (keyof Submission)[] = [
+  "id",
+  "student",
+  "version",
+  "grade",
+  "question_grades",
+  "canvas_id",
+  "canvas_url",
+  "papersubmission_images",
+]
+
+/**
+ * Fetch the submissions listed in the pages of an assignment, page by page
+ * and with only the fields these pages use. Their comments, extracted
+ * fields, pdf and assignment are not loaded, use `fetchSubmissionById`
+ * for them.
+ */
+export async function fetchSubmissionListOfAssignment(assignmentId: number) {
+  const submissions: Submission[] = []
+  for await (const page of fetchSubmissionPagesOfAssignment(assignmentId, {
+    fields: assignmentListSubmissionFields,
+    expand: ["student", "version"],
+  })) {
+    submissions.push(...(page as Submission[]))
+  }
+  return submissions
+}
+
 export async function fetchSubmissionsOfStudentInCourse(
   courseId: number,
   studentId: number
@@ -219,6 +282,31 @@ export async function patchSubmission({
   )
 }
 
+// the automation workflows run as background jobs on the server,
+// so we poll the job until it finishes and return its result
+async function waitForJob<T>(
+  jobId: string,
+  token: string | undefined,
+  pollInterval = 2000
+): Promise<T> {
+  for (;;) {
+    const job = await axios
+      .get(`${baseAPIUrl}jobs/${jobId}/`, {
+        headers: {
+          Authorization: `Bearer ${token}`,
+        },
+      })
+      .then((response) => response.data)
+    if (job.status === "done") {
+      return job.result
+    }
+    if (job.status === "failed") {
+      throw new Error(job.error ?? "Job failed")
+    }
+    await new Promise((resolve) => setTimeout(resolve, pollInterval))
+  }
+}
+
 export async function identifySubmissionsWorkflow({
   assignmentId,
   ...data
@@ -238,7 +326,7 @@ export async function identifySubmissionsWorkflow({
           },
         }
       )
-      .then((response) => response.data)
+      .then((response) => waitForJob(response.data.job_id, token))
   )
 }
 
@@ -248,6 +336,8 @@ export async function versionSubmissionsWorkflow({
 }: {
   assignmentId: number
   pages_selected: number[]
+  incremental?: boolean
+  method?: 'text' | 'fingerprint'
 }) {
   const token = auth.getToken()
   return loaderFn(() =>
@@ -261,7 +351,7 @@ export async function versionSubmissionsWorkflow({
           },
         }
       )
-      .then((response) => response.data)
+      .then((response) => waitForJob(response.data.job_id, token))
   )
 }
 
@@ -281,7 +371,7 @@ export async function extractInfoSubmissionsWorkflow({
           Authorization: `Bearer ${token}`,
         },
       })
-      .then((response) => response.data)
+      .then((response) => waitForJob(response.data.job_id, token))
   )
 }
 
@@ -308,7 +398,7 @@ export async function createSubmissionsBySplittingPDFs({
           "Content-Type": "multipart/form-data",
         },
       })
-      .then((response) => response.data)
+      .then((response) => waitForJob(response.data.job_id, token))
   )
 }
 
@@ -17,6 +17,7 @@ import {
   fetchStudentsOfCourse,
   fetchStudentOfCourseById,
   fetchSubmissionsOfAssignment,
+  fetchSubmissionListOfAssignment,
   fetchSubmissionsOfStudentInCourse,
   fetchSubmissionById,
   fetchAnnouncementsOfCourse,
@@ -139,7 +140,7 @@ export const studentInCourseQueryOptions = (
 export const submissionsQueryOptions = (assignmentId: number) => {
   return queryOptions({
     queryKey: subKeys.list(`assignmentId=${assignmentId}`),
-    queryFn: () => fetchSubmissionsOfAssignment(assignmentId),
+    queryFn: () => fetchSubmissionListOfAssignment(assignmentId),
   })
 }
 
@@ -285,11 +286,18 @@ export const useIdentifyAutomationWorkflowMutation = (assignmentId: number) => {
 export const useVersionAutomationWorkflowMutation = (assignmentId: number) => {
   return useMutation({
     mutationKey: ["submissions", "version", `assignmentId=${assignmentId}`],
-    mutationFn: async (pages_selected: number[]) => {
+    mutationFn: async ({
+      pages_selected,
+      incremental,
+    }: {
+      pages_selected: number[]
+      incremental: boolean
+    }) => {
       console.log("Automation workflow -Version- for assignment", assignmentId)
       return await versionSubmissionsWorkflow({
         assignmentId,
         pages_selected,
+        incremental,
       })
     },
     onSuccess: () => queryClient.invalidateQueries(),
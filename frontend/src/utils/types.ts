@@ -137,6 +137,11 @@ export interface Submission {
   extracted_fields?: ExtractedField[]
 }
 
+export interface SubmissionPage<T = Partial<Submission>> {
+  next: string | null
+  results: T[]
+}
+
 export interface Version {
   id: string
   name: string
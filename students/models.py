@@ -59,45 +59,50 @@ class Student(models.Model):
         cls,
         profiles):
 
-        # retrieve asynchrounously the avatars from canvas
-        # and update the profile objects
-        # max 30 concurrent requests
-        import asyncio
+        # retrieve concurrently the avatars from canvas, with the
+        # connections shared by all the canvas calls, and update the
+        # profile objects. The avatars are files, not calls to the
+        # Canvas API, so they do not use its rate limit
         import os
+        from concurrent.futures import ThreadPoolExecutor, as_completed
 
-        import aiohttp
+        import requests
+        from django.conf import settings
 
-        MAX_WORKERS = 30
+        from courses.canvas_transport import get_canvas_transport
 
-        semaphore = asyncio.Semaphore(MAX_WORKERS)
-        async def download_avatar(session, profile):
+        transport = get_canvas_transport()
+
+        def download_avatar(profile):
             url = profile["new_avatar_url"]
             basename = os.path.basename(url)
-            async with semaphore, session.get(url) as response:
-                filecontent = await response.read()
-                return profile, basename, filecontent
+            try:
+                response = transport.get(
+                    url,
+                    timeout=settings.CANVAS_AVATAR_DOWNLOAD_TIMEOUT,
+                    rate_limited=False)
+            except requests.RequestException as e:
+                print(f"Could not download avatar {url}: {e}")
+                return None
+            if not response.ok:
+                print(f"Could not download avatar {url}: {response.status_code}")
+                return None
+            return profile, basename, response.content
 
-        async def main(profiles):
-            async with aiohttp.ClientSession() as session:
-                tasks = [ download_avatar(session, profile) for profile in profiles ]
-                finished = 0
-                print("Downloading avatars...")
-                results = []
-                for task in asyncio.as_completed(tasks):
-                    result = await task
-                    finished += 1
-                    print(f"Finished {finished} of {len(profiles)} ...", end="\r")
-                    results.append(result)
-                print("\n")
-                return results
-                    
-        results = asyncio.run(main(profiles))
+        print("Downloading avatars...")
+        results = []
+        with ThreadPoolExecutor(max_workers=transport.pool_size) as executor:
+            futures = [executor.submit(download_avatar, profile) for profile in profiles]
+            for finished, future in enumerate(as_completed(futures), start=1):
+                results.append(future.result())
+                print(f"Finished {finished} of {len(profiles)} ...", end="\r")
+        print("\n")
         
         # update the profile objects
         for result in results:
-            profile, basename, filecontent = result
             if not result:
                 continue
+            profile, basename, filecontent = result
 
             # check if the new avatar is different from the old one
             # by comparing the md5 hashes of the two files
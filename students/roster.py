@@ -0,0 +1,152 @@
+"""Compiled rosters of the courses, used to identify the students
+of the paper submissions.
+
+A roster keeps the students of a course that have a valid University ID
+as arrays, so that the predicted digits can be matched against it without
+going through the database. Rosters are cached in the memory of each
+process and on disk, and they are invalidated by the receivers in
+`students.signals` when a student or the sections of a course change.
+Changes made with `QuerySet.update` or `bulk_create` do not send signals,
+so they need to call `invalidate_course_roster` themselves.
+"""
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+from django.apps import apps
+from django.conf import settings
+
+from submissions.digits_classify import UFID_LENGTH
+
+# course pk -> (identity of the cache file, CourseRoster)
+_rosters = {}
+
+
+class CourseRoster:
+    """The students of a course with a valid University ID.
+
+    uni_ids and student_pks are int64 arrays, and names is an array
+    of "last name, first name" strings, all in the same order.
+    """
+
+    def __init__(self, uni_ids, names, student_pks):
+        self.uni_ids = np.asarray(uni_ids, dtype=np.int64)
+        self.names = np.asarray(names, dtype=str)
+        self.student_pks = np.asarray(student_pks, dtype=np.int64)
+        self._pk_by_uni_id = dict(
+            zip(self.uni_ids.tolist(), self.student_pks.tolist()))
+
+    def __len__(self):
+        return len(self.uni_ids)
+
+    @property
+    def digits(self):
+        """The University IDs as an (N_students, UFID_LENGTH) array of digits."""
+        powers = 10 ** np.arange(UFID_LENGTH - 1, -1, -1, dtype=np.int64)
+        return ((self.uni_ids[:, np.newaxis] // powers) % 10).astype(np.intp)
+
+    def get_student_pk(self, uni_id):
+        """Return the pk of the student with the given University ID,
+        or None if the student is not in the roster."""
+        try:
+            return self._pk_by_uni_id.get(int(uni_id))
+        except (TypeError, ValueError):
+            return None
+
+    def to_dataframe(self):
+        """Return the roster in the format of `import_students_from_db`."""
+        return pd.DataFrame({
+            "Student": self.names,
+            "SIS User ID": [f"{uni_id:0{UFID_LENGTH}d}" for uni_id in self.uni_ids.tolist()],
+        })
+
+    def save(self, path):
+        # write to a temporary file first, so that other processes
+        # never read a partially written roster
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), suffix=".npz", delete=False) as f:
+            np.savez(
+                f,
+                uni_ids=self.uni_ids,
+                names=self.names,
+                student_pks=self.student_pks)
+        os.replace(f.name, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as data:
+            return cls(data["uni_ids"], data["names"], data["student_pks"])
+
+    @classmethod
+    def from_db(cls, course):
+        Student = apps.get_model("students", "Student")
+        students = (
+            Student.objects
+            .filter(sections__course=course)
+            .distinct()
+            .order_by("last_name", "first_name", "pk")
+            .values_list("pk", "first_name", "last_name", "uni_id"))
+        uni_ids, names, student_pks = [], [], []
+        for pk, first_name, last_name, uni_id in students:
+            # skip the students whose University ID is not a number of length UFID_LENGTH
+            if not (uni_id.isascii() and uni_id.isdigit() and len(uni_id) == UFID_LENGTH):
+                continue
+            uni_ids.append(int(uni_id))
+            names.append(f"{last_name}, {first_name}")
+            student_pks.append(pk)
+        return cls(uni_ids, names, student_pks)
+
+
+def roster_cache_path(course_pk):
+    return os.path.join(settings.MEDIA_ROOT, "rosters", f"course_{course_pk}.npz")
+
+
+def _cache_file_identity(path):
+    # the inode changes whenever the file is written again, even
+    # when the modification times are too coarse to tell
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+def get_course_roster(course):
+    """Return the CourseRoster of the course.
+
+    The roster is read from memory if the cache file did not change since
+    it was loaded, from the cache file if it exists, and from the database
+    otherwise. Checking the file lets the processes that run the jobs see
+    the invalidations made by the web server.
+    """
+    path = roster_cache_path(course.pk)
+    file_identity = _cache_file_identity(path)
+
+    cached = _rosters.get(course.pk)
+    if file_identity is not None and cached is not None and cached[0] == file_identity:
+        return cached[1]
+
+    roster = None
+    if file_identity is not None:
+        try:
+            roster = CourseRoster.load(path)
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Could not load the roster of course {course.pk}: {e}")
+    if roster is None:
+        roster = CourseRoster.from_db(course)
+        roster.save(path)
+        file_identity = _cache_file_identity(path)
+    _rosters[course.pk] = (file_identity, roster)
+    return roster
+
+
+def invalidate_course_roster(course_pk):
+    """Remove the cached roster of the course from memory and disk."""
+    if course_pk is None:
+        return
+    _rosters.pop(course_pk, None)
+    try:
+        os.remove(roster_cache_path(course_pk))
+    except FileNotFoundError:
+        pass
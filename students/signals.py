@@ -0,0 +1,62 @@
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+
+from courses.models import Course
+from sections.models import Section
+
+from .models import Student
+from .roster import invalidate_course_roster
+
+
+def invalidate_student_rosters(student):
+    for course_pk in (Section.objects
+                      .filter(students=student)
+                      .values_list("course_id", flat=True)
+                      .distinct()):
+        invalidate_course_roster(course_pk)
+
+@receiver(post_save, sender=Student)
+def invalidate_rosters_on_student_save(sender, instance, **kwargs):
+    invalidate_student_rosters(instance)
+
+@receiver(pre_delete, sender=Student)
+def invalidate_rosters_on_student_delete(sender, instance, **kwargs):
+    # the sections of the student are removed before post_delete
+    invalidate_student_rosters(instance)
+
+@receiver(m2m_changed, sender=Student.sections.through)
+def invalidate_rosters_on_enrollment_change(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ("post_add", "post_remove", "pre_clear"):
+        return
+    if reverse:
+        # instance is a Section
+        invalidate_course_roster(instance.course_id)
+    elif action == "pre_clear":
+        invalidate_student_rosters(instance)
+    else:
+        for course_pk in (Section.objects
+                          .filter(pk__in=pk_set)
+                          .values_list("course_id", flat=True)
+                          .distinct()):
+            invalidate_course_roster(course_pk)
+
+@receiver(pre_save, sender=Section)
+def invalidate_rosters_on_section_move(sender, instance, **kwargs):
+    # the section may be moved to another course
+    if instance.pk is None:
+        return
+    old_course_pk = (Section.objects
+                     .filter(pk=instance.pk)
+                     .values_list("course_id", flat=True)
+                     .first())
+    if old_course_pk != instance.course_id:
+        invalidate_course_roster(old_course_pk)
+        invalidate_course_roster(instance.course_id)
+
+@receiver(pre_delete, sender=Section)
+def invalidate_rosters_on_section_delete(sender, instance, **kwargs):
+    invalidate_course_roster(instance.course_id)
+
+@receiver(post_delete, sender=Course)
+def invalidate_rosters_on_course_delete(sender, instance, **kwargs):
+    invalidate_course_roster(instance.pk)
@@ -3,7 +3,7 @@ from django.contrib import admin
 from .models import (CanvasQuizSubmission, PaperSubmission,
                      PaperSubmissionImage, ScantronSubmission,
                      SubmissionComment, AssignmentInfoField, 
-                     ExtractedInfoField)
+                     ExtractedInfoField, OCRCacheEntry, QuestionGrade)
 
 # # Register your models here.
 
@@ -57,5 +57,16 @@ class SubmissionCommentAdmin(admin.ModelAdmin):
 
 admin.site.register(SubmissionComment, SubmissionCommentAdmin)
 
+class QuestionGradeAdmin(admin.ModelAdmin):
+    list_display = ['__str__', 'question', 'score']
+    list_filter = ['submission__assignment__course', 'submission__assignment', 'question']
+
+admin.site.register(QuestionGrade, QuestionGradeAdmin)
+
 admin.site.register(AssignmentInfoField)
-admin.site.register(ExtractedInfoField)
\ No newline at end of file
+admin.site.register(ExtractedInfoField)
+
+class OCRCacheEntryAdmin(admin.ModelAdmin):
+    list_display = ['__str__', 'size', 'last_used']
+
+admin.site.register(OCRCacheEntry, OCRCacheEntryAdmin)
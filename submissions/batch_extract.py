@@ -1,6 +1,9 @@
 import os
+import queue
 import re
+import threading
 from collections import defaultdict
+from hashlib import md5
 import json
 import argparse
 
@@ -37,32 +40,133 @@ def get_images(folder, pattern):
     return {filepath: load_and_resize_image(filepath) for filepath in filepaths}
 
 
-def load_and_resize_image(image_path, max_size=1024):
+def load_and_resize_image(image_path, max_size=1024, cache_dir=None):
     """
     Load and resize an image while maintaining aspect ratio
 
+    The image is decoded at a reduced scale when the format supports it
+    (JPEG), and shrunk with a fast integer reduction before the final
+    LANCZOS resampling, so the full resolution image is never resized.
+
     Args:
         image_path: Path to the image file
         max_size: Maximum dimension (width or height) of the output image
+        cache_dir: If given, the resized image is saved in this folder
+            and read from it the next time, see evict_image_cache
 
     Returns:
         PIL Image: Resized image
     """
-    image = Image.open(image_path)
+    cache_path = None
+    if cache_dir is not None:
+        stat = os.stat(image_path)
+        key = f"{os.path.abspath(image_path)}-{stat.st_mtime_ns}-{stat.st_size}-{max_size}"
+        cache_path = os.path.join(cache_dir, f"{md5(key.encode()).hexdigest()}.png")
+        if os.path.exists(cache_path):
+            with Image.open(cache_path) as cached_image:
+                cached_image.load()
+                cached_image = cached_image.copy()
+            # the modification time tells evict_image_cache when it was last used
+            os.utime(cache_path)
+            return cached_image
+
+    with Image.open(image_path) as image:
+        # only resize if image is larger than max_size
+        image.draft(image.mode, (max_size, max_size))
+        image.thumbnail(
+            (max_size, max_size), Image.Resampling.LANCZOS, reducing_gap=3.0
+        )
+        image = image.copy()
+
+    if cache_path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        # write to a temporary file first, so that a concurrent
+        # reader never sees a partially written image
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        image.save(tmp_path, format="PNG")
+        os.replace(tmp_path, cache_path)
 
-    # Get current dimensions
-    width, height = image.size
+    return image
 
-    # Calculate scaling factor
-    scale = min(max_size / width, max_size / height)
 
-    # Only resize if image is larger than max_size
-    if scale < 1:
-        new_width = int(width * scale)
-        new_height = int(height * scale)
-        image = image.resize((new_width, new_height), Image.Resampling.LANCZOS)
+def evict_image_cache(cache_dir, max_bytes):
+    """
+    Delete the least recently used images of the cache of
+    load_and_resize_image until they take less than max_bytes
 
-    return image
+    Args:
+        cache_dir: the cache_dir given to load_and_resize_image
+        max_bytes: maximum total size of the cached images
+    """
+    if not os.path.isdir(cache_dir):
+        return
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.is_file() and entry.name.endswith(".png"):
+            stat = entry.stat()
+            entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            # already evicted by a concurrent extraction
+            pass
+        total -= size
+
+
+def iter_resized_images(image_paths, max_size=1024, prefetch=8, cache_dir=None):
+    """
+    Load and resize images in a background thread, keeping at most
+    `prefetch` images in memory ahead of the consumer
+
+    Args:
+        image_paths: iterable of (key, image_path) pairs
+        max_size: see load_and_resize_image
+        prefetch: maximum number of images loaded but not yet consumed
+        cache_dir: see load_and_resize_image
+
+    Yields:
+        (key, PIL Image) pairs, in the order of image_paths
+    """
+    done = object()
+    loaded = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+
+    def put(item):
+        # give up if the consumer stopped iterating
+        while not stop.is_set():
+            try:
+                loaded.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def load():
+        try:
+            for key, image_path in image_paths:
+                image = load_and_resize_image(image_path, max_size, cache_dir=cache_dir)
+                if not put((key, image)):
+                    return
+        except Exception as e:
+            put(e)
+        put(done)
+
+    loader = threading.Thread(target=load, daemon=True)
+    loader.start()
+    try:
+        while True:
+            item = loaded.get()
+            if item is done:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
 
 
 def json_save_results(results, filepath):
@@ -77,72 +181,148 @@ def json_load_results(filepath):
     return results
 
 
+class VLMExtractor:
+    """
+    A vision language model kept in memory with its processor and the
+    JSON-constrained generators already built for each pydantic model.
+
+    Loading the model takes much longer than extracting the information
+    from a page, so the extractors are created once per process with 
+    `get_extractor` and reused by every extraction, e.g. by all the jobs
+    run by the same `run_assignment_jobs` worker.
+    """
+
+    def __init__(self, model_uri, model_class=AutoModelForVision2Seq):
+        has_cuda = torch.cuda.is_available()
+        self.model_uri = model_uri
+        self.model = outlines.models.transformers_vision(
+            model_uri,
+            model_class=model_class,
+            model_kwargs={
+                "device_map": "auto",
+                "torch_dtype": torch.float16 if has_cuda else torch.float32,
+                "attn_implementation": "flash_attention_2" if has_cuda else "eager",
+            },
+        )
+        self.processor = AutoProcessor.from_pretrained(model_uri)
+        # schema -> (prompt, generator)
+        self._generators = {}
+
+    def get_generator(self, pydantic_model: BaseModel, user_message: str):
+        """Return the prompt and the generator for the pydantic model,
+        building them the first time the schema is seen."""
+        schema = pydantic_model.model_json_schema(by_alias=False)
+        key = (json.dumps(schema, sort_keys=True), user_message)
+        if key not in self._generators:
+            messages = [
+                {
+                    "role": "user",
+                    "content": [
+                        {
+                            # The image is provided as a PIL Image object
+                            "type": "image",
+                            "image": "",
+                        },
+                        {
+                            "type": "text",
+                            "text": f"""{user_message}
+
+                            Return the information in the following JSON schema:
+                            {schema}
+                        """,
+                        },
+                    ],
+                }
+            ]
+            print(messages)
+            # Convert the messages to the final prompt
+            prompt = self.processor.apply_chat_template(
+                messages, tokenize=False, add_generation_prompt=True
+            )
+            extract_generator = outlines.generate.json(
+                self.model,
+                pydantic_model,
+                # Greedy sampling is a good idea for numeric
+                # data extraction -- no randomness.
+                sampler=outlines.samplers.greedy(),
+                # sampler=outlines.samplers.multinomial(temperature=0.5),
+            )
+            self._generators[key] = (prompt, extract_generator)
+        return self._generators[key]
+
+    def extract(
+        self,
+        images,
+        pydantic_model: BaseModel,
+        user_message: str = "You are a helpful assistant",
+        batch_size: int = 4,
+    ):
+        """
+        Extract the information of the pydantic model from the images.
+
+        Args:
+            images: iterable of (key, PIL Image) pairs, e.g. dict.items()
+            batch_size: number of images sent to the model at once
+
+        Yields:
+            (key, result) pairs, where result is the extracted information as a dict
+        """
+        prompt, extract_generator = self.get_generator(pydantic_model, user_message)
+        batch = []
+        for key, image in images:
+            batch.append((key, image))
+            if len(batch) == batch_size:
+                yield from self._extract_batch(prompt, extract_generator, batch)
+                batch = []
+        if batch:
+            yield from self._extract_batch(prompt, extract_generator, batch)
+
+    def _extract_batch(self, prompt, extract_generator, batch):
+        results = extract_generator(
+            [prompt] * len(batch),
+            [[image] for _, image in batch],
+        )
+        if not isinstance(results, list):
+            results = [results]
+        for (key, _), result in zip(batch, results):
+            print(result.model_dump(mode="json", by_alias=True))
+            yield key, result.model_dump(mode="json")
+
+
+# model_uri -> VLMExtractor, loaded once per process
+_extractors = {}
+
+
+def get_extractor(model_uri, model_class=AutoModelForVision2Seq):
+    if model_uri not in _extractors:
+        print(f"Loading {model_uri}...")
+        _extractors[model_uri] = VLMExtractor(model_uri, model_class=model_class)
+    return _extractors[model_uri]
+
+
 def outlines_vlm(
     images,
     model_uri,
     pydantic_model: BaseModel,
     model_class=AutoModelForVision2Seq,
     user_message: str = "You are a helpful assistant",
+    batch_size: int = 4,
+    progress_callback=None,
 ):
+    # progress_callback(n_done) is called with the number of images done
     # output_path = f"{model_uri.replace('/', '-')}-results.json"
     # print(f"Saving results to {output_path}")
-    has_cuda = torch.cuda.is_available()
-    model = outlines.models.transformers_vision(
-        model_uri,
-        model_class=model_class,
-        model_kwargs={
-            "device_map": "auto",
-            "torch_dtype": torch.float16 if has_cuda else torch.float32,
-            "attn_implementation": "flash_attention_2" if has_cuda else "eager",
-        },
-    )
-
-    messages = [
-        {
-            "role": "user",
-            "content": [
-                {
-                    # The image is provided as a PIL Image object
-                    "type": "image",
-                    "image": "",
-                },
-                {
-                    "type": "text",
-                    "text": f"""{user_message}
-
-                    Return the information in the following JSON schema:
-                    {pydantic_model.model_json_schema(by_alias=False)}
-                """,
-                },
-            ],
-        }
-    ]
-    print(messages)
-    # Convert the messages to the final prompt
-    processor = AutoProcessor.from_pretrained(model_uri)
-    prompt = processor.apply_chat_template(
-        messages, tokenize=False, add_generation_prompt=True
-    )
-    extract_generator = outlines.generate.json(
-        model,
-        pydantic_model,
-        # Greedy sampling is a good idea for numeric
-        # data extraction -- no randomness.
-        sampler=outlines.samplers.greedy(),
-        # sampler=outlines.samplers.multinomial(temperature=0.5),
-    )
+    extractor = get_extractor(model_uri, model_class=model_class)
+    items = images.items() if isinstance(images, dict) else images
 
     # Generate the quiz submission summary
     results = defaultdict(list)
-    n_samples = 1
-    for idx, (imagepath, image) in enumerate(images.items()):
-        if idx >= 5:
-            break
-        for _ in range(n_samples):
-            result = extract_generator(prompt, [image])
-            print(result.model_dump(mode="json", by_alias=True))
-            results[imagepath].append(result.model_dump(mode="json"))
-        print("\n")
+    for imagepath, result in extractor.extract(
+        items, pydantic_model, user_message=user_message, batch_size=batch_size
+    ):
+        results[imagepath].append(result)
+        if progress_callback is not None:
+            progress_callback(len(results))
 
     # save the results
     # json_save_results(results, filepath=output_path)
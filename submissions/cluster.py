@@ -1,6 +1,8 @@
 
+import os
 import subprocess
-import io
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from string import ascii_letters, digits
 
 import numpy as np
@@ -36,86 +38,194 @@ def crop_and_ocr(image_path):
     return text
 
 
-def images_to_text(image_paths, sub_pks):
+# characters that tesseract is allowed to recognize
+OCR_CHAR_SET = ascii_letters + ' ' + digits
+# (left, top, right, bottom) fractions of the page that are used to tell
+# the versions apart, same region as in crop_and_ocr
+VERSION_TEXT_REGION = (0, 0.1, 1, 0.4)
+# side in pixels of the blank page OCRed in place of an unreadable image
+BLANK_PAGE_SIZE = 100
+
+
+def parse_tesseract_tsv(tsv, min_conf=70):
+    """
+    Parse the TSV output of tesseract
+    Input:
+        tsv: TSV output of tesseract, as a string
+        min_conf: minimum confidence of the words to keep
+    Output:
+        words: dict with the list of words of each page, 
+            with the page numbers starting at 1 as in the TSV
+    """
+    words = {}
+    # columns: level page_num block_num par_num line_num word_num 
+    # left top width height conf text
+    for line in tsv.splitlines()[1:]:
+        fields = line.split("\t", 11)
+        if len(fields) < 12:
+            continue
+        text = fields[11].strip()
+        if not text:
+            continue
+        try:
+            conf = float(fields[10])
+        except ValueError:
+            continue
+        if conf > min_conf:
+            words.setdefault(int(fields[1]), []).append(text)
+    return words
+
+
+def _ocr_shard(image_paths, crop_fractions, dpi, char_set):
+    """
+    Run a single tesseract process over a list of images
+    Output:
+        texts: list with the text of each image
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        ocr_paths = []
+        for i, image_path in enumerate(image_paths):
+            if crop_fractions is None:
+                ocr_paths.append(image_path)
+                continue
+            image = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
+            if image is not None:
+                height, width = image.shape[:2]
+                left, top, right, bottom = crop_fractions
+                image = image[
+                    int(height * top):int(height * bottom),
+                    int(width * left):int(width * right)]
+            if image is None or image.size == 0:
+                # keep a blank page so that the pages stay aligned,
+                # large enough for tesseract to accept it
+                image = np.full((BLANK_PAGE_SIZE, BLANK_PAGE_SIZE), 255, dtype=np.uint8)
+            ocr_path = os.path.join(tmp_dir, f"{i}.png")
+            cv2.imwrite(ocr_path, image)
+            ocr_paths.append(ocr_path)
+
+        text_tsv = subprocess.run(
+            [
+                'tesseract',  
+                '--dpi', str(dpi),
+                '-c', f'tessedit_char_whitelist={char_set}',
+                '-c', 'tessedit_create_tsv=1',
+                'stdin', 'stdout', # stdin/stdout
+            ],
+            input="\n".join(ocr_paths),
+            capture_output=True, 
+            text=True,
+            # the images are already spread over the processes
+            env={**os.environ, "OMP_THREAD_LIMIT": "1"},
+        )
+    if text_tsv.returncode != 0:
+        raise RuntimeError(
+            f"tesseract exited with code {text_tsv.returncode}: {text_tsv.stderr.strip()}")
+    words = parse_tesseract_tsv(text_tsv.stdout)
+    return [" ".join(words.get(page_num, [])) for page_num in range(1, len(image_paths) + 1)]
+
+
+def ocr_images(image_paths, crop_fractions=VERSION_TEXT_REGION, dpi=150, char_set=OCR_CHAR_SET, processes=None, progress_callback=None, skip_failed=False):
+    """
+    Use OCR to extract the text of each image
+    Input:
+        image_paths: list of paths to the images
+        crop_fractions: (left, top, right, bottom) fractions of the images
+            to keep before OCR, or None to use the whole images
+        dpi: dpi of the images
+        char_set: characters that tesseract is allowed to recognize
+        processes: number of tesseract processes run at the same time,
+            by default the number of cpus
+        progress_callback: if given, called as progress_callback(n_done, n_total)
+            with the number of images done each time a process finishes
+        skip_failed: if True, the texts of the images of a tesseract
+            process that failed are None, instead of raising its error
+    Output:
+        texts: list with the text of each image
+    """
+    if not image_paths:
+        return []
+    if processes is None:
+        processes = os.cpu_count() or 1
+    processes = min(processes, len(image_paths))
+    # one tesseract process per shard, which avoids paying 
+    # the startup of tesseract for every image
+    shards = [image_paths[i::processes] for i in range(processes)]
+    texts = [""] * len(image_paths)
+    n_done = 0
+    with ThreadPoolExecutor(processes) as executor:
+        futures = {
+            executor.submit(_ocr_shard, shard, crop_fractions, dpi, char_set): i
+            for i, shard in enumerate(shards)
+        }
+        for future in as_completed(futures):
+            i = futures[future]
+            try:
+                texts[i::processes] = future.result()
+            except RuntimeError as e:
+                if not skip_failed:
+                    raise
+                print(f"OCR of {len(shards[i])} images failed: {e}")
+                texts[i::processes] = [None] * len(shards[i])
+            n_done += len(shards[i])
+            if progress_callback is not None:
+                progress_callback(n_done, len(image_paths))
+    return texts
+
+
+def group_texts_by_submission(texts, sub_pks):
+    """
+    Join the texts of the images of each submission
+    Input:
+        texts: list with the text of each image
+        sub_pks: list of submission pks. Same length as texts
+    Output:
+        texts_grouped: Series with the text of each submission, indexed
+            by the submission pk and sorted by the last image of each 
+            submission
+    """
+    submission_texts = {}
+    last_image = {}
+    for i, (text, sub_pk) in enumerate(zip(texts, sub_pks)):
+        submission_texts.setdefault(sub_pk, []).append(text)
+        last_image[sub_pk] = i
+    sub_pks_sorted = sorted(submission_texts, key=last_image.get)
+    return pd.Series(
+        [" ".join(submission_texts[sub_pk]) for sub_pk in sub_pks_sorted],
+        index=pd.Index(sub_pks_sorted, name="sub_pk"),
+        name="text",
+        dtype=object,
+    )
+
+
+def images_to_text(image_paths, sub_pks, crop_fractions=VERSION_TEXT_REGION, processes=None):
     """
     Use OCR to extract the text and save the texts in a list
     Input:
         image_list : list of paths to the images
         sub_pks: list of submission pks. Same length as image_list
+        crop_fractions: region of the images to OCR, see ocr_images
+        processes: number of tesseract processes, see ocr_images
     Output:
-        texts: list of texts extracted from the images
+        texts: Series with the text of each submission, 
+            see group_texts_by_submission
     """    
-    print(f"Extracting text from {len(image_paths)} images. This may take a while...")
-    
-    char_set = ascii_letters + ' ' + digits
-    text_tsv = subprocess.run(
-        [
-            'tesseract',  
-            '--dpi', '150',
-            '-c', f'tessedit_char_whitelist={char_set}',
-            '-c', 'tessedit_create_tsv=1',
-            'stdin', 'stdout', # stdin/stdout
-        ],
-        input="\n".join(image_paths),
-        capture_output=True, 
-        text=True,
-    )
-
-    df = pd.read_csv(
-        io.StringIO(text_tsv.stdout), 
-        sep='\t',
-        quotechar='"',
-        engine='python',
-        keep_default_na=False,
-    )
-    
-    # keep only the text with confidence > 70
-    df = df[df.conf > 70]
-    # remove empty texts
-    df = df[(df.text != '') & (df.text != ' ')]
-    # convert the page_num from 1-indexed to 0-indexed
-    if df.page_num.max() > 0 and df.page_num.min() > 0:
-        df.page_num = df.page_num - 1
-
-    texts_grouped = df[['text', 'page_num']].groupby('page_num')
-    texts_grouped = texts_grouped.agg({'text': ' '.join})["text"]
-    # replace NaN with empty string
-    texts_grouped = texts_grouped.fillna('')
-    print(texts_grouped.head(), type(texts_grouped))
-
-    df_pks = pd.DataFrame({"sub_pk": sub_pks, "page_num": range(len(sub_pks))})
-    print(df_pks.head(), type(df_pks))
-
-    texts_grouped = pd.merge(
-        df_pks,
-        texts_grouped,
-        left_on="page_num",
-        right_on="page_num",
-        how="left",
-    ).fillna('')
-    print(texts_grouped.head(), type(texts_grouped))
-    texts_grouped = (texts_grouped
-                     .groupby("sub_pk")
-                     .agg({'text': ' '.join, 'page_num': np.max})
-                     .sort_values(by=['page_num'])
-                     ["text"]
-    )
+    print(f"Extracting text from {len(image_paths)} images...")
+    texts = ocr_images(image_paths, crop_fractions=crop_fractions, processes=processes)
+    texts_grouped = group_texts_by_submission(texts, sub_pks)
     print(texts_grouped.head(25))
     print(texts_grouped.shape)
-    print(texts_grouped.index)
-    print(type(texts_grouped))
-    # raise NotImplementedError
 
     return texts_grouped
 
 
 
-def vectorize_texts(texts):
+def fit_text_vectorizer(texts):
     """
-    Vectorize the texts using TfidfVectorizer
+    Fit a TfidfVectorizer on the texts
     Input:
         texts: list of texts
     Output:
+        vectorizer: the fitted TfidfVectorizer
         X: vectorized texts
     """
     vectorizer = TfidfVectorizer(
@@ -125,8 +235,75 @@ def vectorize_texts(texts):
     )
     X = vectorizer.fit_transform(texts)
 
+    return vectorizer, X
+
+def vectorize_texts(texts):
+    """
+    Vectorize the texts using TfidfVectorizer
+    Input:
+        texts: list of texts
+    Output:
+        X: vectorized texts
+    """
+    vectorizer, X = fit_text_vectorizer(texts)
+
     return X
 
+def load_text_vectorizer(vocabulary, idf):
+    """
+    Rebuild a vectorizer fitted by fit_text_vectorizer
+    Input:
+        vocabulary: the vocabulary_ of the fitted vectorizer
+        idf: the idf_ of the fitted vectorizer
+    Output:
+        vectorizer: a TfidfVectorizer that transforms the texts
+            in the same way as the fitted one
+    """
+    vectorizer = TfidfVectorizer(
+        stop_words="english",
+        vocabulary=vocabulary,
+    )
+    vectorizer.idf_ = np.asarray(idf, dtype=np.float64)
+    return vectorizer
+
+def get_cluster_centroids(X, cluster_labels, outlier_label=-1):
+    """
+    Compute the normalized centroid of each cluster
+    Input:
+        X: vectorized texts, with rows of unit norm
+        cluster_labels: labels of the clusters
+    Output:
+        centroids: dict with the centroid of each cluster label
+    """
+    centroids = {}
+    for label in set(cluster_labels) - {outlier_label}:
+        centroid = np.asarray(X[cluster_labels == label].mean(axis=0)).ravel()
+        norm = np.linalg.norm(centroid)
+        centroids[label] = centroid / norm if norm > 0 else centroid
+    return centroids
+
+def assign_to_centroids(X, centroids, eps=0.5):
+    """
+    Assign each row of X to the most similar centroid
+    Input:
+        X: vectorized texts, with rows of unit norm
+        centroids: array with one normalized centroid per row
+        eps: the DBSCAN eps, a row is an outlier if it is further 
+            than eps from every centroid
+    Output:
+        assignments: index of the centroid of each row, or -1 for outliers
+        similarities: cosine similarity to the assigned centroid
+    """
+    if len(centroids) == 0 or X.shape[0] == 0:
+        return np.full(X.shape[0], -1), np.zeros(X.shape[0])
+    # sparse (n, d) times dense (d, k)
+    similarities = np.asarray(X @ np.asarray(centroids).T)
+    assignments = similarities.argmax(axis=1)
+    best = similarities[np.arange(len(assignments)), assignments]
+    # for unit vectors, distance <= eps is the same as similarity >= 1 - eps**2/2
+    assignments[best < 1 - eps**2 / 2] = -1
+    return assignments, best
+
 def perform_dbscan_clustering(X):
     """
     Perform DBSCAN clustering on the images
@@ -1,6 +1,9 @@
+import numpy as np
 from PIL import Image
 import fitz
 
+from submissions.fingerprint import page_fingerprint
+
 def convert_pdf_to_images(filepath, dpi, top_percent=0.25, left_percent=0.5, crop_box=None, skip_pages=(0,1,3)):
     """
     Converts a pdf file to a list of images.
@@ -29,63 +32,299 @@ def convert_pdf_to_images(filepath, dpi, top_percent=0.25, left_percent=0.5, cro
         A list of images.
     """
     images = []
-    doc = fitz.Document(filepath)
-    for page in doc:
-        if page.number in skip_pages:
+    for pix in render_pdf_pages(filepath, dpi, top_percent, left_percent, crop_box, skip_pages):
+        if pix is None:
             images.append(None)
             continue
-        rect = page.rect  # the page rectangle
-
-        if crop_box is not None and page.number in crop_box:
-            x_perc = float(crop_box[page.number]["x"])
-            y_perc = float(crop_box[page.number]["y"])
-            w_perc = float(crop_box[page.number]["width"])
-            h_perc = float(crop_box[page.number]["height"])
-            page_width = rect.x1 - rect.x0
-            page_height = rect.y1 - rect.y0
-            rect.x0 = rect.x0 + x_perc * page_width / 100
-            rect.y0 = rect.y0 + y_perc * page_height / 100
-            rect.x1 = rect.x0 + w_perc * page_width / 100
-            rect.y1 = rect.y0 + h_perc * page_height / 100
-        else:
-            rect.x1 = rect.x0 + (rect.x1 - rect.x0) * left_percent
-            rect.y1 = rect.y0 + (rect.y1 - rect.y0) * top_percent
-
-        pix = page.get_pixmap(dpi=dpi, clip=rect)
         images.append(Image.frombytes(mode="RGB", size=[pix.width, pix.height], data=pix.samples))
     
     return images
 
-def convert_pdf_to_images_multi(i, cpu, submissions_pdfs, dpi, top_percent, left_percent, crop_box, skip_pages):
-    images = []
-    segment_size = len(submissions_pdfs) // cpu
-    start = i * segment_size
-    end = (i + 1) * segment_size
-    if i == cpu - 1:
-        end = len(submissions_pdfs)
-    print(f"Process {i}: {start} to {end-1}")
-    for j in range(start, end):
-        images.append(convert_pdf_to_images(submissions_pdfs[j], dpi, top_percent, left_percent, crop_box, skip_pages))
+def render_pdf_pages(filepath, dpi, top_percent=0.25, left_percent=0.5, crop_box=None, skip_pages=(0,1,3)):
+    """
+    Yield a pixmap of the cropped region of each page of a pdf file,
+    or None for the pages in skip_pages.
 
-    return images
+    See `convert_pdf_to_images` for the meaning of the parameters.
+    """
+    with fitz.Document(filepath) as doc:
+        for page in doc:
+            if page.number in skip_pages:
+                yield None
+                continue
+            rect = page.rect  # the page rectangle
 
-def multiprocessed_pdf_conversion(vectors):
-    from multiprocessing import Pool, set_start_method
-    try:
-        set_start_method('fork', force=True)
-    except ValueError:
-        print("Forking the process failed. Trying spawn.")
-        set_start_method('spawn', force=True)
-    
-    pool = Pool()
-    print("Pool initialized")
-    results = pool.starmap(convert_pdf_to_images_multi, vectors)
-    pool.close()
-    pool.join()
-    print("Done")
+            if crop_box is not None and page.number in crop_box:
+                x_perc = float(crop_box[page.number]["x"])
+                y_perc = float(crop_box[page.number]["y"])
+                w_perc = float(crop_box[page.number]["width"])
+                h_perc = float(crop_box[page.number]["height"])
+                page_width = rect.x1 - rect.x0
+                page_height = rect.y1 - rect.y0
+                rect.x0 = rect.x0 + x_perc * page_width / 100
+                rect.y0 = rect.y0 + y_perc * page_height / 100
+                rect.x1 = rect.x0 + w_perc * page_width / 100
+                rect.y1 = rect.y0 + h_perc * page_height / 100
+            else:
+                rect.x1 = rect.x0 + (rect.x1 - rect.x0) * left_percent
+                rect.y1 = rect.y0 + (rect.y1 - rect.y0) * top_percent
 
-    images = []
+            yield page.get_pixmap(dpi=dpi, clip=rect)
+
+def convert_pdf_to_arrays(filepath, dpi, top_percent=0.25, left_percent=0.5, crop_box=None, skip_pages=(0,1,3)):
+    """
+    Same as `convert_pdf_to_images`, but return the images as 
+    uint8 arrays of shape (height, width, 3), which are much cheaper
+    to send between processes than PIL images.
+    """
+    arrays = []
+    for pix in render_pdf_pages(filepath, dpi, top_percent, left_percent, crop_box, skip_pages):
+        if pix is None:
+            arrays.append(None)
+            continue
+        arrays.append(
+            np.frombuffer(pix.samples, dtype=np.uint8)
+            .reshape(pix.height, pix.width, pix.n))
+    return arrays
+
+def get_crop_fractions(page_number, top_percent=0.25, left_percent=0.5, crop_box=None):
+    """
+    Return the region of a page that is used for classification,
+    as fractions (left, top, right, bottom) of the page size.
+
+    The region is the same as the one used by `convert_pdf_to_images`.
+    """
+    if crop_box is not None and page_number in crop_box:
+        x_frac = float(crop_box[page_number]["x"]) / 100
+        y_frac = float(crop_box[page_number]["y"]) / 100
+        w_frac = float(crop_box[page_number]["width"]) / 100
+        h_frac = float(crop_box[page_number]["height"]) / 100
+        return (x_frac, y_frac, x_frac + w_frac, y_frac + h_frac)
+    return (0, 0, left_percent, top_percent)
+
+def crop_page_image(image, fractions, scale=1.0):
+    """
+    Crop a rendered page image to the region given as fractions
+    of the page size and optionally rescale it.
+
+    Parameters
+    ----------
+    image : PIL.Image
+        The image of the full page.
+    fractions : tuple
+        The region (left, top, right, bottom) as returned by `get_crop_fractions`.
+    scale : float
+        The factor to resize the cropped image by, e.g. to go 
+        from the dpi of the image to a lower dpi.
+
+    Returns
+    -------
+    image : PIL.Image
+        The cropped RGB image.
+    """
+    width, height = image.size
+    left, top, right, bottom = fractions
+    box = (
+        round(left * width),
+        round(top * height),
+        round(min(right, 1) * width),
+        round(min(bottom, 1) * height),
+    )
+    cropped = image.crop(box)
+    if scale != 1.0:
+        cropped = cropped.resize(
+            (max(1, round(cropped.width * scale)), max(1, round(cropped.height * scale))),
+            Image.Resampling.LANCZOS)
+    return cropped.convert("RGB")
+
+_pool = None
+
+def get_pool():
+    """
+    Return the process pool shared by the pdf conversions of this process.
+
+    The pool is created on first use and reused afterwards, so that
+    the workers are not forked again on every call. The workers never
+    touch the database, so forking is used where available, without
+    changing the global start method.
+    """
+    global _pool
+    if _pool is None:
+        import atexit
+        from multiprocessing import get_all_start_methods, get_context
+        start_method = "fork" if "fork" in get_all_start_methods() else None
+        _pool = get_context(start_method).Pool()
+        atexit.register(close_pool)
+    return _pool
+
+def close_pool():
+    global _pool
+    if _pool is not None:
+        _pool.terminate()
+        _pool = None
+
+def _convert_pdf_chunk(args):
+    pdf_idxs, pdf_paths, dpi, top_percent, left_percent, crop_box, skip_pages = args
+    return [
+        (pdf_idx, convert_pdf_to_arrays(pdf_path, dpi, top_percent, left_percent, crop_box, skip_pages))
+        for pdf_idx, pdf_path in zip(pdf_idxs, pdf_paths)
+    ]
+
+def balance_pdf_chunks(submissions_pdfs, skip_pages=(), pages_per_chunk=None):
+    """
+    Group the pdfs in chunks with roughly the same number of pages to render.
+
+    The pdfs are taken from the largest to the smallest, so that a few
+    long pdfs do not end up in the last chunk and delay the whole conversion.
+    By default, the chunks are sized so that each worker of the pool
+    gets about four chunks.
+
+    Returns
+    -------
+    chunks : list
+        A list of lists of indices in submissions_pdfs.
+    """
+    from multiprocessing import cpu_count
+    n_pages = []
+    for pdf_path in submissions_pdfs:
+        with fitz.Document(pdf_path) as doc:
+            n_pages.append(sum(1 for p in range(doc.page_count) if p not in skip_pages))
+    if pages_per_chunk is None:
+        pages_per_chunk = max(1, sum(n_pages) // (4 * cpu_count()))
+
+    chunks = []
+    chunk, chunk_pages = [], 0
+    for pdf_idx in sorted(range(len(submissions_pdfs)), key=lambda i: -n_pages[i]):
+        chunk.append(pdf_idx)
+        chunk_pages += n_pages[pdf_idx]
+        if chunk_pages >= pages_per_chunk:
+            chunks.append(chunk)
+            chunk, chunk_pages = [], 0
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+def stream_pdf_conversion(submissions_pdfs, dpi, top_percent=0.25, left_percent=0.5, crop_box=None, skip_pages=(0,1,3), pages_per_chunk=None):
+    """
+    Convert the pdfs to images in the shared process pool and
+    yield the results as soon as each chunk is done.
+
+    Yields
+    ------
+    pdf_idx, images : int, list
+        The index of the pdf in submissions_pdfs and the output of 
+        `convert_pdf_to_arrays` for it. The pdfs are yielded in the
+        order they finish, not in the order of submissions_pdfs.
+    """
+    chunks = balance_pdf_chunks(submissions_pdfs, skip_pages, pages_per_chunk)
+    tasks = [
+        (chunk, [submissions_pdfs[i] for i in chunk], dpi, top_percent, left_percent, crop_box, skip_pages)
+        for chunk in chunks
+    ]
+    if len(tasks) <= 1:
+        results = map(_convert_pdf_chunk, tasks)
+    else:
+        results = get_pool().imap_unordered(_convert_pdf_chunk, tasks)
     for result in results:
-        images.extend(result)
+        yield from result
+
+def multiprocessed_pdf_conversion(submissions_pdfs, dpi, top_percent=0.25, left_percent=0.5, crop_box=None, skip_pages=(0,1,3)):
+    """
+    Convert the pdfs to images in the shared process pool.
+
+    Returns
+    -------
+    images : list
+        The output of `convert_pdf_to_arrays` for each pdf,
+        in the order of submissions_pdfs.
+    """
+    images = [None] * len(submissions_pdfs)
+    for pdf_idx, pdf_images in stream_pdf_conversion(
+            submissions_pdfs, dpi, top_percent, left_percent, crop_box, skip_pages):
+        images[pdf_idx] = pdf_images
+    print("Done")
+
+    return images
+
+def split_pdf_submissions(pdf_path, submission_indices, num_pages_per_submission, dpi):
+    """
+    Split the submissions with the given indices out of the pdf file
+    and render each of their pages to a PNG.
+
+    Runs in a worker process, so it only deals with paths and bytes
+    and never touches the database.
+
+    Parameters
+    ----------
+    pdf_path : str
+        The path to the combined pdf file.
+    submission_indices : range
+        The 0-indexed submissions to split out of the pdf.
+    num_pages_per_submission : int
+        The number of consecutive pages that make up a submission.
+    dpi : int
+        The dpi of the rendered page images.
+
+    Returns
+    -------
+    split : list
+        A list of tuples (submission_idx, pdf_bytes, page_png_bytes, 
+        page_fingerprints), where page_png_bytes and page_fingerprints
+        have one entry per page of the submission. The fingerprints are
+        computed by `submissions.fingerprint.page_fingerprint`.
+    """
+    split = []
+    doc = fitz.Document(pdf_path)
+    for i in submission_indices:
+        start_page = i * num_pages_per_submission
+        end_page = (i + 1) * num_pages_per_submission - 1
+        doc_new = fitz.Document()
+        doc_new.insert_pdf(doc, from_page=start_page, to_page=end_page)
+        pages_png = []
+        pages_fingerprint = []
+        for page_num in range(start_page, end_page + 1):
+            pix = doc.load_page(page_num).get_pixmap(dpi=dpi)
+            pages_png.append(pix.tobytes())
+            pages_fingerprint.append(page_fingerprint(
+                np.frombuffer(pix.samples, dtype=np.uint8)
+                .reshape(pix.height, pix.width, pix.n)))
+        split.append((i, doc_new.tobytes(), pages_png, pages_fingerprint))
+        doc_new.close()
+    doc.close()
+
+    return split
+
+def _split_pdf_submissions_star(args):
+    return split_pdf_submissions(*args)
+
+def multiprocessed_pdf_split(
+    pdf_path,
+    n_submissions,
+    num_pages_per_submission,
+    dpi,
+    submissions_per_chunk=8,
+    processes=None):
+    """
+    Split a combined pdf into submissions using the shared process pool.
+
+    The submissions are divided in chunks of `submissions_per_chunk`
+    and the chunks are yielded in order as soon as they are ready,
+    so that the caller can save them while the rest are still rendered.
+    Small files, or all files if processes is 1, are split in the
+    current process.
+
+    Yields
+    ------
+    split : list
+        The output of `split_pdf_submissions` for one chunk.
+    """
+    chunks = [
+        (pdf_path, range(start, min(start + submissions_per_chunk, n_submissions)),
+         num_pages_per_submission, dpi)
+        for start in range(0, n_submissions, submissions_per_chunk)
+    ]
+    if len(chunks) <= 1 or processes == 1:
+        yield from map(_split_pdf_submissions_star, chunks)
+        return
 
-    return images
\ No newline at end of file
+    yield from get_pool().imap(_split_pdf_submissions_star, chunks)
\ No newline at end of file
@@ -1,3 +1,5 @@
+import os
+
 import cv2
 import numpy as np
 import pandas as pd
@@ -113,20 +115,10 @@ def remove_lines_img(
     return invert_final , (low, high)
 
 def import_students_from_db(course):
-    student_info = []
-    for student in course.get_students():
-        student_info.append(
-            {"Student": f"{student.last_name}, {student.first_name}",
-            "SIS User ID": student.uni_id,
-            })
-
-    df_ids = pd.DataFrame(student_info, columns=["Student", "SIS User ID"])
-    # skip rows where SIS User ID is not an integer of length UFID_LENGTH
-    # first keep the rows where SIS User ID is an integer
-    df_ids = df_ids[df_ids["SIS User ID"].apply(lambda x: str(x).isnumeric())]
-    
-    # then keep the rows where SIS User ID is of length UFID_LENGTH
-    df_ids = df_ids[df_ids["SIS User ID"].apply(lambda x: len(str(x)) == UFID_LENGTH)]
+    """Return the students of the course with a valid University ID,
+    from the cached roster of the course."""
+    from students.roster import get_course_roster
+    df_ids = get_course_roster(course).to_dataframe()
     print(f"Found {len(df_ids)} students with valid University IDs.")
         
     return df_ids
@@ -136,14 +128,37 @@ def import_tf_model(model_path):
     model = tf.keras.models.load_model(model_path)
     return model
 
-def import_onnx_model(model_path):
+# ONNX sessions created in this process, see import_onnx_model
+_onnx_sessions = {}
+
+def import_onnx_model(model_path, intra_op_num_threads=4):
+    """Return the ONNX session of the model with its input and output names.
+
+    Creating a session is much slower than running the small digits model,
+    so the session is created once per process and reused by later calls
+    (it is created again if the model file changes). The model works on
+    batches of 28x28 images, for which a few intra-op threads are faster
+    than one thread per core.
+    """
     import onnxruntime as rt
-    sess = rt.InferenceSession(model_path)
-    input_name = sess.get_inputs()[0].name
-    output_name = sess.get_outputs()[0].name
-    # print(f"ONNX model Input name: {input_name}")
-    # print(f"ONNX model Output name: {output_name}")
-    return sess, input_name, output_name
+    key = (model_path, os.path.getmtime(model_path), intra_op_num_threads)
+    if key not in _onnx_sessions:
+        options = rt.SessionOptions()
+        options.intra_op_num_threads = min(intra_op_num_threads, os.cpu_count() or 1)
+        options.inter_op_num_threads = 1
+        options.execution_mode = rt.ExecutionMode.ORT_SEQUENTIAL
+        options.graph_optimization_level = rt.GraphOptimizationLevel.ORT_ENABLE_ALL
+        sess = rt.InferenceSession(
+            model_path, 
+            sess_options=options, 
+            providers=["CPUExecutionProvider"])
+        input_name = sess.get_inputs()[0].name
+        output_name = sess.get_outputs()[0].name
+        # print(f"ONNX model Input name: {input_name}")
+        # print(f"ONNX model Output name: {output_name}")
+        _onnx_sessions.clear()
+        _onnx_sessions[key] = (sess, input_name, output_name)
+    return _onnx_sessions[key]
 
 def apply_scale_rotate(img, scale, angle):
     """Apply scale and rotation to image"""
@@ -263,22 +278,56 @@ def extract_digit_boxes_from_img_new(
     assert image_i.dtype==np.uint8
     return digits
 
-def get_all_digits_new(
+def _extract_page_digits(args):
+    key, page, dpi = args
+    # the pages are already spread over the processes
+    cv2.setNumThreads(1)
+    return key, extract_digit_boxes_from_img_new(np.asarray(page), dpi=dpi)
+
+def iter_all_digits(
     quizzes_img_list,
     dpi,
     pages_to_skip=[0,1,3],
+    processes=None,
+    chunksize=4,
+    progress_callback=None,
     ):
-    digits = {}
-    for idx_submission, submission in enumerate(quizzes_img_list):
-        for idx_page, page in enumerate(submission):
-            if idx_page in pages_to_skip:
-                continue
-            digits_extracted = extract_digit_boxes_from_img_new(
-                np.array(page), 
-                dpi=dpi)
+    """Extract the digit boxes of every page using the shared process pool.
 
-            digits[idx_submission, idx_page] = digits_extracted
-    return digits
+    Yields ((idx_submission, idx_page), digit boxes) as soon as each 
+    page is done, in no particular order, so that the digits can be
+    classified while the rest of the pages are still being extracted.
+    If processes is 1, the pages are extracted in the current process.
+    If given, progress_callback(n_done, n_total) is called after each page.
+    """
+    tasks = [
+        ((idx_submission, idx_page), page, dpi)
+        for idx_submission, submission in enumerate(quizzes_img_list)
+        for idx_page, page in enumerate(submission)
+        if idx_page not in pages_to_skip and page is not None
+    ]
+    if processes == 1 or len(tasks) <= 1:
+        pages_digits = map(_extract_page_digits, tasks)
+    else:
+        from submissions.convert import get_pool
+        pages_digits = get_pool().imap_unordered(_extract_page_digits, tasks, chunksize=chunksize)
+    for n_done, page_digits in enumerate(pages_digits, start=1):
+        if progress_callback is not None:
+            progress_callback(n_done, len(tasks))
+        yield page_digits
+
+def get_all_digits_new(
+    quizzes_img_list,
+    dpi,
+    pages_to_skip=[0,1,3],
+    processes=None,
+    ):
+    digits = dict(iter_all_digits(
+        quizzes_img_list, 
+        dpi, 
+        pages_to_skip=pages_to_skip, 
+        processes=processes))
+    return dict(sorted(digits.items()))
 
 def resize_keep_aspect(img, size):
 
@@ -439,90 +488,212 @@ def preprocess_digits(digits_img_list, **kwargs):
     return preprocessed_digits
 
 
-def get_predicted_labels(predictions, df_ids, found_digits):
-    max_probability = 0 
+def get_roster_digits(df_ids):
+    """Return the University IDs in df_ids as an integer array of 
+    shape (N_students, UFID_LENGTH), one digit per column.
+
+    The array only depends on the roster, so it should be computed 
+    once and reused for all the pages that are matched against it.
+    """
+    ufids = "".join(df_ids["SIS User ID"].astype(str))
+    digits = np.frombuffer(ufids.encode("ascii"), dtype=np.uint8) - ord("0")
+    return digits.reshape(-1, UFID_LENGTH).astype(np.intp)
+
+
+def score_ufids(predictions, roster_digits):
+    """Return the log-probability of every University ID in the roster.
+
+    predictions has shape (..., UFID_LENGTH, 10) with the probability
+    of each digit at each position, and the result has shape 
+    (..., N_students). The probability of a University ID is the 
+    product of the probabilities of its digits, so its log is a 
+    gather followed by a sum over the positions.
+    """
+    with np.errstate(divide="ignore"):
+        log_probs = np.log(predictions)
+    return log_probs[..., np.arange(UFID_LENGTH), roster_digits].sum(axis=-1)
+
+
+def match_ufids(predictions, roster_digits, top_k=3, batch_size=256):
+    """Match a batch of pages against the roster.
+
+    Parameters
+    ----------
+    predictions : array
+        The digit probabilities of each page, of shape 
+        (N_pages, UFID_LENGTH, 10).
+    roster_digits : array
+        The output of `get_roster_digits`.
+    top_k : int
+        The number of candidates to return for each page.
+    batch_size : int
+        The number of pages scored at once, which bounds the memory
+        used to N_pages * N_students * UFID_LENGTH floats per batch.
+
+    Returns
+    -------
+    candidates : array
+        The roster indices of the best candidates of each page, 
+        from best to worst, of shape (N_pages, top_k).
+    probabilities : array
+        The probabilities of the candidates, of shape (N_pages, top_k).
+    margins : array
+        The difference in log-probability between the first and 
+        second candidates of each page, of shape (N_pages,).
+    """
+    predictions = np.asarray(predictions, dtype=np.float64)
+    n_pages = len(predictions)
+    top_k = min(top_k, len(roster_digits))
+    candidates = np.zeros((n_pages, top_k), dtype=np.intp)
+    log_probs = np.full((n_pages, top_k), -np.inf)
+    for start in range(0, n_pages, batch_size):
+        scores = score_ufids(predictions[start:start+batch_size], roster_digits)
+        if top_k < scores.shape[1]:
+            top = np.argpartition(-scores, top_k - 1, axis=1)[:, :top_k]
+        else:
+            top = np.broadcast_to(np.arange(top_k), (len(scores), top_k))
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        # stable sort so that ties keep the roster order
+        order = np.argsort(-top_scores, axis=1, kind="stable")
+        candidates[start:start+batch_size] = np.take_along_axis(top, order, axis=1)
+        log_probs[start:start+batch_size] = np.take_along_axis(top_scores, order, axis=1)
+    if top_k > 1:
+        with np.errstate(invalid="ignore"):
+            margins = log_probs[:, 0] - log_probs[:, 1]
+    else:
+        margins = np.full(n_pages, np.inf)
+    return candidates, np.exp(log_probs), margins
+
+
+def get_predicted_labels(predictions, df_ids, found_digits, roster_digits=None):
+    if roster_digits is None:
+        roster_digits = get_roster_digits(df_ids)
     predicted_ufid = -1
     predicted_student = ""
-    for ufid in df_ids["SIS User ID"]:
-        # if ufid in found_digits.keys():
-        #     continue
-        digit_probs = [
-            predictions[i][int(x)] for i, x in enumerate(str(ufid))
-            ]
-        prob_ufid = np.prod(digit_probs)
-        # if prob_ufid > 0: 
-            # print(f"{ufid}: {prob_ufid} "
-            #     f"{df_ids[df_ids['SIS User ID']==ufid]['Student'].values[0]}")
-        if prob_ufid > max_probability:
-            max_probability = prob_ufid
-            predicted_ufid = ufid
+    if len(roster_digits) == 0:
+        return predicted_ufid, predicted_student, 0
+    candidates, probabilities, _ = match_ufids(
+        predictions[np.newaxis], roster_digits, top_k=1)
+    max_probability = probabilities[0, 0]
     if max_probability > 0: 
-        predicted_student = df_ids[df_ids['SIS User ID']==predicted_ufid]['Student'].values[0]
-    else:
-        pass
-        # print("No match found")   
+        predicted_ufid = df_ids["SIS User ID"].iloc[candidates[0, 0]]
+        predicted_student = df_ids["Student"].iloc[candidates[0, 0]]
     return predicted_ufid, predicted_student, max_probability
 
 
-def get_all_ufids(digit_imgs, df_ids, model, len_subs):
+MORPH_LIST = [None,"dilate", "erode", cv2.MORPH_OPEN, cv2.MORPH_CLOSE, cv2.MORPH_GRADIENT,cv2.MORPH_TOPHAT,cv2.MORPH_BLACKHAT]
+
+def predict_digits(model, digits_processed, batch_size=64):
+    """Run the model on the preprocessed digits of many pages.
+
+    digits_processed is a list with the output of `preprocess_digits` 
+    for each page. The pages are sent to the model in batches of 
+    batch_size pages, and the predictions are returned as an array 
+    of shape (N_pages, UFID_LENGTH, 10).
+    """
+    predictions = []
+    for start in range(0, len(digits_processed), batch_size):
+        batch = np.concatenate(digits_processed[start:start+batch_size])
+        if isinstance(model, dict):
+            sess = model["sess"]
+            input_name = model["input_name"]
+            output_name = model["output_name"]
+            batch_predictions = sess.run(
+                [output_name], 
+                {input_name: batch})[0]
+        else:
+            batch_predictions = model.predict(batch)
+        predictions.append(
+            np.asarray(batch_predictions).reshape(-1, UFID_LENGTH, 10))
+    if not predictions:
+        return np.zeros((0, UFID_LENGTH, 10), dtype=np.float32)
+    return np.concatenate(predictions)
+
+
+def get_all_ufids(digit_imgs, df_ids, model, len_subs, batch_size=64, roster_digits=None):
+    """Identify the University ID written on each page.
+
+    digit_imgs is either the output of `get_all_digits_new` or an
+    iterable like `iter_all_digits`, which lets the first round start
+    before all the digits are extracted.
+
+    The pages are processed in rounds, one for each morphological 
+    operation of MORPH_LIST: each round preprocesses the digits of the
+    pages that were not identified yet, runs them through the model in
+    batches of batch_size pages and matches all of them against the 
+    roster at once. As before, a page is identified by the first 
+    operation whose best match is above detection_cutoff, and the 
+    other pages keep the match of the last operation that was tried.
+
+    roster_digits is the output of `get_roster_digits` for df_ids, e.g.
+    the digits of a cached `CourseRoster`; it is computed if not given.
+    """
     found_digits = []
     docs_classified = {}
-    morph_list = [None,"dilate", "erode", cv2.MORPH_OPEN, cv2.MORPH_CLOSE, cv2.MORPH_GRADIENT,cv2.MORPH_TOPHAT,cv2.MORPH_BLACKHAT]
     # TODO: add morphological elements to preprocess_digits
     morph_elements = []
     detection_cutoff = 1E3 * 0.1**UFID_LENGTH
-    # import matplotlib.pyplot as plt
-    # import matplotlib
-    # matplotlib.use('TKAgg')
-    for submission_idx, page_idx in digit_imgs.keys():
-        digits_img_list = digit_imgs[(submission_idx, page_idx)]
-        
-        max_probability = 0
-        for morph in morph_list:
-            if digits_img_list is None:
-                break
-            
-            digits_processed = preprocess_digits(digits_img_list, morph=morph)
-            
-            if digits_processed is None:
+    if roster_digits is None:
+        roster_digits = get_roster_digits(df_ids)
+    # (submission_idx, page_idx) -> (max_probability, predicted_ufid, predicted_student)
+    page_matches = {}
+
+    def identify_pages(pending, morph):
+        """Match the pending pages using morph and return the ones 
+        that are still not identified."""
+        if not pending or len(roster_digits) == 0:
+            return pending
+        keys = []
+        digits_processed = []
+        for key in pending:
+            page_digits = preprocess_digits(digit_imgs[key], morph=morph)
+            if page_digits is None:
                 continue
-            
-            if isinstance(model, dict):
-                sess = model["sess"]
-                input_name = model["input_name"]
-                output_name = model["output_name"]
-                predictions = sess.run(
-                    [output_name], 
-                    {input_name: np.stack(digits_processed)})[0]
+            keys.append(key)
+            digits_processed.append(page_digits)
+        predictions = predict_digits(model, digits_processed, batch_size=batch_size)
+        candidates, probabilities, _ = match_ufids(predictions, roster_digits, top_k=1)
+
+        identified = set()
+        for key, candidate, max_probability in zip(keys, candidates[:, 0], probabilities[:, 0]):
+            if max_probability > 0:
+                predicted_ufid = df_ids["SIS User ID"].iloc[candidate]
+                predicted_student = df_ids["Student"].iloc[candidate]
             else:
-                predictions = model.predict(
-                    np.stack(digits_processed)
-                    )
-            # for digit_idx in range(len(digits_processed)):
-            #     print(predictions[digit_idx])
-            #     plt.imshow(digits_processed[digit_idx])
-            #     plt.show()
-            predicted_ufid, predicted_student, max_probability = get_predicted_labels(predictions, df_ids, found_digits)
-            # print(f"{submission_idx},{page_idx}\t Got {predicted_ufid}: {max_probability} {predicted_student}", end="\r")
+                predicted_ufid, predicted_student = -1, ""
+            page_matches[key] = (max_probability, predicted_ufid, predicted_student)
+            # print(f"{key}\t Got {predicted_ufid}: {max_probability} {predicted_student}", end="\r")
             if max_probability >= detection_cutoff:
+                submission_idx = key[0]
                 if submission_idx in docs_classified.keys():
                     # docs_classified is used to check that there are no conflicting predictions
                     assert docs_classified[submission_idx] == (predicted_ufid, predicted_student)
                 else:
                     docs_classified[submission_idx] = (predicted_ufid, predicted_student)
-                break
-            # elif morph is None:
-            #     plt.imshow(quizzes_img_list[submission_idx][page_idx])
-            #     plt.show()
-            #     for digit_idx in range(len(digits_processed)):
-            #         pass
-            #         # print()
-            #         print(predictions[digit_idx])
-            #         plt.imshow(digits_processed[digit_idx])
-            #         plt.show()
+                identified.add(key)
+        return [key for key in pending if key not in identified]
+
+    # the first round runs while the digits are being extracted,
+    # as soon as batch_size pages are available
+    pages_stream = digit_imgs.items() if isinstance(digit_imgs, dict) else digit_imgs
+    digit_imgs = {}
+    pending = []
+    new_pages = []
+    for key, digits_img_list in pages_stream:
+        digit_imgs[key] = digits_img_list
+        if digits_img_list is not None:
+            new_pages.append(key)
+        if len(new_pages) == batch_size:
+            pending += identify_pages(new_pages, MORPH_LIST[0])
+            new_pages = []
+    pending += identify_pages(new_pages, MORPH_LIST[0])
+    for morph in MORPH_LIST[1:]:
+        pending = identify_pages(pending, morph)
+
+    for submission_idx, page_idx in sorted(digit_imgs.keys()):
+        max_probability, predicted_ufid, predicted_student = page_matches.get(
+            (submission_idx, page_idx), (0, -1, ""))
         if max_probability == 0:
-            # plt.imshow(quizzes_img_list[submission_idx][page_idx])
-            # plt.show()
             found_digits.append(
                         [submission_idx,
                         page_idx,
@@ -550,10 +721,6 @@ def get_all_ufids(digit_imgs, df_ids, model, len_subs):
         .drop_duplicates(['doc_idx', 'page_idx'])
         .sort_values(['doc_idx', 'page_idx']))
     df_digits.to_csv("inference_digits.csv", index=False)
-    try:
-        del sess
-    except Exception:
-        pass
     return df_digits
 
 
@@ -563,18 +730,21 @@ def classify(
         img_list,
         dpi=300,
         pages_to_skip=[0,1,3],
+        progress_callback=None,
+        roster_digits=None,
         ):
 
-    print("Cropping to the digit list")
-    digit_imgs = get_all_digits_new(
+    print("Cropping to the digit list and classifying the digits")
+    digit_imgs = iter_all_digits(
         img_list, 
         dpi=dpi,
-        pages_to_skip=pages_to_skip)
-    print("Classifying the digits")
+        pages_to_skip=pages_to_skip,
+        progress_callback=progress_callback)
     df_digits = get_all_ufids(
         digit_imgs, 
         df_ids, 
         model, 
-        len_subs=len(img_list))
+        len_subs=len(img_list),
+        roster_digits=roster_digits)
 
     return df_digits
\ No newline at end of file
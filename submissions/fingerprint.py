@@ -0,0 +1,114 @@
+"""
+Perceptual fingerprints of the page images, used to group the submissions
+in versions without OCR.
+
+A fingerprint is the difference hash of the versioning region of a page:
+the region is shrunk to (hash_size + 1) x hash_size pixels and each bit
+tells whether a pixel is brighter than its right neighbour. Printed pages
+of the same version give almost the same bits even when they are scanned
+at different dpi or with handwriting on them, while different versions
+differ in about half of the bits.
+"""
+import cv2
+import numpy as np
+
+from submissions.cluster import VERSION_TEXT_REGION
+
+HASH_SIZE = 16
+
+
+def page_fingerprint(image, crop_fractions=VERSION_TEXT_REGION, hash_size=HASH_SIZE):
+    """
+    Compute the fingerprint of a page image
+    Input:
+        image: uint8 array, grayscale or RGB
+        crop_fractions: (left, top, right, bottom) fractions of the image
+            to use, or None to use the whole image
+        hash_size: the fingerprint has hash_size**2 bits
+    Output:
+        fingerprint: the bits packed in bytes
+    """
+    if crop_fractions is not None:
+        height, width = image.shape[:2]
+        left, top, right, bottom = crop_fractions
+        image = image[
+            int(height * top):int(height * bottom),
+            int(width * left):int(width * right)]
+    if image.ndim == 3 and image.shape[2] >= 3:
+        image = cv2.cvtColor(np.ascontiguousarray(image[:, :, :3]), cv2.COLOR_RGB2GRAY)
+    elif image.ndim == 3:
+        image = image[:, :, 0]
+    small = cv2.resize(image, (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA)
+    bits = small[:, 1:] > small[:, :-1]
+    return np.packbits(bits).tobytes()
+
+
+def fingerprint_bits(fingerprints):
+    """
+    Unpack a list of fingerprints of the same length
+    Output:
+        bits: (N, n_bits) float32 array of zeros and ones
+    """
+    if len(fingerprints) == 0:
+        return np.zeros((0, 0), dtype=np.float32)
+    packed = np.frombuffer(b"".join(fingerprints), dtype=np.uint8)
+    return np.unpackbits(packed.reshape(len(fingerprints), -1), axis=1).astype(np.float32)
+
+
+def hamming_distances(bits_a, bits_b):
+    """
+    Fraction of different bits between every row of bits_a and every row of bits_b,
+    computed with two matrix products instead of comparing the rows one by one
+    Output:
+        distances: (len(bits_a), len(bits_b)) array with values between 0 and 1
+    """
+    n_bits = bits_a.shape[1]
+    different = bits_a @ (1 - bits_b).T + (1 - bits_a) @ bits_b.T
+    return different / n_bits
+
+
+def perform_fingerprint_clustering(bits, eps=0.2, min_samples=2):
+    """
+    Perform DBSCAN clustering on the fingerprints
+    Input:
+        bits: unpacked fingerprints, see fingerprint_bits
+        eps: maximum fraction of different bits between neighbours
+    Output:
+        cluster_labels: labels of the clusters, -1 for the outliers
+    """
+    from sklearn.cluster import DBSCAN
+    if len(bits) == 0:
+        return np.zeros(0, dtype=int)
+    distances = hamming_distances(bits, bits)
+    dbscan = DBSCAN(eps=eps, min_samples=min_samples, metric="precomputed")
+    dbscan.fit(distances)
+    return dbscan.labels_
+
+
+def get_fingerprint_centroids(bits, cluster_labels, outlier_label=-1):
+    """
+    Compute the majority bits of each cluster
+    Output:
+        centroids: dict with the centroid of each cluster label
+    """
+    return {
+        label: (bits[cluster_labels == label].mean(axis=0) > 0.5).astype(np.float32)
+        for label in set(cluster_labels) - {outlier_label}
+    }
+
+
+def assign_to_fingerprint_centroids(bits, centroids, eps=0.2):
+    """
+    Assign each fingerprint to the closest centroid
+    Output:
+        assignments: index of the centroid of each fingerprint, or -1 if
+            all the centroids are further than eps
+        distances: distance to the assigned centroid
+    """
+    if len(centroids) == 0 or len(bits) == 0:
+        return np.full(len(bits), -1), np.ones(len(bits))
+    distances = hamming_distances(bits, np.asarray(centroids, dtype=np.float32))
+    assignments = distances.argmin(axis=1)
+    best = distances[np.arange(len(assignments)), assignments]
+    assignments[best > eps] = -1
+    return assignments, best
@@ -282,7 +282,7 @@ class StudentClassifyForm(forms.Form):
         else:
             crop_box = None
 
-        classified_submission_pks, not_classified_submission_pks = PaperSubmission.classify(
+        classified_submission_pks, not_classified_submission_pks, _ = PaperSubmission.classify(
                 assignment,
                 skip_pages=pages_to_skip,
                 crop_box=crop_box,
@@ -310,7 +310,7 @@ class SyncFromForm(forms.Form):
         assignment = self.cleaned_data['assignment']
         print("assignment: ", assignment)
 
-        assignment.sync_labeled_submissions_from_canvas()
+        return assignment.sync_labeled_submissions_from_canvas()
 
 class SyncToForm(forms.Form):
     def __init__(self,*args,**kwargs):
@@ -367,6 +367,25 @@ class SyncToForm(forms.Form):
         label="Upload submission pdf",
         help_text="Upload the submission pdf as a file attachment on the submission on canvas",
     )
+
+    # grade_sync_mode
+    grade_sync_mode = forms.ChoiceField(
+        choices=(
+            ('submission', 'Upload the grades one submission at a time'),
+            ('bulk', 'Upload all the grades and text comments with bulk requests'),
+            ),
+        initial='submission',
+        required=False,
+        help_text="Bulk requests are much faster for large classes, but the ids of the comments on canvas are not saved",
+        )
+
+    # resume
+    resume = forms.BooleanField(
+        initial=True,
+        required=False,
+        label="Skip what was already uploaded",
+        help_text="Do not upload again the grades, comments and files that were uploaded before and did not change",
+    )
     
     def clean(self):
         cleaned_data = super().clean()
@@ -381,6 +400,8 @@ class SyncToForm(forms.Form):
         comment_sync_option = self.cleaned_data['comment_sync_option']
         grade_summary_sync_option = self.cleaned_data['grade_summary_sync_option']
         submission_pdf_sync_option = self.cleaned_data['submission_pdf_sync_option']
+        resume = self.cleaned_data['resume']
+        grade_sync_mode = self.cleaned_data['grade_sync_mode'] or 'submission'
         # if submission_sync_option is 'specific', get the specific
         # paper submissions from the cleaned_data
         if submission_sync_option == 'specific':
@@ -394,12 +415,14 @@ class SyncToForm(forms.Form):
         print("submission_pdf_sync_option: ", submission_pdf_sync_option)
         print("specific_submissions: ", specific_submissions)
 
-        assignment.upload_graded_submissions_to_canvas(
+        return assignment.upload_graded_submissions_to_canvas(
             submission_sync_option=submission_sync_option,
             comment_sync_option=comment_sync_option,
             grade_summary_sync_option=grade_summary_sync_option,
             submission_pdf_sync_option=submission_pdf_sync_option,
             request_user=self.request_user,
             specific_submissions=specific_submissions,
+            resume=resume,
+            grade_sync_mode=grade_sync_mode,
         )
             
\ No newline at end of file
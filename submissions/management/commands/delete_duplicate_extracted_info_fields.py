@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Count, F
+from django.db.models.expressions import RawSQL
+
+from submissions.models import ExtractedInfoField
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete the duplicate extracted info fields of each image, keeping the newest, "
+        "so that the unique constraint on (info_field, paper_submission_image) can be applied"
+    )
+
+    def handle(self, *args, **options):
+        table = ExtractedInfoField._meta.db_table
+        if table not in connection.introspection.table_names():
+            self.stdout.write("No extracted info fields to deduplicate")
+            return
+        if connection.vendor == "sqlite":
+            # the rowids follow the order in which the rows were inserted
+            insertion_order = RawSQL(f'"{table}".rowid', [])
+        else:
+            # the fields have no creation date, keep any of the duplicates
+            insertion_order = F("pk")
+
+        duplicates = (ExtractedInfoField.objects
+                      .filter(info_field__isnull=False)
+                      .values("info_field", "paper_submission_image")
+                      .annotate(n_fields=Count("pk"))
+                      .filter(n_fields__gt=1))
+        to_delete = []
+        for duplicate in duplicates:
+            pks = (ExtractedInfoField.objects
+                   .filter(
+                       info_field=duplicate["info_field"],
+                       paper_submission_image=duplicate["paper_submission_image"])
+                   .annotate(insertion_order=insertion_order)
+                   .order_by("-insertion_order")
+                   .values_list("pk", flat=True))
+            to_delete += list(pks)[1:]
+        with transaction.atomic():
+            for i in range(0, len(to_delete), 500):
+                ExtractedInfoField.objects.filter(pk__in=to_delete[i:i + 500]).delete()
+        self.stdout.write(f"Deleted {len(to_delete)} duplicate extracted info field(s)")
@@ -0,0 +1,50 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from submissions.models import PaperSubmission, QuestionGrade
+
+
+class Command(BaseCommand):
+    help = "Write the QuestionGrade rows of the paper submissions from their question_grades"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--assignment",
+            help="Only sync the submissions of this assignment",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=500,
+            help="Number of submissions written per transaction",
+        )
+        parser.add_argument(
+            "--missing",
+            action="store_true",
+            help="Only sync the graded submissions that have no QuestionGrade rows yet",
+        )
+
+    def handle(self, *args, **options):
+        submissions = PaperSubmission.objects.only("pk", "question_grades").order_by("pk")
+        if options["assignment"]:
+            submissions = submissions.filter(assignment=options["assignment"])
+        if options["missing"]:
+            submissions = (submissions
+                           .exclude(question_grades__isnull=True)
+                           .exclude(question_grades="")
+                           .filter(submissions_questiongrades__isnull=True))
+        batch_size = options["batch_size"]
+        n_submissions = 0
+        batch = []
+        for submission in submissions.iterator(chunk_size=batch_size):
+            batch.append(submission)
+            if len(batch) == batch_size:
+                with transaction.atomic():
+                    QuestionGrade.sync(batch)
+                n_submissions += len(batch)
+                batch = []
+        if batch:
+            with transaction.atomic():
+                QuestionGrade.sync(batch)
+            n_submissions += len(batch)
+        self.stdout.write(f"Synced the question grades of {n_submissions} submission(s)")
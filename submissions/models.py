@@ -1,34 +1,52 @@
+import hashlib
+import json
 import math
 import os
 import random
 import string
 import uuid
+from collections import defaultdict
+from contextlib import nullcontext
+
 import numpy as np
+import pandas as pd
 
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError
 from django.core.files.base import ContentFile
-from django.db import models
+from django.db import models, transaction
 from django.forms.models import model_to_dict
-from django.db.models import Max, Q
+from django.db.models import Max, Prefetch, Q, Sum
 from django.urls import reverse
 from django.utils import timezone
 from PIL import Image
 
-from assignments.models import Assignment, Version
+from assignments.models import Assignment, Version, VersioningState
 from assignments.utils import delete_versions
 from students.models import Student
-from submissions.digits_classify import (classify, import_students_from_db,
-                                         import_onnx_model)
+from students.roster import get_course_roster
+from submissions.digits_classify import classify, import_onnx_model
 from submissions.utils import (CommaSeparatedFloatField, get_quiz_pdf_path, 
-                               open_UploadedFile_as_PDF, submission_image_upload_to,
-                               submission_upload_to)
-from submissions.convert import (convert_pdf_to_images, 
-                                 multiprocessed_pdf_conversion)
-from submissions.cluster import (images_to_text,
-                                 perform_dbscan_clustering,
-                                 vectorize_texts)
+                               UploadedFile_on_disk, get_stage_progress_callback,
+                               submission_crop_cache_path,
+                               submission_image_upload_to, submission_upload_to)
+from submissions.convert import (convert_pdf_to_images, crop_page_image,
+                                 get_crop_fractions,
+                                 multiprocessed_pdf_conversion,
+                                 multiprocessed_pdf_split,
+                                 stream_pdf_conversion)
+from submissions.cluster import (OCR_CHAR_SET, VERSION_TEXT_REGION,
+                                 assign_to_centroids, fit_text_vectorizer,
+                                 get_cluster_centroids,
+                                 group_texts_by_submission,
+                                 load_text_vectorizer, ocr_images,
+                                 perform_dbscan_clustering)
+from submissions.fingerprint import (assign_to_fingerprint_centroids,
+                                     fingerprint_bits,
+                                     get_fingerprint_centroids,
+                                     page_fingerprint,
+                                     perform_fingerprint_clustering)
 
 
 class Submission(models.Model):
@@ -236,6 +254,29 @@ class PaperSubmission(Submission):
     class Meta:
         verbose_name_plural = "Paper Submissions" 
         ordering = ["created"] 
+        indexes = [
+            # used by the cursor pagination of the submissions of an assignment
+            models.Index(fields=["assignment", "created", "id"], name="papersub_assignment_cursor"),
+        ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # remember the saved question grades, so that the QuestionGrade
+        # rows are written again only when they change
+        instance._saved_question_grades = instance.__dict__.get("question_grades")
+        return instance
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get("update_fields")
+        sync_question_grades = (
+            (update_fields is None or "question_grades" in update_fields)
+            and self.question_grades != getattr(self, "_saved_question_grades", None))
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if sync_question_grades:
+                QuestionGrade.sync([self])
+        self._saved_question_grades = self.question_grades
 
     def non_grade_comments(self, include_file_comments=True):
         """get all the comments that have is_grade_summary=False
@@ -276,14 +317,96 @@ class PaperSubmission(Submission):
     # @profile
     @classmethod
     def get_images_for_classify_multi(cls, assignment, dpi, top_percent=0.25, left_percent=0.5, crop_box=None, skip_pages=(0,1,3)):
-        from multiprocessing import cpu_count
-        cpu = cpu_count()
         submissions = PaperSubmission.objects.filter(assignment=assignment)
         submissions_pdfs = [sub.pdf.path for sub in submissions]
-        vectors = [(i, cpu, submissions_pdfs, dpi, top_percent, left_percent, crop_box, skip_pages) for i in range(cpu)]
         
         print("%i submissions..." % (len(submissions)))
-        images = multiprocessed_pdf_conversion(vectors)
+        images = multiprocessed_pdf_conversion(submissions_pdfs, dpi, top_percent, left_percent, crop_box, skip_pages)
+
+        len_images = [len(imgs) for imgs in images]
+        image_sub_pks = [[sub.pk for i in range(len_imgs_sub)] for sub, len_imgs_sub in zip(submissions, len_images)]
+
+        return images, image_sub_pks
+
+    @classmethod
+    def get_images_for_classify_stored(cls, assignment, dpi, top_percent=0.25, left_percent=0.5, crop_box=None, skip_pages=(0,1,3), cache_crops=True, progress_callback=None):
+        """
+        Return the same images as `get_images_for_classify_multi`, but crop
+        them from the page images stored at upload time instead of
+        rendering the pdfs again.
+
+        Pages whose stored image has a lower dpi than `dpi` are still
+        rendered from the pdf. If `cache_crops` is True, these crops are
+        saved next to the stored images, so that each page is rendered
+        at most once per dpi and crop region.
+
+        If given, progress_callback(n_done, n_total) is called with the
+        number of submissions whose images are ready.
+
+        The images are returned as uint8 arrays of shape (height, width, 3).
+        """
+        submissions = list(PaperSubmission.objects.filter(assignment=assignment))
+        sub_images = defaultdict(dict)
+        for sub_image in (PaperSubmissionImage.objects
+                          .filter(submission__assignment=assignment)
+                          .select_related("submission__assignment__course")):
+            sub_images[sub_image.submission_id][sub_image.page] = sub_image
+
+        print("%i submissions..." % (len(submissions)))
+        images = []
+        # submission index -> [(page_number, submission image, crop fractions)]
+        # of the crops that need to be rendered from the pdf
+        to_render = defaultdict(list)
+        for sub_idx, submission in enumerate(submissions):
+            pages = sub_images[submission.pk]
+            if not pages:
+                to_render[sub_idx] = None
+                images.append([])
+                continue
+            sub_imgs = [None] * max(pages)
+            for page_number in range(len(sub_imgs)):
+                sub_image = pages.get(page_number + 1)
+                if page_number in skip_pages or sub_image is None:
+                    continue
+                fractions = get_crop_fractions(page_number, top_percent, left_percent, crop_box)
+                cache_path = submission_crop_cache_path(sub_image, dpi, fractions)
+                if os.path.exists(cache_path):
+                    with Image.open(cache_path) as cached_crop:
+                        sub_imgs[page_number] = np.asarray(cached_crop.convert("RGB"))
+                    continue
+                with Image.open(sub_image.image.path) as page_img:
+                    stored_dpi = round(page_img.info.get("dpi", (0,))[0])
+                    if stored_dpi >= dpi:
+                        sub_imgs[page_number] = np.asarray(crop_page_image(
+                            page_img, fractions, scale=dpi / stored_dpi))
+                        continue
+                to_render[sub_idx].append((page_number, sub_image, fractions))
+            images.append(sub_imgs)
+
+        n_done = len(submissions) - len(to_render)
+        if progress_callback is not None:
+            progress_callback(n_done, len(submissions))
+        if to_render:
+            render_idxs = list(to_render.keys())
+            submissions_pdfs = [submissions[sub_idx].pdf.path for sub_idx in render_idxs]
+            print(f"Rendering {len(submissions_pdfs)} submissions at {dpi} dpi...")
+            # the crops are saved as soon as each chunk of pdfs is rendered
+            for pdf_idx, rendered_imgs in stream_pdf_conversion(
+                    submissions_pdfs, dpi, top_percent, left_percent, crop_box, skip_pages):
+                sub_idx = render_idxs[pdf_idx]
+                if to_render[sub_idx] is None:
+                    images[sub_idx] = rendered_imgs
+                    continue
+                for page_number, sub_image, fractions in to_render[sub_idx]:
+                    crop = rendered_imgs[page_number]
+                    images[sub_idx][page_number] = crop
+                    if cache_crops and crop is not None:
+                        cache_path = submission_crop_cache_path(sub_image, dpi, fractions)
+                        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+                        Image.fromarray(crop).save(cache_path, dpi=(dpi, dpi))
+                n_done += 1
+                if progress_callback is not None:
+                    progress_callback(n_done, len(submissions))
 
         len_images = [len(imgs) for imgs in images]
         image_sub_pks = [[sub.pk for i in range(len_imgs_sub)] for sub, len_imgs_sub in zip(submissions, len_images)]
@@ -294,7 +417,45 @@ class PaperSubmission(Submission):
         return PaperSubmissionImage.objects.filter(submission=self).count()
 
     def get_extracted_fields(self):
-        return ExtractedInfoField.objects.filter(paper_submission_image__submission=self)
+        """
+        Return the fields extracted from the images of the submission. When the
+        images and their fields were prefetched with `prefetch_extracted_fields`,
+        no query is made.
+        """
+        images_cache = getattr(self, "_prefetched_objects_cache", {})
+        images = images_cache.get("submissions_papersubmissionimage_related")
+        if images is not None and all(
+            "submissions_extractedinfofield_related" in getattr(image, "_prefetched_objects_cache", {})
+            for image in images
+        ):
+            return [
+                extracted_field
+                for image in images
+                for extracted_field in image.submissions_extractedinfofield_related.all()
+            ]
+        return (
+            ExtractedInfoField.objects
+            .filter(paper_submission_image__submission=self)
+            .select_related("info_field", "paper_submission_image")
+        )
+
+    @staticmethod
+    def prefetch_extracted_fields(queryset):
+        """
+        Prefetch the images of the submissions and the fields extracted from them,
+        so that serializing a list of submissions takes a fixed number of queries.
+        """
+        return queryset.prefetch_related(
+            Prefetch(
+                "submissions_papersubmissionimage_related",
+                queryset=PaperSubmissionImage.objects.prefetch_related(
+                    Prefetch(
+                        "submissions_extractedinfofield_related",
+                        queryset=ExtractedInfoField.objects.select_related("info_field"),
+                    )
+                ),
+            ),
+        )
 
     @classmethod
     def add_papersubmissions_to_db(cls,
@@ -304,11 +465,21 @@ class PaperSubmission(Submission):
         student=None,
         quiz_number=None,
         quiz_dir_path=None,
-        uploaded_files=None):
+        uploaded_files=None,
+        submissions_per_chunk=8,
+        processes=None,
+        progress_callback=None):
         """
         This method adds paper submissions to the database.
         It also saves the pdfs and images to the media directory
         by splitting the original pdf(s) into individual submissions.
+
+        The uploads are read from disk and split in chunks of
+        `submissions_per_chunk` submissions by a pool of `processes`
+        workers. Each chunk is inserted with bulk queries as soon as
+        it is ready. If provided, `progress_callback(n_done, n_total)`
+        is called after each chunk, with each file counting as an equal
+        part of the upload.
         """
         print("assignment is:", assignment_target)
         # if uploaded files in not iterable, make it iterable
@@ -326,56 +497,82 @@ class PaperSubmission(Submission):
         for file_idx, uploaded_file in enumerate(uploaded_files):
             print(f"File {file_idx+1}/{len(uploaded_files)}: {uploaded_file} as {type(uploaded_file)}")
             if uploaded_file:
-                doc = open_UploadedFile_as_PDF(uploaded_file)
+                pdf_on_disk = UploadedFile_on_disk(uploaded_file)
             else:
-                doc = fitz.Document(get_quiz_pdf_path(quiz_number, quiz_dir_path))
-            
-            n_pages = doc.page_count
-            if student and n_pages != num_pages_per_submission:
-                raise ValueError(
-                    f"The number of pages in the pdf ({n_pages}) is "
-                    f"not equal to num_pages_per_submission ({num_pages_per_submission}).")
-            if n_pages % num_pages_per_submission != 0:
-                raise ValueError("The number of pages in the pdf is not a multiple of num_pages_per_submission.")
-            
-            n_submissions = n_pages // num_pages_per_submission
-            print(f"File metadata: {doc.metadata}")
-            for i in range(n_submissions):
-                # print on the same line the progress of the loop
-                print(f"Submission {i+1}/{n_submissions}", end="\r")
-                start_page = i * num_pages_per_submission
-                end_page = (i + 1) * num_pages_per_submission - 1
-                # we want to avoid name collisions, so we generate a random string
-                # to append to the filename
-                random_string = ''.join(random.choices(string.ascii_uppercase + string.digits, k=8))
-                pdf_filename = f'submission_batch_{file_idx}_{start_page}-{end_page}_{random_string}.pdf'
-                doc_new = fitz.Document()
-                doc_new.insert_pdf(doc, from_page=start_page, to_page=end_page)
-                doc_bytes = doc_new.tobytes()
-                django_pdf_file = ContentFile(doc_bytes, name=pdf_filename)
-                paper_submission = PaperSubmission.objects.create(
-                    assignment=assignment_target,
-                    pdf=django_pdf_file,)
-                # if student is provided, we want to associate the submission
-                # with the student
-                if student:
-                    paper_submission.student = student
-                    paper_submission.save()
-                created_submission_pks.append(paper_submission.pk)
-                for j in range(num_pages_per_submission):
-                    page = doc_new.load_page(j)
-                    img_filename = f'submission-{i}-batch-{file_idx}-page-{j+1}-{random_string}.png'
-                    pix = page.get_pixmap(dpi=dpi)
-                    pix_bytes = pix.tobytes()
-                    django_img_file = ContentFile(pix_bytes, name=img_filename)
-                    PaperSubmissionImage.objects.create(
-                        submission=paper_submission,
-                        image=django_img_file,
-                        page=j+1)
+                pdf_on_disk = nullcontext(get_quiz_pdf_path(quiz_number, quiz_dir_path))
+
+            with pdf_on_disk as pdf_path:
+                with fitz.Document(pdf_path) as doc:
+                    n_pages = doc.page_count
+                    print(f"File metadata: {doc.metadata}")
+                if student and n_pages != num_pages_per_submission:
+                    raise ValueError(
+                        f"The number of pages in the pdf ({n_pages}) is "
+                        f"not equal to num_pages_per_submission ({num_pages_per_submission}).")
+                if n_pages % num_pages_per_submission != 0:
+                    raise ValueError("The number of pages in the pdf is not a multiple of num_pages_per_submission.")
+
+                n_submissions = n_pages // num_pages_per_submission
+                file_progress_callback = get_stage_progress_callback(
+                    progress_callback, file_idx, len(uploaded_files))
+                n_done = 0
+                for split in multiprocessed_pdf_split(
+                        pdf_path,
+                        n_submissions,
+                        num_pages_per_submission,
+                        dpi,
+                        submissions_per_chunk=submissions_per_chunk,
+                        processes=processes):
+                    created_submission_pks.extend(
+                        cls._bulk_create_split_submissions(
+                            assignment_target, split, file_idx, student))
+                    n_done += len(split)
+                    # print on the same line the progress of the loop
+                    print(f"Submission {n_done}/{n_submissions}", end="\r")
+                    if file_progress_callback is not None:
+                        file_progress_callback(n_done, n_submissions)
         print(f"\nCreated {len(created_submission_pks)} submissions.")
 
         return created_submission_pks
 
+    @classmethod
+    def _bulk_create_split_submissions(cls, assignment_target, split, file_idx, student=None):
+        """
+        Insert the submissions and page images of one chunk returned by
+        `split_pdf_submissions` with one query per table.
+        """
+        paper_submissions = []
+        submission_images = []
+        for i, pdf_bytes, pages_png, pages_fingerprint in split:
+            start_page = i * len(pages_png)
+            end_page = (i + 1) * len(pages_png) - 1
+            # we want to avoid name collisions, so we generate a random string
+            # to append to the filename
+            random_string = ''.join(random.choices(string.ascii_uppercase + string.digits, k=8))
+            pdf_filename = f'submission_batch_{file_idx}_{start_page}-{end_page}_{random_string}.pdf'
+            # if student is provided, we want to associate the submission
+            # with the student
+            paper_submission = PaperSubmission(
+                assignment=assignment_target,
+                student=student,
+                pdf=ContentFile(pdf_bytes, name=pdf_filename),)
+            paper_submissions.append(paper_submission)
+            for j, (png_bytes, fingerprint) in enumerate(zip(pages_png, pages_fingerprint)):
+                img_filename = f'submission-{i}-batch-{file_idx}-page-{j+1}-{random_string}.png'
+                submission_images.append(PaperSubmissionImage(
+                    submission=paper_submission,
+                    image=ContentFile(png_bytes, name=img_filename),
+                    page=j+1,
+                    fingerprint=fingerprint))
+
+        # bulk_create calls pre_save on the file fields,
+        # so the pdfs and images are written to storage here
+        with transaction.atomic():
+            PaperSubmission.objects.bulk_create(paper_submissions)
+            PaperSubmissionImage.objects.bulk_create(submission_images)
+
+        return [paper_submission.pk for paper_submission in paper_submissions]
+
     @classmethod
     def classify(
         cls, 
@@ -384,23 +581,34 @@ class PaperSubmission(Submission):
         top_percent=0.25,
         left_percent=0.5,
         crop_box=None,
-        skip_pages=(0, 1, 3,)):
+        skip_pages=(0, 1, 3,),
+        progress_callback=None):
         """ 
         use a deep learning model to classify the paper submissions
+
+        Return the pks of the classified and not classified submissions,
+        and a list of dicts describing the submissions whose student was
+        replaced by a different one.
+
+        If given, progress_callback(n_done, n_total) is called while the
+        images are retrieved and while their digits are extracted.
         """
         DETECTION_PROB_D = 1E-5
         model_path_onnx = os.path.join(settings.MEDIA_ROOT, "classify/digits_model.onnx")
         print("Retrieving images for classification...", end="", flush=True)
-        all_imgs, all_sub_pks = PaperSubmission.get_images_for_classify_multi(
+        all_imgs, all_sub_pks = PaperSubmission.get_images_for_classify_stored(
             assignment,
             dpi=dpi,
             top_percent=top_percent,
             left_percent=left_percent,
             crop_box=crop_box,
-            skip_pages=skip_pages)
+            skip_pages=skip_pages,
+            progress_callback=get_stage_progress_callback(progress_callback, 0, 2))
         print("\tDONE")
-        df_ids = import_students_from_db(assignment.course)
-        if len(df_ids) == 0:
+        # the University IDs, names and pks all come from the cached roster
+        roster = get_course_roster(assignment.course)
+        print(f"Found {len(roster)} students with valid University IDs.")
+        if len(roster) == 0:
             raise ValueError("No students with valid IDs found in the database.")
         # get the model
         sess, input_name, output_name =  import_onnx_model(model_path_onnx)
@@ -414,10 +622,12 @@ class PaperSubmission(Submission):
         # we already replaced them with None in get_images_for_classify
         df_digits = classify(
             model, 
-            df_ids, 
+            roster.to_dataframe(), 
             all_imgs,
             dpi=dpi,
             pages_to_skip=skip_pages,
+            progress_callback=get_stage_progress_callback(progress_callback, 1, 2),
+            roster_digits=roster.digits,
             )
 
         df_digits_detections = (
@@ -427,37 +637,50 @@ class PaperSubmission(Submission):
                 .astype({'ufid': str})
                 .sort_values('doc_idx'))
 
-        
-        if len(df_digits_detections) == 0:
-            print("No detections above threshold.")
-            classified_submission_pks = []
-            not_classified_submission_pks = [pk_list[0] for pk_list in all_sub_pks]
-            return classified_submission_pks, not_classified_submission_pks
-        df_digits_detections["submission_pk"] = df_digits_detections.apply(
-            lambda row: PaperSubmission.objects.get(pk=all_sub_pks[row.doc_idx][row.page_idx]).pk, 
-            axis=1)
-        df_digits_detections["student_pk"] = df_digits_detections.apply(
-            lambda row: Student.objects.get(uni_id=row.ufid).pk,
-            axis=1)
-
-
+        submissions = {
+            sub.pk: sub for sub in PaperSubmission.objects.filter(assignment=assignment)
+        }
         print(df_digits_detections)
+        now = timezone.now()
+        submissions_to_update = []
+        # the submissions whose student was replaced by a different one
+        reassigned = []
         for row in df_digits_detections.itertuples():
-            sub_to_update = PaperSubmission.objects.get(id=row.submission_pk)
-            if sub_to_update.student and sub_to_update.student.pk != row.student_pk:
+            sub_to_update = submissions[all_sub_pks[row.doc_idx][row.page_idx]]
+            student_pk = roster.get_student_pk(row.ufid)
+            if student_pk is None:
+                print(f"Warning: no student with University ID {row.ufid} in the course")
+                continue
+            if sub_to_update.student_id and sub_to_update.student_id != student_pk:
                 # replacing student, so reset canvas_id and canvas_url
-                print(f"Warning: replacing student pk {sub_to_update.student.pk} with {row.student_pk} \nResetting canvas_id and canvas_url")
+                print(f"Warning: replacing student pk {sub_to_update.student_id} with {student_pk} \nResetting canvas_id and canvas_url")
+                reassigned.append({
+                    "submission_pk": sub_to_update.pk,
+                    "old_student_pk": sub_to_update.student_id,
+                    "new_student_pk": student_pk,
+                    "ufid": row.ufid,
+                    "probability": float(row.max_probability),
+                })
                 sub_to_update.canvas_id = ""
                 sub_to_update.canvas_url = ""
-            sub_to_update.student = Student.objects.get(pk=row.student_pk)
+            sub_to_update.student_id = student_pk
             sub_to_update.classification_type = "D"
-            sub_to_update.save()
-        classified_submission_pks = df_digits_detections["submission_pk"].tolist()
+            sub_to_update.updated = now
+            submissions_to_update.append(sub_to_update)
+        with transaction.atomic():
+            PaperSubmission.objects.bulk_update(
+                submissions_to_update,
+                ["student", "classification_type", "canvas_id", "canvas_url", "updated"])
+
+        classified_submission_pks = [sub.pk for sub in submissions_to_update]
+        classified = set(classified_submission_pks)
         not_classified_submission_pks = [
-            pk for pk in PaperSubmission.objects.filter(assignment=assignment).exclude(id__in=classified_submission_pks).values_list("id", flat=True)
+            pk for pk in submissions if pk not in classified
         ]
+        if not classified_submission_pks:
+            print("No detections above threshold.")
         
-        return classified_submission_pks, not_classified_submission_pks
+        return classified_submission_pks, not_classified_submission_pks, reassigned
     
     @classmethod
     def perform_versioning(
@@ -470,70 +693,243 @@ class PaperSubmission(Submission):
         selected_pages=(
             3,
         ),
+        incremental=True,
+        max_outlier_fraction=0.1,
+        method="text",
+        progress_callback=None,
     ):
-        submissions = PaperSubmission.objects.filter(assignment=assignment)
+        """
+        Group the submissions of the assignment in versions by 
+        clustering the selected pages.
+
+        With method "text", the pages are compared using the text found
+        by OCR. With method "fingerprint", they are compared using the
+        perceptual hashes computed when the pages were uploaded, which
+        does not need OCR and also works for pages without much text.
+
+        If incremental is True and the assignment was already versioned
+        using the same pages, the existing versions are kept and only 
+        the submissions without a version are assigned to the version 
+        with the most similar pages. The whole assignment is clustered 
+        again if the submissions that cannot be assigned to any version
+        are more than max_outlier_fraction of the submissions.
+
+        If given, progress_callback(n_done, n_total) is called with the
+        number of pages OCRed, or whose fingerprint is computed.
+
+        Return the serialized submissions and the number of outliers.
+        """
+        selected_pages = list(selected_pages)
+        submissions = list(PaperSubmission.objects.filter(assignment=assignment))
+        state = VersioningState.objects.filter(assignment=assignment).first()
+        if incremental and cls._can_version_incrementally(assignment, state, selected_pages, method):
+            outliers = cls._version_incrementally(
+                assignment, submissions, state, selected_pages, progress_callback)
+            if outliers <= max_outlier_fraction * len(submissions):
+                return cls._serialize_versioned_submissions(assignment), outliers
+            print(f"{outliers} submissions could not be assigned to a version, "
+                  "clustering all the submissions again...")
+        outliers = cls._version_all(
+            assignment, submissions, selected_pages, method, progress_callback)
+        return cls._serialize_versioned_submissions(assignment), outliers
+
+    @classmethod
+    def _get_versioning_texts(cls, submissions, selected_pages, progress_callback=None):
+        """
+        Return the text of the selected pages of each submission, and
+        the image of the first selected page of each submission.
+        """
         images = []
         sub_pks = []
+        first_page_images = {}
+        submission_images = defaultdict(list)
+        for image in (PaperSubmissionImage.objects
+                      .filter(submission__in=submissions, page__in=selected_pages)
+                      .order_by("page")):
+            submission_images[image.submission_id].append(image)
         for submission in submissions:
-            submission_images = PaperSubmissionImage.objects.filter(
-                Q(submission=submission) & Q(page__in=selected_pages)
-            )
-            for image in submission_images:
+            for image in submission_images[submission.pk]:
                 images.append(image.image.path)
                 sub_pks.append(submission.pk)
+                if image.page == selected_pages[0]:
+                    first_page_images[submission.pk] = image
 
-        texts = images_to_text(images, sub_pks)
+        # only the pages that were never OCRed go through tesseract
+        texts = group_texts_by_submission(
+            OCRCacheEntry.ocr_images(images, progress_callback=progress_callback), sub_pks)
         print("Number of texts: ", len(texts))
-        X = vectorize_texts(texts)
-        # cluster the text
+        return texts, first_page_images
+
+    @classmethod
+    def _get_versioning_fingerprints(cls, submissions, selected_pages, progress_callback=None):
+        """
+        Return the pks of the submissions that have all the selected pages,
+        the unpacked fingerprints of their selected pages and the image 
+        of their first selected page.
+
+        The fingerprints of the images uploaded before fingerprints were
+        computed at upload time are computed and saved here.
+        """
+        submission_images = defaultdict(dict)
+        missing = []
+        for image in PaperSubmissionImage.objects.filter(
+                submission__in=submissions, page__in=selected_pages):
+            submission_images[image.submission_id][image.page] = image
+            if image.fingerprint is None:
+                missing.append(image)
+        if missing:
+            print(f"Computing the fingerprints of {len(missing)} images...")
+            for n_done, image in enumerate(missing, start=1):
+                with Image.open(image.image.path) as page_img:
+                    image.fingerprint = page_fingerprint(np.asarray(page_img.convert("L")))
+                if progress_callback is not None:
+                    progress_callback(n_done, len(missing))
+            PaperSubmissionImage.objects.bulk_update(missing, ["fingerprint"])
+
+        sub_pks = []
+        fingerprints = []
+        first_page_images = {}
+        for submission in submissions:
+            pages = submission_images[submission.pk]
+            if any(page not in pages for page in selected_pages):
+                continue
+            sub_pks.append(submission.pk)
+            fingerprints.append(b"".join(bytes(pages[page].fingerprint) for page in selected_pages))
+            first_page_images[submission.pk] = pages[selected_pages[0]]
+        return sub_pks, fingerprint_bits(fingerprints), first_page_images
+
+    @classmethod
+    def _version_all(cls, assignment, submissions, selected_pages, method="text", progress_callback=None):
+        """
+        Cluster all the submissions of the assignment, replacing
+        the existing versions. Return the number of outliers.
+        """
+        outlier_label = -1
         print("Clustering Images...")
-        dbscan, cluster_labels = perform_dbscan_clustering(X)
+        if method == "fingerprint":
+            sub_pks, bits, first_page_images = cls._get_versioning_fingerprints(
+                submissions, selected_pages, progress_callback)
+            cluster_labels = perform_fingerprint_clustering(bits)
+            centroids = get_fingerprint_centroids(bits, cluster_labels, outlier_label)
+            vectorizer_state = {}
+        elif method == "text":
+            texts, first_page_images = cls._get_versioning_texts(
+                submissions, selected_pages, progress_callback)
+            sub_pks = list(texts.index)
+            vectorizer, X = fit_text_vectorizer(texts)
+            # cluster the text
+            dbscan, cluster_labels = perform_dbscan_clustering(X)
+            centroids = get_cluster_centroids(X, cluster_labels, outlier_label)
+            vectorizer_state = {
+                "vocabulary": {
+                    term: int(column) for term, column in vectorizer.vocabulary_.items()
+                },
+                "idf": vectorizer.idf_.tolist(),
+            }
+        else:
+            raise ValueError(f"Unknown versioning method {method}")
 
         # delete the versions if already exist
         delete_versions(assignment)
 
-        outlier_label = -1
-        cluster_types = set(cluster_labels) - {
-            outlier_label,
-        }
-        len_cluster_types = len(set(cluster_types))
+        cluster_types = sorted(set(cluster_labels) - {outlier_label})
         # create the versions
-
-        for label in cluster_types:
-            Version.objects.create(name=label + 1, assignment=assignment)
-
-        cluster_images = [""] * len_cluster_types
-        # add the cluster labels to the database
-        for i, submission in enumerate(submissions):
-            # get the version with the corresponding cluster label
-            if cluster_labels[i] not in cluster_types:
-                continue
-            version = Version.objects.get(assignment=assignment, name=cluster_labels[i] + 1)
+        versions = {
+            label: Version(name=label + 1, assignment=assignment)
+            for label in cluster_types
+        }
+        labels_by_pk = dict(zip(sub_pks, cluster_labels))
+        for submission in submissions:
+            version = versions.get(labels_by_pk.get(submission.pk, outlier_label))
             submission.version = version
-            # check if version already has an image
-            if version.version_image == "":
-                submission_image = PaperSubmissionImage.objects.filter(
-                    submission=submission, page=selected_pages[0]
-                )
-                cluster_images[int(version.name) - 1] = submission_image[0].image.url
-                # url.replace("/media", "")
-                version.version_image = cluster_images[int(version.name) - 1].replace(
-                    "/media", ""
-                )
-                version.save()
+            # use the first submission of each version as its image
+            if version is not None and not version.version_image:
+                submission_image = first_page_images.get(submission.pk)
+                if submission_image is not None:
+                    version.version_image = submission_image.image.url.replace("/media", "")
+        with transaction.atomic():
+            Version.objects.bulk_create(versions.values())
+            PaperSubmission.objects.bulk_update(submissions, ["version"])
+
+            # count number of -1 in cluster_labels
+            outliers = int(np.count_nonzero(cluster_labels == outlier_label))
+            VersioningState.objects.update_or_create(
+                assignment=assignment,
+                defaults={
+                    "method": method,
+                    "selected_pages": selected_pages,
+                    "vectorizer": vectorizer_state,
+                    "centroids": {
+                        str(versions[label].pk): centroid.tolist()
+                        for label, centroid in centroids.items()
+                    },
+                    "n_submissions": len(sub_pks),
+                    "n_outliers": outliers,
+                })
 
-            submission.save()
-        # renew the submissions_image queryset after the above changes
-        submissions = PaperSubmission.objects.filter(assignment=assignment)
+            assignment.versioned = True
+            assignment.save()
+
+        return outliers
 
-        # count number of 0 in cluster_labels
-        outliers = np.count_nonzero(cluster_labels == outlier_label)
+    @classmethod
+    def _can_version_incrementally(cls, assignment, state, selected_pages, method="text"):
+        if state is None or not assignment.versioned or state.method != method:
+            return False
+        if state.selected_pages != selected_pages or not state.centroids:
+            return False
+        # the versions may have been deleted since the last full versioning
+        n_versions = Version.objects.filter(
+            assignment=assignment, pk__in=list(state.centroids)).count()
+        return n_versions == len(state.centroids)
 
-        assignment.versioned = True
-        assignment.save()
+    @classmethod
+    def _version_incrementally(cls, assignment, submissions, state, selected_pages, progress_callback=None):
+        """
+        Assign the submissions without a version to the most similar
+        existing version. Return the number of submissions that could
+        not be assigned to any version.
+        """
+        new_submissions = [sub for sub in submissions if sub.version_id is None]
+        print(f"Assigning {len(new_submissions)} submissions to the existing versions...")
+        if not new_submissions:
+            return 0
+        version_pks = list(state.centroids)
+        centroids = np.array([state.centroids[pk] for pk in version_pks])
+        if state.method == "fingerprint":
+            sub_pks, bits, _ = cls._get_versioning_fingerprints(
+                new_submissions, selected_pages, progress_callback)
+            assignments, distances = assign_to_fingerprint_centroids(bits, centroids)
+        else:
+            texts, _ = cls._get_versioning_texts(
+                new_submissions, selected_pages, progress_callback)
+            sub_pks = list(texts.index)
+            vectorizer = load_text_vectorizer(
+                state.vectorizer["vocabulary"], state.vectorizer["idf"])
+            X = vectorizer.transform(texts)
+            assignments, similarities = assign_to_centroids(X, centroids)
+
+        submissions_by_pk = {sub.pk: sub for sub in new_submissions}
+        assigned = []
+        for sub_pk, version_idx in zip(sub_pks, assignments):
+            if version_idx < 0:
+                continue
+            submission = submissions_by_pk[sub_pk]
+            submission.version_id = uuid.UUID(version_pks[version_idx])
+            assigned.append(submission)
+        outliers = len(sub_pks) - len(assigned)
+        with transaction.atomic():
+            PaperSubmission.objects.bulk_update(assigned, ["version"])
+            state.n_outliers = outliers
+            state.save()
+        return outliers
 
-        # Serialize the data
-        assignment = model_to_dict(assignment)
+    @classmethod
+    def _serialize_versioned_submissions(cls, assignment):
+        submissions = (PaperSubmission.objects
+                       .filter(assignment=assignment)
+                       .select_related("version")
+                       .prefetch_related("submissions_papersubmissionimage_related"))
         submissions_serialized = []
         for submission in submissions:
             images_urls = submission.submissions_papersubmissionimage_related.all()
@@ -549,13 +945,14 @@ class PaperSubmission(Submission):
                 submission_serialized["version"] = None
             submissions_serialized.append(submission_serialized)
 
-        return submissions_serialized, outliers
+        return submissions_serialized
 
     @classmethod
     def extract_info(
         cls,
         assignment,
         info_fields,
+        progress_callback=None,
     ):
         """
         Use a vision language model to extract information from the paper submissions
@@ -564,26 +961,39 @@ class PaperSubmission(Submission):
             assignment: Assignment
             info_fields: list of InfoField
                 The fields of information to extract from the paper submissions.
+            progress_callback: callable, optional
+                Called as progress_callback(n_done, n_total) after each image.
         Returns:
             List of dictionaries containing the extracted information
         """
         from pydantic import Field, create_model
-        from submissions.batch_extract import outlines_vlm, load_and_resize_image
+        from submissions.batch_extract import (evict_image_cache, iter_resized_images,
+                                               outlines_vlm)
         max_pages = PaperSubmissionImage.get_max_page_number(assignment)
-        for page in range(1, max_pages + 1):
+        pages = [
+            page for page in range(1, max_pages + 1)
+            if any(page in info_field["pages"] for info_field in info_fields)
+        ]
+        # the resized images of all the assignments share one cache,
+        # bounded by settings.VLM_IMAGE_CACHE_MAX_BYTES
+        image_cache_dir = os.path.join(settings.MEDIA_ROOT, "vlm_cache")
+        for page_idx, page in enumerate(pages):
             page_info_fields = []
             for info_field in info_fields:
                 print(info_field)
                 if page in info_field["pages"]:
                     page_info_fields.append(info_field)
-            if not page_info_fields:
-                continue
-            images = {
-                str(image.pk): load_and_resize_image(image.image.path)
+            page_images = [
+                (str(image.pk), image.image.path)
                 for image in PaperSubmissionImage.objects.filter(
                     submission__assignment=assignment, page=page
                 )
-            }
+            ]
+            page_progress_callback = get_stage_progress_callback(
+                progress_callback, page_idx, len(pages))
+            # the images are loaded in the background while the model 
+            # runs, and only a few of them are kept in memory at once
+            images = iter_resized_images(page_images, cache_dir=image_cache_dir)
             page_model = create_model(
                 "SubmissionPageModel",
                 **{
@@ -597,12 +1007,16 @@ class PaperSubmission(Submission):
             )
             print(f"Pydantic Model for page: {page}", page_model.schema())
             
+            # the model is loaded only once per process
             results = outlines_vlm(
                 images,
-                model_uri="Qwen/Qwen2-VL-2B-Instruct",
-                # model_uri="HuggingFaceTB/SmolVLM-256M-Instruct",
+                model_uri=settings.VLM_MODEL_URI,
                 pydantic_model = page_model,
                 user_message =  "You are a helpful assistant",
+                batch_size=settings.VLM_BATCH_SIZE,
+                progress_callback=(
+                    lambda n_done: page_progress_callback(n_done, len(page_images))
+                ) if page_progress_callback is not None else None,
             )
             print("Results:", results)
 
@@ -616,18 +1030,22 @@ class PaperSubmission(Submission):
                     pages=page_info_field["pages"],
                 )
 
+            info_fields_by_title = {
+                info_field.title: info_field
+                for info_field in AssignmentInfoField.objects.filter(assignment=assignment)
+            }
+            extracted_fields = []
             for submission_image_pk, samples in results.items():
                 # sample is a dict with keys the titles of the info fields
                 sample = samples[0]
                 for title, value in sample.items():
-                    info_field = AssignmentInfoField.objects.get(
-                        assignment=assignment, 
-                        title=title)
-                    ExtractedInfoField.objects.create(
-                        info_field=info_field,
-                        paper_submission_image=PaperSubmissionImage.objects.get(pk=submission_image_pk),
+                    extracted_fields.append(ExtractedInfoField(
+                        info_field=info_fields_by_title[title],
+                        paper_submission_image_id=submission_image_pk,
                         value=value,
-                    )
+                    ))
+            ExtractedInfoField.upsert(extracted_fields)
+            evict_image_cache(image_cache_dir, settings.VLM_IMAGE_CACHE_MAX_BYTES)
 
 
 
@@ -683,6 +1101,12 @@ class PaperSubmissionImage(models.Model):
         null=True,
         blank=True)
 
+    # perceptual hash of the page, see submissions.fingerprint
+    fingerprint = models.BinaryField(
+        null=True,
+        blank=True,
+        editable=False)
+
 
     def __str__(self):
         return f"Paper Submission Image {self.pk}"
@@ -729,6 +1153,98 @@ class PaperSubmissionImage(models.Model):
         
         return all_imgs, all_img_pks
         
+class QuestionGrade(models.Model):
+    """
+    The grade of one question of a paper submission. The rows are a copy of
+    PaperSubmission.question_grades kept in sync on save, so that the grades
+    of the questions can be aggregated in SQL or loaded with a single query.
+    """
+    id = models.UUIDField(
+        primary_key=True, 
+        default=uuid.uuid4, 
+        editable=False)
+
+    submission = models.ForeignKey(
+        PaperSubmission,
+        on_delete=models.CASCADE,
+        related_name="%(app_label)s_%(class)s_related",
+        related_query_name="%(app_label)s_%(class)ss")
+
+    # starts at 1
+    question = models.PositiveSmallIntegerField()
+
+    # null when the question is not graded
+    score = models.FloatField(
+        null=True,
+        blank=True)
+
+    def __str__(self):
+        return f"Question {self.question} of {self.submission.short_name()}: {self.score}"
+
+    @staticmethod
+    def parse(question_grades):
+        """Return the scores in a question_grades string, None for the empty ones."""
+        if not question_grades:
+            return []
+        scores = []
+        for grade in question_grades.split(","):
+            try:
+                scores.append(float(grade))
+            except ValueError:
+                scores.append(None)
+        return scores
+
+    @classmethod
+    def sync(cls, submissions):
+        """Write again the QuestionGrade rows of the submissions from their question_grades."""
+        cls.objects.filter(submission__in=[s.pk for s in submissions]).delete()
+        cls.objects.bulk_create([
+            cls(submission_id=submission.pk, question=question, score=score)
+            for submission in submissions
+            for question, score in enumerate(cls.parse(submission.question_grades), start=1)
+        ], batch_size=1000)
+
+    @classmethod
+    def get_dataframe(cls, submissions):
+        """
+        Return the grades of the submissions in a DataFrame indexed by
+        submission pk, with one question_{i}_grade column per question.
+        """
+        rows = cls.objects.filter(submission__in=submissions).values_list(
+            "submission_id", "question", "score")
+        df = pd.DataFrame.from_records(list(rows), columns=["submission_id", "question", "score"])
+        df = df.pivot(index="submission_id", columns="question", values="score")
+        df.columns = [f"question_{question}_grade" for question in df.columns]
+        return df
+
+    @classmethod
+    def get_array(cls, submissions, n_questions=None):
+        """
+        Return the pks of the graded submissions and an (N_submissions, n_questions)
+        float array of their grades, with NaN for the questions not graded.
+        """
+        rows = list(cls.objects.filter(submission__in=submissions).values_list(
+            "submission_id", "question", "score"))
+        submission_pks = list(dict.fromkeys(row[0] for row in rows))
+        row_idx = {pk: i for i, pk in enumerate(submission_pks)}
+        if n_questions is None:
+            n_questions = max((row[1] for row in rows), default=0)
+        grades = np.full((len(submission_pks), n_questions), np.nan)
+        for submission_pk, question, score in rows:
+            if question <= n_questions and score is not None:
+                grades[row_idx[submission_pk], question - 1] = score
+        return submission_pks, grades
+
+    class Meta:
+        verbose_name_plural = "Question Grades"
+        constraints = [
+            models.UniqueConstraint(
+                fields=["submission", "question"],
+                name="unique_question_grade_per_submission",
+            ),
+        ]
+
+
 class SubmissionComment(models.Model):
     id = models.UUIDField(
         primary_key=True, 
@@ -948,5 +1464,136 @@ class ExtractedInfoField(models.Model):
     def __str__(self):
         return f"{self.info_field.title} on page {self.paper_submission_image.page}: {self.value}"
 
+    @classmethod
+    def upsert(cls, extracted_fields, batch_size=500):
+        """
+        Save the extracted fields with a single query per batch. The value of
+        a field that was already extracted from the same image is replaced,
+        so running the extraction again does not create duplicates.
+        """
+        return cls.objects.bulk_create(
+            extracted_fields,
+            batch_size=batch_size,
+            update_conflicts=True,
+            unique_fields=["info_field", "paper_submission_image"],
+            update_fields=["value"],
+        )
+
+    class Meta:
+        verbose_name_plural = "Extracted Info Fields"
+        constraints = [
+            models.UniqueConstraint(
+                fields=["info_field", "paper_submission_image"],
+                name="unique_extracted_info_field_per_image",
+            ),
+        ]
+
+class OCRCacheEntry(models.Model):
+    """
+    Text extracted by OCR from an image, keyed by the hash of the image
+    content and of the OCR parameters, so that versioning the same pages
+    again does not run tesseract on them.
+
+    The least recently used entries are deleted when the size of the
+    texts goes over settings.OCR_CACHE_MAX_BYTES.
+    """
+    id = models.UUIDField(
+        primary_key=True, 
+        default=uuid.uuid4, 
+        editable=False)
+
+    key = models.CharField(
+        max_length=64,
+        unique=True)
+
+    text = models.TextField(
+        blank=True)
+
+    size = models.PositiveIntegerField(
+        default=0)
+
+    last_used = models.DateTimeField(
+        db_index=True)
+
+    def __str__(self):
+        return f"OCR cache entry {self.key[:12]}"
+
     class Meta:
-        verbose_name_plural = "Extracted Info Fields"
\ No newline at end of file
+        verbose_name_plural = "OCR Cache Entries"
+
+    @staticmethod
+    def get_key(image_path, params):
+        """Return the hash of the content of the image and the OCR parameters."""
+        image_hash = hashlib.sha256()
+        with open(image_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                image_hash.update(chunk)
+        image_hash.update(json.dumps(params, sort_keys=True).encode())
+        return image_hash.hexdigest()
+
+    @classmethod
+    def ocr_images(cls, image_paths, crop_fractions=VERSION_TEXT_REGION, dpi=150, char_set=OCR_CHAR_SET, processes=None, progress_callback=None):
+        """
+        Same as `cluster.ocr_images`, but only the images that are not
+        in the cache go through tesseract, and progress_callback only
+        counts them.
+
+        Only the non-empty texts are cached, so that the images without
+        text are OCRed again. If a tesseract process fails, the texts of
+        the other processes are still cached before raising an error.
+        """
+        params = {
+            "crop_fractions": list(crop_fractions) if crop_fractions is not None else None,
+            "dpi": dpi,
+            "char_set": char_set,
+        }
+        keys = [cls.get_key(image_path, params) for image_path in image_paths]
+        now = timezone.now()
+        cached = dict(cls.objects.filter(key__in=set(keys)).values_list("key", "text"))
+        cls.objects.filter(key__in=cached.keys()).update(last_used=now)
+
+        # the same image may appear more than once
+        missing = {}
+        for image_path, key in zip(image_paths, keys):
+            if key not in cached:
+                missing.setdefault(key, image_path)
+        print(f"OCR cache: {len(image_paths) - len(missing)} hits, {len(missing)} misses")
+        if missing:
+            texts = ocr_images(
+                list(missing.values()),
+                crop_fractions=crop_fractions,
+                dpi=dpi,
+                char_set=char_set,
+                processes=processes,
+                progress_callback=progress_callback,
+                skip_failed=True)
+            new_texts = dict(zip(missing.keys(), texts))
+            cls.objects.bulk_create(
+                [
+                    cls(key=key, text=text, size=len(text.encode()), last_used=now)
+                    for key, text in new_texts.items() if text
+                ],
+                ignore_conflicts=True)
+            cls.evict()
+            n_failed = sum(text is None for text in new_texts.values())
+            if n_failed:
+                raise RuntimeError(f"OCR failed for {n_failed} of {len(new_texts)} images")
+            cached.update(new_texts)
+        return [cached[key] for key in keys]
+
+    @classmethod
+    def evict(cls, max_bytes=None):
+        """Delete the least recently used entries until the texts take
+        less than max_bytes, by default settings.OCR_CACHE_MAX_BYTES."""
+        if max_bytes is None:
+            max_bytes = getattr(settings, "OCR_CACHE_MAX_BYTES", 64 * 1024 * 1024)
+        total = cls.objects.aggregate(total=Sum("size"))["total"] or 0
+        if total <= max_bytes:
+            return
+        to_delete = []
+        for pk, size in cls.objects.order_by("last_used").values_list("pk", "size").iterator():
+            if total <= max_bytes:
+                break
+            to_delete.append(pk)
+            total -= size
+        cls.objects.filter(pk__in=to_delete).delete()
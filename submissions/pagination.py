@@ -0,0 +1,100 @@
+"""Cursor pagination of the submissions of an assignment.
+
+The submissions are ordered by (created, id) and a page starts right
+after the submission encoded in the cursor, so fetching a page costs
+the same however far in the list it is, and submissions added while
+the pages are fetched are not skipped or repeated.
+
+Pagination is opt-in: the whole list is returned as before unless the
+request has a `cursor` or a `page_size` parameter.
+"""
+import base64
+import binascii
+import uuid
+from datetime import datetime
+
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+def encode_cursor(submission):
+    position = f"{submission.created.isoformat()}|{submission.pk}"
+    return base64.urlsafe_b64encode(position.encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        created, pk = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.fromisoformat(created), uuid.UUID(pk)
+    except (binascii.Error, UnicodeError, ValueError):
+        raise NotFound("Invalid cursor")
+
+
+class SubmissionCursorPagination(BasePagination):
+    cursor_query_param = "cursor"
+    page_size_query_param = "page_size"
+    page_size = 50
+    max_page_size = 500
+
+    def is_requested(self, request):
+        return (
+            self.cursor_query_param in request.GET
+            or self.page_size_query_param in request.GET
+        )
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.GET[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return min(max(page_size, 1), self.max_page_size)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if not self.is_requested(request):
+            return None
+        self.request = request
+        page_size = self.get_page_size(request)
+
+        queryset = queryset.order_by("created", "id")
+        cursor = request.GET.get(self.cursor_query_param)
+        if cursor:
+            created, pk = decode_cursor(cursor)
+            queryset = queryset.filter(
+                Q(created__gt=created) | Q(created=created, id__gt=pk))
+
+        # fetch one more submission to know if there is a next page
+        page = list(queryset[:page_size + 1])
+        self.has_next = len(page) > page_size
+        page = page[:page_size]
+        self.next_cursor = encode_cursor(page[-1]) if self.has_next else None
+        return page
+
+    def get_next_link(self):
+        if self.next_cursor is None:
+            return None
+        return replace_query_param(
+            self.request.build_absolute_uri(),
+            self.cursor_query_param,
+            self.next_cursor)
+
+    def get_paginated_data(self, data):
+        return {
+            "next": self.get_next_link(),
+            "results": data,
+        }
+
+    def get_paginated_response(self, data):
+        return Response(self.get_paginated_data(data))
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            "type": "object",
+            "required": ["results"],
+            "properties": {
+                "next": {"type": "string", "nullable": True, "format": "uri"},
+                "results": schema,
+            },
+        }
@@ -1,3 +1,4 @@
+from django.db.models import Prefetch
 from rest_framework import serializers
 from profiles.serializers import UserSerializer
 from students.models import Student
@@ -53,7 +54,27 @@ class ExtractedFieldSerializer(serializers.ModelSerializer):
         depth = 1
 
 
+def parse_sparse_fieldset(query_params):
+    """
+    Return the lists of names in the comma separated `fields` and `expand`
+    query parameters. fields is None when the parameter is missing.
+    """
+    fields = query_params.get("fields")
+    if fields is not None:
+        fields = [name for name in fields.split(",") if name]
+    expand = [name for name in query_params.get("expand", "").split(",") if name]
+    return fields, expand
+
+
 class PaperSubmissionSerializer(serializers.ModelSerializer):
+    """
+    The fields can be restricted with the `fields` argument, a list of names
+    from Meta.fields. The relations in EXPANDABLE_FIELDS are then returned
+    as primary keys unless they are also listed in `expand`. Without `fields`,
+    every field is returned with the relations expanded.
+    """
+    EXPANDABLE_FIELDS = ("student", "version", "assignment")
+
     papersubmission_images = PaperSubmissionImageSerializer(
         source="submissions_papersubmissionimage_related", many=True, read_only=True
     )
@@ -65,11 +86,70 @@ class PaperSubmissionSerializer(serializers.ModelSerializer):
     )
     student = StudentSerializer(read_only=True)
     extracted_fields = serializers.SerializerMethodField()
+    thumbnail = serializers.SerializerMethodField()
+
+    def __init__(self, *args, fields=None, expand=(), **kwargs):
+        super().__init__(*args, **kwargs)
+        if fields is None:
+            return
+        unknown_fields = set(fields) - set(self.fields)
+        if unknown_fields:
+            raise serializers.ValidationError(
+                {"fields": f"Unknown fields: {', '.join(sorted(unknown_fields))}"})
+        for field_name in set(self.fields) - set(fields):
+            self.fields.pop(field_name)
+        for field_name in self.EXPANDABLE_FIELDS:
+            if field_name in self.fields and field_name not in expand:
+                self.fields[field_name] = serializers.PrimaryKeyRelatedField(read_only=True)
 
     def get_extracted_fields(self, obj):
         extracted_fields = obj.get_extracted_fields()
         return ExtractedFieldSerializer(extracted_fields, many=True).data
 
+    def get_thumbnail(self, obj):
+        """URL of the image of the first page"""
+        for image in obj.submissions_papersubmissionimage_related.all():
+            if image.page == 1 and image.image:
+                request = self.context.get("request")
+                if request is None:
+                    return image.image.url
+                return request.build_absolute_uri(image.image.url)
+        return None
+
+    @classmethod
+    def setup_eager_loading(cls, queryset, fields=None, expand=()):
+        """
+        Load everything the nested serializers read along with the submissions,
+        so that serializing them takes the same number of queries however many
+        submissions there are. When `fields` is given, only what these fields
+        read is loaded, see the arguments of the serializer.
+        """
+        if fields is None:
+            fields = cls.Meta.fields
+            expand = cls.EXPANDABLE_FIELDS
+        select_related = []
+        prefetch_related = []
+        if "student" in fields and "student" in expand:
+            select_related.append("student__profile")
+            prefetch_related.append("student__sections__meetings")
+        if "assignment" in fields and "assignment" in expand:
+            select_related += ["assignment__course", "assignment__assignment_group_object"]
+            prefetch_related.append("assignment__course__instructors")
+        if "version" in fields and "version" in expand:
+            select_related.append("version__assignment")
+        if "submission_comments" in fields:
+            prefetch_related.append(Prefetch(
+                "submissions_submissioncomment_related",
+                queryset=SubmissionComment.objects.select_related("author").prefetch_related(
+                    "author__groups", "author__user_permissions"),
+            ))
+        queryset = queryset.select_related(*select_related).prefetch_related(*prefetch_related)
+        if "extracted_fields" in fields:
+            return PaperSubmission.prefetch_extracted_fields(queryset)
+        if "papersubmission_images" in fields or "thumbnail" in fields:
+            return queryset.prefetch_related("submissions_papersubmissionimage_related")
+        return queryset
+
     class Meta:
         model = PaperSubmission
         fields = (
@@ -86,5 +166,6 @@ class PaperSubmissionSerializer(serializers.ModelSerializer):
             "papersubmission_images",
             "submission_comments",
             "extracted_fields",
+            "thumbnail",
         )
         depth = 2
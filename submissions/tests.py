@@ -1,3 +1,172 @@
-from django.test import TestCase
+import os
+import shutil
+import tempfile
+from datetime import time
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import Group, User
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from rest_framework.test import APIClient
+
+from assignments.models import Assignment, AssignmentJob, Version
+from courses.models import Course
+from sections.models import Meeting, Section
+from students.models import Student
+from submissions.models import (AssignmentInfoField, ExtractedInfoField,
+                                OCRCacheEntry, PaperSubmission,
+                                PaperSubmissionImage, SubmissionComment)
+from submissions.serializers import PaperSubmissionSerializer
+
+
+class PaperSubmissionSerializerQueriesTest(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.media_root = tempfile.mkdtemp()
+        cls.media_override = override_settings(MEDIA_ROOT=cls.media_root)
+        cls.media_override.enable()
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls.media_override.disable()
+        shutil.rmtree(cls.media_root, ignore_errors=True)
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create(username="grader")
+        cls.author.groups.add(Group.objects.create(name="graders"))
+        cls.course = Course.objects.create(name="Course")
+        cls.course.instructors.add(cls.author)
+        cls.assignment = Assignment.objects.create(
+            name="Quiz 1", course=cls.course, max_question_scores="1")
+        cls.version = Version.objects.create(name="A", assignment=cls.assignment)
+        cls.section = Section.objects.create(name="Section 1", course=cls.course)
+        cls.section.meetings.add(
+            Meeting.objects.create(start_time=time(9), end_time=time(10)))
+        cls.info_field = AssignmentInfoField.objects.create(
+            title="name", assignment=cls.assignment, pages=[1])
+
+    def add_submissions(self, n_submissions):
+        for _ in range(n_submissions):
+            i = Student.objects.count()
+            student = Student.objects.create(
+                first_name="First", last_name=f"Last {i}", uni_id=f"{i:08d}")
+            student.sections.add(self.section)
+            submission = PaperSubmission.objects.create(
+                assignment=self.assignment, student=student, version=self.version)
+            for page in (1, 2):
+                image = PaperSubmissionImage.objects.create(
+                    submission=submission,
+                    page=page,
+                    image=ContentFile(b"", name=f"{submission.pk}-{page}.png"))
+                ExtractedInfoField.objects.create(
+                    info_field=self.info_field, paper_submission_image=image, value="name")
+            SubmissionComment.objects.create(
+                paper_submission=submission, author=self.author, text="Good")
+
+    def count_queries(self):
+        queryset = PaperSubmissionSerializer.setup_eager_loading(
+            PaperSubmission.objects.filter(assignment=self.assignment))
+        with CaptureQueriesContext(connection) as queries:
+            data = PaperSubmissionSerializer(queryset, many=True).data
+        return len(queries), data
+
+    def test_query_count_does_not_depend_on_number_of_submissions(self):
+        self.add_submissions(2)
+        n_queries, data = self.count_queries()
+        self.assertEqual(len(data), 2)
+
+        self.add_submissions(8)
+        self.assertEqual(self.count_queries()[0], n_queries)
+
+    def test_nested_data(self):
+        self.add_submissions(1)
+        submission = self.count_queries()[1][0]
+        self.assertEqual(len(submission["papersubmission_images"]), 2)
+        self.assertEqual(len(submission["extracted_fields"]), 2)
+        self.assertEqual(submission["extracted_fields"][0]["info_field"]["title"], "name")
+        self.assertEqual(submission["submission_comments"][0]["author"]["username"], "grader")
+        self.assertEqual(submission["student"]["sections"][0]["name"], "Section 1")
+        self.assertEqual(submission["assignment"]["course"]["instructors"], [self.author.pk])
+        self.assertEqual(submission["version"]["name"], "A")
+
+
+class OCRCacheEntryTest(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir, ignore_errors=True)
+        self.image_paths = []
+        for name in ("text", "blank", "failed"):
+            image_path = os.path.join(self.tmp_dir, f"{name}.png")
+            with open(image_path, "wb") as f:
+                f.write(name.encode())
+            self.image_paths.append(image_path)
+
+    def test_only_successful_non_empty_texts_are_cached(self):
+        with mock.patch("submissions.models.ocr_images", return_value=["V1", "", None]), \
+                self.assertRaises(RuntimeError):
+            OCRCacheEntry.ocr_images(self.image_paths)
+        self.assertEqual(list(OCRCacheEntry.objects.values_list("text", flat=True)), ["V1"])
+
+        with mock.patch("submissions.models.ocr_images", return_value=["", "V2"]) as ocr:
+            texts = OCRCacheEntry.ocr_images(self.image_paths)
+        # the blank and the failed images are OCRed again
+        self.assertEqual(ocr.call_args.args[0], self.image_paths[1:])
+        self.assertEqual(texts, ["V1", "", "V2"])
+        self.assertEqual(OCRCacheEntry.objects.count(), 2)
+
+
+class SplitPDFsJobTest(TestCase):
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        media_override = override_settings(MEDIA_ROOT=media_root)
+        media_override.enable()
+        self.addCleanup(media_override.disable)
+        course = Course.objects.create(name="Course")
+        self.assignment = Assignment.objects.create(
+            name="Quiz 1", course=course, max_question_scores="5,5")
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create(username="grader"))
+
+    def get_pdf(self, n_pages):
+        import fitz
+        with fitz.open() as doc:
+            for i in range(n_pages):
+                doc.new_page(width=200, height=200).insert_text((20, 50), f"Page {i + 1}")
+            return SimpleUploadedFile("scans.pdf", doc.tobytes(), content_type="application/pdf")
+
+    def test_pdfs_are_split_by_a_job(self):
+        response = self.client.post(
+            reverse("assignment-submission-list", kwargs={"assignment_pk": self.assignment.pk}),
+            {"submission_PDFs": [self.get_pdf(4)], "num_pages_per_submission": 2},
+            format="multipart")
+        self.assertEqual(response.status_code, 202)
+        self.assertFalse(PaperSubmission.objects.exists())
+
+        job = AssignmentJob.claim_next()
+        self.assertEqual(job.pk, response.data["job_id"])
+        (pdf_name,) = job.params["pdf_names"]
+        self.assertTrue(default_storage.exists(pdf_name))
+        with mock.patch.object(
+                AssignmentJob, "set_progress", autospec=True,
+                side_effect=AssignmentJob.set_progress) as set_progress:
+            job.run()
+        self.assertEqual(job.status, AssignmentJob.DONE, job.error)
+        self.assertEqual(set_progress.call_args.args[1:], (1, "Splitting the PDFs into submissions"))
+        self.assertEqual(
+            sorted(job.result["submission_ids"]),
+            sorted(PaperSubmission.objects.values_list("pk", flat=True)))
+        self.assertEqual(len(job.result["submission_ids"]), 2)
+        self.assertEqual(PaperSubmissionImage.objects.count(), 4)
+        self.assertFalse(default_storage.exists(pdf_name))
@@ -1,9 +1,13 @@
 import glob
 import os
 import re
+import tempfile
+from contextlib import contextmanager
+from hashlib import md5
 
 import fitz
 
+from django.conf import settings
 from django.core.validators import RegexValidator
 from django.db import models
 from django.utils.translation import gettext as _
@@ -24,6 +28,31 @@ def open_UploadedFile_as_PDF(uploaded_file):
     """
     return fitz.Document(stream=uploaded_file.read(), filetype="pdf")
 
+@contextmanager
+def UploadedFile_on_disk(uploaded_file):
+    """
+    Yield a path on disk with the contents of the uploaded file.
+
+    Large uploads are already spooled to a temporary file by Django,
+    so their path is used directly. Uploads kept in memory are written
+    to a temporary file chunk by chunk, which is removed on exit.
+    """
+    try:
+        file_path = uploaded_file.temporary_file_path()
+    except AttributeError:
+        file_path = None
+    if file_path is not None:
+        yield file_path
+        return
+
+    with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as f:
+        for chunk in uploaded_file.chunks():
+            f.write(chunk)
+    try:
+        yield f.name
+    finally:
+        os.remove(f.name)
+
 def submission_upload_to(instance, filename):
     """
     Return the relative path where the submission file should be saved.
@@ -46,6 +75,24 @@ def submission_image_upload_to(instance, filename):
         "img",
         filename)
 
+def submission_crop_cache_path(submission_image, dpi, fractions):
+    """
+    Return the absolute path where a high-dpi crop of a submission image
+    used for classification is cached.
+
+    The filename depends on the dpi and the crop region, so that
+    changing either of them results in a cache miss.
+    """
+    fractions_hash = md5(
+        ",".join(f"{f:.4f}" for f in fractions).encode()).hexdigest()[:8]
+    return os.path.join(
+        settings.MEDIA_ROOT,
+        "submissions",
+        f"course_{submission_image.submission.assignment.course.pk}",
+        f"assignment_{submission_image.submission.assignment.pk}",
+        "crops",
+        f"{submission_image.pk}-{dpi}dpi-{fractions_hash}.png")
+
 def get_quiz_pdf_path(
     quiz_number,
     quiz_dir_path):
@@ -82,3 +129,18 @@ def split_pdfs(pdf_fpath=None, file_idx=0, n_pages=2):
     Split a PDF into multiple PDFs each of size n_pages.
     """
     raise NotImplementedError
+
+
+def get_stage_progress_callback(progress_callback, stage, n_stages):
+    """
+    Return a progress callback for the stage-th of n_stages equal stages
+    of a task, which reports its progress to progress_callback as the
+    progress of the whole task, or None if progress_callback is None.
+    """
+    if progress_callback is None:
+        return None
+
+    def stage_progress_callback(n_done, n_total):
+        n_total = max(n_total, 1)
+        progress_callback(stage * n_total + n_done, n_stages * n_total)
+    return stage_progress_callback
@@ -4,6 +4,7 @@ from itertools import zip_longest
 import pandas as pd
 from django.apps import apps
 from django.contrib.auth.decorators import login_required
+from django.core.files.storage import default_storage
 from django.db.models.query_utils import Q
 from django.contrib.auth.models import User
 from django.http import HttpRequest, JsonResponse
@@ -11,17 +12,19 @@ from django.shortcuts import get_object_or_404, redirect, render
 from django.urls import reverse
 from django.utils import timezone
 
-from assignments.models import Assignment
+from assignments.models import Assignment, AssignmentJob
 from courses.models import Course
 
 from .forms import GradingForm, StudentClassifyForm, SubmissionSearchForm
-from .models import (PaperSubmission,
+from .models import (PaperSubmission, QuestionGrade,
                      SubmissionComment)
 
 from rest_framework.response import Response
 from rest_framework import viewsets
 from rest_framework import permissions
-from submissions.serializers import PaperSubmissionSerializer, SubmissionCommentSerializer
+from submissions.pagination import SubmissionCursorPagination
+from submissions.serializers import (PaperSubmissionSerializer, SubmissionCommentSerializer,
+                                     parse_sparse_fieldset)
 from rest_framework.views import APIView
 import zipfile
 from io import BytesIO
@@ -30,36 +33,78 @@ from django.http import HttpResponse
 class AuthenticatedHttpRequest(HttpRequest):
     user: User
 # Create your views here.
-class PaperSubmissionInAssignmentViewSet(viewsets.ModelViewSet):
+class PaperSubmissionFieldsMixin:
+    """
+    Let the clients select the fields of the submissions with the `fields`
+    and `expand` query parameters, e.g. `?fields=id,grade,version,thumbnail`,
+    and load only what these fields need.
+    """
+    def get_sparse_fieldset(self):
+        return parse_sparse_fieldset(self.request.query_params)
+
+    def get_serializer(self, *args, **kwargs):
+        fields, expand = self.get_sparse_fieldset()
+        kwargs.setdefault("fields", fields)
+        kwargs.setdefault("expand", expand)
+        return super().get_serializer(*args, **kwargs)
+
+    def eager_load(self, queryset):
+        return PaperSubmissionSerializer.setup_eager_loading(
+            queryset, *self.get_sparse_fieldset())
+
+
+class PaperSubmissionInAssignmentViewSet(PaperSubmissionFieldsMixin, viewsets.ModelViewSet):
     """
     This ViewSet automatically provides `list`, `create`, `retrieve`,
     `update` and `destroy` actions.
+
+    The list is paginated with a cursor when the `cursor` or
+    `page_size` query parameter is given.
     """
     queryset = PaperSubmission.objects.all()
     serializer_class = PaperSubmissionSerializer
     permission_classes = [permissions.IsAuthenticatedOrReadOnly,]
+    pagination_class = SubmissionCursorPagination
 
     def get_queryset(self):
         assignment_id = self.kwargs['assignment_pk']
-        return PaperSubmission.objects.filter(assignment=assignment_id)
+        return self.eager_load(PaperSubmission.objects.filter(assignment=assignment_id))
     
     def create(self, request, *args, **kwargs):
         """
         Create a new PaperSubmissions by splitting
-        the PDFs into multiple submissions
+        the PDFs into multiple submissions.
+
+        The PDFs are stored and split by a "split_pdfs" assignment job,
+        whose progress and result, the submission_ids, can be polled.
         """
         num_pages_per_submission = int(request.data.get("num_pages_per_submission"))
         assignment_pk = self.kwargs.get("assignment_pk")
         assignment = Assignment.objects.get(pk=assignment_pk)
         uploaded_files = request.data.getlist("submission_PDFs")
-        sub_ids = PaperSubmission.add_papersubmissions_to_db(
-            assignment_target=assignment,
-            num_pages_per_submission=num_pages_per_submission,
-            uploaded_files=uploaded_files,
+        pdf_names = [
+            default_storage.save(
+                f"job_uploads/assignment_{assignment.pk}/{uploaded_file.name}", uploaded_file)
+            for uploaded_file in uploaded_files
+        ]
+        job = AssignmentJob.enqueue(
+            assignment,
+            "split_pdfs",
+            params={
+                "num_pages_per_submission": num_pages_per_submission,
+                "pdf_names": pdf_names,
+            },
+            created_by=request.user,
+        )
+        return Response(
+            {
+                "job_id": job.pk,
+                "status": job.status,
+            },
+            status=202,
         )
-        return Response(status=200, data={"submission_ids": sub_ids})
     
-class PaperSubmissionOfStudentInCourseViewSet(viewsets.ModelViewSet):
+class PaperSubmissionOfStudentInCourseViewSet(PaperSubmissionFieldsMixin, viewsets.ModelViewSet):
     """
     This ViewSet automatically provides `list`, `create`, `retrieve`,
     `update` and `destroy` actions.
@@ -71,9 +116,10 @@ class PaperSubmissionOfStudentInCourseViewSet(viewsets.ModelViewSet):
     def get_queryset(self):
         course_id = self.kwargs['course_pk']
         student_id = self.kwargs['student_pk']
-        return PaperSubmission.objects.filter(assignment__course=course_id, student=student_id)
+        return self.eager_load(
+            PaperSubmission.objects.filter(assignment__course=course_id, student=student_id))
     
-class PaperSubmissionViewSet(viewsets.ModelViewSet):
+class PaperSubmissionViewSet(PaperSubmissionFieldsMixin, viewsets.ModelViewSet):
     """
     This ViewSet automatically provides `create`, `retrieve`,
     `update` and `destroy` actions.
@@ -82,6 +128,9 @@ class PaperSubmissionViewSet(viewsets.ModelViewSet):
     serializer_class = PaperSubmissionSerializer
     permission_classes = [permissions.IsAuthenticatedOrReadOnly,]
 
+    def get_queryset(self):
+        return self.eager_load(PaperSubmission.objects.all())
+
 class CommentViewSet(viewsets.ModelViewSet):
     """
     This ViewSet automatically provides `create`, `retrieve`,
@@ -615,15 +664,11 @@ def api_grades_list_view(request, assignment_pk):
     This view returns the grades for an assignment
     """
     assignment = get_object_or_404(Assignment, pk=assignment_pk)
-    submissions = PaperSubmission.objects.filter(assignment=assignment)
-    
+    submissions = PaperSubmission.objects.filter(assignment=assignment).select_related('student', 'version')
+
     # create a pandas dataframe
     data = []
     for submission in submissions:
-        question_grades = submission.get_question_grades()
-        question_grades_dict = dict()
-        for i, qg in enumerate(question_grades):
-            question_grades_dict[f'question_{i+1}_grade'] = qg
         section = None
         if submission.student:
             try:
@@ -637,10 +682,12 @@ def api_grades_list_view(request, assignment_pk):
             'grade': submission.grade,
             'section_id': section.pk if section else '',
             'section_name': section.name if section else 'Unassigned',
-            **question_grades_dict,
         }
         data.append(row)
     df = pd.DataFrame(data)
+    if not df.empty:
+        # the grades of the questions of all the submissions are loaded at once
+        df = df.join(QuestionGrade.get_dataframe(submissions), on='submission_id')
     # replace NaN with empty string
     df = df.fillna('')
     grades = df.to_dict(orient='records')
@@ -720,15 +767,11 @@ def submission_export_grades_csv_view(request):
 
     # get the submissions
     print(submission_pks)
-    submissions = PaperSubmission.objects.filter(pk__in=submission_pks)
-    
+    submissions = PaperSubmission.objects.filter(pk__in=submission_pks).select_related('student', 'version')
+
     # create a pandas dataframe
     data = []
     for submission in submissions:
-        question_grades = submission.get_question_grades()
-        question_grades_dict = dict()
-        for i, qg in enumerate(question_grades):
-            question_grades_dict[f'question_{i+1}_grade'] = qg
         row = {
             'submission_id': submission.pk,
             'submission_canvas_id': submission.canvas_id,
@@ -738,10 +781,12 @@ def submission_export_grades_csv_view(request):
             'student_uni_id': submission.student.uni_id if submission.student else '',
             'version': submission.version.name if submission.version else '',
             'grade': submission.grade,
-            **question_grades_dict,
         }
         data.append(row)
     df = pd.DataFrame(data)
+    if not df.empty:
+        # the grades of the questions of all the submissions are loaded at once
+        df = df.join(QuestionGrade.get_dataframe(submissions), on='submission_id')
     # create the response
     from django.http import HttpResponse
     response = HttpResponse(content_type='text/csv')
@@ -868,30 +913,50 @@ def api_submission_manual_version_view(request, submission_pk):
 def api_submissions_list_view(request, assignment_pk):
     """
     This view returns a list of submissions for an assignment
+
+    The `fields` query parameter selects among id, images and version, and
+    the list is paginated with a cursor when the `cursor` or `page_size`
+    query parameter is given.
     """
     # get the assignment object
     assignment = get_object_or_404(Assignment, pk=assignment_pk)
     # get the submissions for the assignment
+    fields, _ = parse_sparse_fieldset(request.GET)
+    if fields is None:
+        fields = ['id', 'images', 'version']
     submissions = PaperSubmission.objects.filter(assignment=assignment)
+    if 'images' in fields:
+        submissions = submissions.prefetch_related('submissions_papersubmissionimage_related')
+    if 'version' in fields:
+        submissions = submissions.select_related('version')
+    paginator = SubmissionCursorPagination()
+    page = paginator.paginate_queryset(submissions, request)
+    if page is not None:
+        submissions = page
     submissions_serialized = []
     for submission in submissions:
-        images_urls = submission.submissions_papersubmissionimage_related.all()
-        # .map(lambda x: (x.page, x.image.url))
-        images_urls = {image.page: image.image.url for image in images_urls}
         submission_serialized = dict()
         submission_serialized['id'] = submission.pk
-        submission_serialized['images'] = images_urls
-        if submission.version:
-            submission_serialized['version'] = dict()
-            submission_serialized['version']['id'] = submission.version.pk
-            submission_serialized['version']['name'] = submission.version.name
-        else:
-            submission_serialized['version'] = None
+        if 'images' in fields:
+            images_urls = submission.submissions_papersubmissionimage_related.all()
+            # .map(lambda x: (x.page, x.image.url))
+            images_urls = {image.page: image.image.url for image in images_urls}
+            submission_serialized['images'] = images_urls
+        if 'version' in fields:
+            if submission.version:
+                submission_serialized['version'] = dict()
+                submission_serialized['version']['id'] = submission.version.pk
+                submission_serialized['version']['name'] = submission.version.name
+            else:
+                submission_serialized['version'] = None
         submissions_serialized.append(submission_serialized)
-    return JsonResponse({
+    response = {
         'message': 'success',
         'submissions': submissions_serialized,
-    })
+    }
+    if page is not None:
+        response['next'] = paginator.get_next_link()
+    return JsonResponse(response)
 
 def submission_pdf_view(request, submission_pk):
     """